@@ -1,7 +1,28 @@
 __author__ = 'Hao'
 
 import multiprocessing
+import asyncio
+import collections
+import queue
+import threading
+import time
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from ingestHelpers import *
+from bulkPublisher import BulkPublisher, split_bulk
+from bulkDiff import BulkDiff
+from fingerprintStore import FingerprintStore
+from graphView import GraphView
+from documentSpec import DocumentSpec
+from memoCache import add_memo_arguments, configure_memo
+from referenceStore import add_reference_arguments, configure_references, trim_describe, reference_predicates
+from describeProfile import add_slim_arguments, configure_slim, slim_describe
+from esHelpers import publish_blue_green, check_not_alias, fast_load, optimize
+from checkpointJournal import CheckpointJournal, record_failure, read_retry_list, add_checkpoint_arguments, \
+    retry_list
+from adaptiveLimiter import add_adaptive_arguments, configure_adaptive
+from sparqlClient import SparqlClient, get_client, parse_graph, add_sparql_arguments, configure_sparql, \
+    settings as sparql_settings
 import itertools
 import json
 import requests
@@ -11,41 +32,127 @@ class Ingest:
 
     def __init__( self ):
         something = None
+        self.batch_size = 1
+        self.concurrency = 100
+        self.bulk_bytes = 5 * 1024 * 1024
+        self.bulk_docs = 1000
+        self.bulk_connections = 4
+        self.blue_green = False
+        self.keep_indices = 1
+        self.fast_load = False
+        self.optimize = False
+        self.manifest = None
+        self.views = {}
+        self.spec = None
+        self.retry = None
+        self.journal = None
+        self.refresh_cache = False
+
+    def __getstate__( self ):
+        # the journal stays with the process that writes the bulk file
+        state = dict( self.__dict__ )
+        state["journal"] = None
+        return state
 
     def ingest( self ):
         parser = argparse.ArgumentParser()
         parser.add_argument( '--threads', default=4, help='number of threads to use (default = 4)' )
+        parser.add_argument( '--engine', default="pool", choices=["pool", "async"], help='"pool" forks --threads workers that each fetch and build; "async" fetches with up to --concurrency requests in flight and builds on --threads workers (default = pool)' )
+        parser.add_argument( '--concurrency', default=100, help='number of in-flight SPARQL requests for --engine async (default = 100)' )
+        parser.add_argument( '--batch-size', default=50, help='number of entities to describe per SPARQL query (default = 50, 1 = one query per entity)' )
         parser.add_argument( '--es', default="http://localhost:9200", help="elasticsearch service URL" )
         parser.add_argument( '--publish', default=False, action="store_true", help="publish to elasticsearch?" )
         parser.add_argument( '--rebuild', default=False, action="store_true", help="rebuild elasticsearch index?" )
+        parser.add_argument( '--blue-green', default=False, action="store_true", help="publish into a fresh index and swap the alias to it when complete" )
+        parser.add_argument( '--fingerprints', help="store of the entity fingerprints and documents of the previous run, e.g. fingerprints/dataset.sqlite; only changed and new entities are described and built" )
+        parser.add_argument( '--manifest', help="hash manifest of the previously published documents, e.g. manifests/dataset.json.gz; only new, changed and deleted documents are published" )
+        parser.add_argument( '--fast-load', default=False, action="store_true", help="disable refresh and replicas of the index while publishing, restore them afterwards" )
+        parser.add_argument( '--optimize', default=False, action="store_true", help="merge the index down to one segment after publishing" )
+        parser.add_argument( '--keep-indices', default=1, help="number of previous indices to keep with --blue-green (default = 1)" )
         parser.add_argument( '--mapping', help="elasticsearch mapping document, e.g. mappings/dataset.json" )
+        parser.add_argument( '--bulk-bytes', default=5, help='maximum size in MB of each _bulk request sent to elasticsearch (default = 5)' )
+        parser.add_argument( '--bulk-docs', default=1000, help='maximum number of documents in each _bulk request (default = 1000)' )
+        parser.add_argument( '--bulk-connections', default=4, help='number of _bulk requests sent concurrently (default = 4)' )
         parser.add_argument( '--sparql', default='http://deepcarbon.tw.rpi.edu:3030/VIVO/query', help='sparql endpoint' )
+        add_sparql_arguments( parser )
+        add_adaptive_arguments( parser )
+        add_memo_arguments( parser )
+        add_reference_arguments( parser )
+        add_slim_arguments( parser )
+        add_checkpoint_arguments( parser )
         parser.add_argument( 'out', metavar='OUT', help='elasticsearch bulk ingest file')
 
         args = parser.parse_args()
+        configure_sparql( args )
+        configure_adaptive( args, int( args.concurrency if args.engine == "async" else args.threads ) )
+        configure_memo( args )
+        configure_slim( args )
 
         # if a mapping file is specified for the "publish" process later, use the specified mapping file
         self.threads = int( args.threads )
+        self.batch_size = int( args.batch_size )
+        self.concurrency = int( args.concurrency )
         self.es = args.es
         self.publish = args.publish
         self.rebuild = args.rebuild
+        self.blue_green = args.blue_green
+        self.keep_indices = int( args.keep_indices )
+        self.fast_load = args.fast_load
+        self.optimize = args.optimize
+        self.manifest = args.manifest
+        self.bulk_bytes = int( float( args.bulk_bytes ) * 1024 * 1024 )
+        self.bulk_docs = int( args.bulk_docs )
+        self.bulk_connections = int( args.bulk_connections )
         self.endpoint = args.sparql
+        # with --fingerprints only the changed entities are described, and a cached description would be stale
+        self.refresh_cache = bool( args.fingerprints )
+        configure_references( args, self.endpoint )
 
         if args.mapping:
             self.mapping = args.mapping
         else:
             self.mapping = self.get_mapping()
 
-        # generate bulk import document
-        self.generate()
+        # entities whose documents fail are written to the retry list, the progress to the journal (see --resume)
+        self.retry = retry_list( args, args.out )
+        self.journal = CheckpointJournal( args.out + ".journal", [args.out], resume=args.resume )
+
+        # generate bulk import document; actions stream through the bulk file (and on to elasticsearch)
+        # as they are produced, so memory use does not grow with the number of entities
+        with contextlib.ExitStack() as stack:
+            if self.journal.complete:
+                # only the publishing of the resumed run is left
+                actions = split_bulk( stack.enter_context( open( args.out ) ) )
+            else:
+                generate = self.generate_async if args.engine == "async" else self.generate
+                if args.fingerprints:
+                    actions = self.generate_changes( generate, FingerprintStore( args.fingerprints ) )
+                else:
+                    actions = generate()
+                actions = self.write_bulk_file( actions )
 
-        with open( args.out, "w" ) as bulk_file:
-            bulk_file.write( '\n'.join( self.records ) + '\n\n' )
+            # publish the results to elasticsearch if "--publish" was specified on the command line
+            if args.publish:
+                self.publish_to_es( actions )
+            else:
+                collections.deque( actions, maxlen=0 )
+        self.journal.remove()
 
-        # publish the results to elasticsearch if "--publish" was specified on the command line
-        if args.publish:
-            bulk_str = '\n'.join( self.records ) + '\n\n'
-            self.publish_to_es( bulk_str )
+
+    def write_bulk_file( self, actions ):
+        """
+        Pass bulk actions through while appending each of them to the bulk file of the journal.  With --resume the
+        actions the resumed run had written come first, so that they are published too.
+        :param actions:     iterable of bulk actions, see process_batch
+        :return:            a generator over the same actions
+        """
+        bulk_file, = self.journal.open()
+        yield from split_bulk( self.journal.resumed() )
+        for action in actions:
+            bulk_file.write( (action + '\n').encode( "utf-8" ) )
+            yield action
+        bulk_file.write( b'\n' )
+        self.journal.close()
 
 
     def process_entity( self, entity, something ):
@@ -68,37 +175,261 @@ class Ingest:
         """
         Helper function used by member function generate(...).
         :return:
-            a list of all the entities' uri values
+            a generator over all the entities' uri values, listed page by page (see ingestHelpers.iter_entities)
         """
         query = load_file( self.get_list_query_file() )
-        r = sparql_select( self.endpoint, query )
-        return [rs[self.get_type()]["value"] for rs in r]
+        return iter_entities( self.endpoint, query, "?" + self.get_type() )
+
+
+    def get_fingerprints( self ):
+        """
+        Helper function used by generate_changes() to fingerprint every entity with one aggregate query, derived from
+        the describe query by ingestHelpers.fingerprint_query.
+        :return:
+            a dict of the entities' uri values to their fingerprints, e.g. {"http://...": "42:5f1c...", ...}
+        """
+        query = fingerprint_query( load_file( self.get_describe_query_file() ), self.get_subject_name() )
+        subject = self.get_subject_name()[1:]
+        return {rs[subject]["value"]: rs["triples"]["value"] + ":" + rs["hash"]["value"]
+                for rs in sparql_select_iter( self.endpoint, query )}
+
+
+    def generate_changes( self, generate, store ):
+        """
+        Source-side change detection around generate() or generate_async(): only the entities whose fingerprint
+        differs from the one in the store (or that are new) are described and built, the stored actions of the other
+        entities are replayed, so the output is still complete.
+        Note:   Documents are matched to their entity by their "uri" field.  After changing create_document, delete
+                the store once so that every entity is built again.
+        :param generate:    self.generate or self.generate_async
+        :param store:       the FingerprintStore of the previous runs
+        :return:
+            a generator over the bulk actions of the changed entities followed by those of the unchanged ones.
+        """
+        entities = list( self.get_entities() )
+        fingerprints = self.get_fingerprints()
+        stored = store.fingerprints()
+        changed = [entity for entity in entities
+                   if fingerprints.get( entity ) is None or stored.get( entity ) != fingerprints[entity]]
+        print( "changed or new entities:", len( changed ), "of", len( entities ) )
+
+        built = set()
+        for action in generate( changed ):
+            entity = json.loads( action.partition( '\n' )[2] )["uri"]
+            store.put( entity, fingerprints.get( entity ), action )
+            built.add( entity )
+            yield action
+
+        # entities that did not produce a document are remembered too, so they are not described again; except the
+        # ones that failed, which keep their previous fingerprint and action so that the next run builds them again
+        # and their last good document is replayed until then, and the ones done by a resumed run, whose actions were
+        # written before this generator started
+        failed = read_retry_list( self.retry )
+        done = self.journal.done if self.journal is not None else set()
+        for entity in changed:
+            if entity in built or entity in done:
+                continue
+            if entity in failed:
+                action = store.get( entity )
+                if action:
+                    yield action
+            else:
+                store.put( entity, fingerprints.get( entity ), "" )
+
+        changed = set( changed )
+        for entity in entities:
+            if entity not in changed:
+                action = store.get( entity )
+                if action:
+                    yield action
+        store.retain( entities )
+
+
+    def process_batch( self, entities ):
+        """
+        Helper function used by generate() to describe a batch of entities with a single SPARQL query and then
+        process each of them.
+        Note:   The combined graph is handed to create_document as the view of every entity in the batch. Document
+                builders only traverse outward from their own subject, so they never see the other descriptions.
+        :param entities:    the subject entities to be described
+        :return:            one bulk action (metadata and document lines) per indexed entity
+        """
+        try:
+            graph = self.describe_entities( entities )
+        except Exception as e:
+            # describe the entities one by one, so that only the ones that fail on their own are lost
+            print( "batch of", len( entities ), "entities not described:", repr( e ) )
+            graph = None
+        return self.build_batch( entities, graph )
+
+
+    def build_batch( self, entities, graph ):
+        """
+        Helper function used by process_batch() and generate_async() to process a batch of already described entities.
+        An entity whose document cannot be built is reported and written to the retry list instead of failing the
+        batch, see checkpointJournal.record_failure.
+        :param entities:    the subject entities
+        :param graph:       the combined description of the entities, or None to describe each entity on its own;
+                            the builders traverse it through a GraphView
+        :return:            one bulk action (metadata and document lines) per indexed entity
+        """
+        self.views = dict.fromkeys( entities, GraphView( graph, self.get_reference_predicates() ) ) \
+            if graph is not None else {}
+        try:
+            actions = []
+            for entity in entities:
+                try:
+                    record = self.process_entity( entity, None )
+                except Exception as e:
+                    record_failure( self.retry, entity, e )
+                    continue
+                if record:
+                    actions.append( '\n'.join( record ) )
+            return actions
+        finally:
+            self.views = {}
+
+
+    def generate( self, entities=None ):
+        """
+        The major method to let an instance of Ingest generate the bulk actions.
+        Entities are described batch_size at a time, so a full ingest sends len(entities) / batch_size
+        DESCRIBE queries instead of one per entity.  At most two batches per worker are pending at any time.
+        With a journal, the entities done by the resumed run are skipped and every batch is checkpointed once its
+        actions have been consumed, i.e. written to the bulk file.
+        :param entities:    the entities to process (default = all, see get_entities)
+        :return:
+            a generator over the bulk actions of this Ingest process, in entity order.
+        """
+        with multiprocessing.Pool( self.threads ) as pool:
+            entity_batches = batches( self.get_pending( entities ), self.batch_size )
+            for entities, actions in bounded_imap( pool, self.process_batch, entity_batches, 2 * self.threads,
+                                                   with_items=True ):
+                yield from actions
+                self.checkpoint( entities )
+            # let the workers exit on their own, so they report their memo statistics
+            pool.close()
+            pool.join()
 
 
-    def generate( self ):
+    def get_pending( self, entities=None ):
         """
-        The major method to let an instance of Ingest generate the JSON records and store in self.records.
-        :param threads:
-        :param sparql: SPARQL endpoint
+        Helper function used by generate() and generate_async().
+        :param entities:    the entities to process (default = all, see get_entities)
+        :return:            the entities, without the ones done by the run the journal resumes
+        """
+        entities = self.get_entities() if entities is None else entities
+        return self.journal.pending( entities ) if self.journal is not None else entities
+
+
+    def checkpoint( self, entities ):
+        """Helper function used by generate() and generate_async() to journal a batch whose actions were written."""
+        if self.journal is not None:
+            self.journal.checkpoint( entities )
+
+
+    def build_raw_batch( self, entities, data, content_type ):
+        """
+        Helper function used by generate_async() to parse a fetched DESCRIBE response and process its entities.
+        Runs on the CPU workers so that graph parsing stays off the event loop.
+        """
+        return self.build_batch( entities, parse_graph( data, content_type ) )
+
+
+    def generate_async( self, entities=None ):
+        """
+        Alternative to generate() for network-bound ingests.  An asyncio fetcher keeps up to self.concurrency
+        DESCRIBE requests in flight from this process over one pooled client, and hands each raw response to a
+        pool of self.threads processes that parse it and run create_document.
+        The event loop runs on a background thread and hands finished batches over through a bounded queue, so
+        fetching pauses while the consumer (bulk file, elasticsearch) is behind.
+        :param entities:    the entities to process (default = all, see get_entities)
         :return:
-            the output JSON records of this Ingest process.
+            a generator over the bulk actions of this Ingest process, in entity order.
         """
-        pool = multiprocessing.Pool( self.threads )
-        sparql = self.endpoint
-        #for object in self.get_entities():
-        #    json_entity = self.process_entity( object )
-        params = [(object,None)
-                  for object in self.get_entities()]
-        self.records = list(itertools.chain.from_iterable(pool.starmap(self.process_entity, params)))
+        client = SparqlClient( self.endpoint, connections=self.concurrency ) if not sparql_settings["source"] \
+            else get_client( self.endpoint )
+        entity_batches = batches( self.get_pending( entities ), self.batch_size )
+        done = object()
+        results = queue.Queue( self.concurrency )
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            with ThreadPoolExecutor( self.concurrency ) as io, ProcessPoolExecutor( self.threads ) as cpu:
+
+                async def fetch_and_build( entities ):
+                    try:
+                        raw = await loop.run_in_executor( io, client.describe_raw, self.get_batch_query( entities ),
+                                                          self.refresh_cache )
+                    except Exception as e:
+                        # describe the entities one by one on the workers, as process_batch does
+                        print( "batch of", len( entities ), "entities not described:", repr( e ) )
+                        return entities, await loop.run_in_executor( cpu, self.build_batch, entities, None )
+                    return entities, await loop.run_in_executor( cpu, self.build_raw_batch, entities, *raw )
 
-    def publish_to_es( self, bulk ):
+                # sliding window of self.concurrency batches, handed over in order
+                pending = collections.deque()
+                for entities in entity_batches:
+                    pending.append( asyncio.ensure_future( fetch_and_build( entities ) ) )
+                    if len( pending ) >= self.concurrency:
+                        await loop.run_in_executor( None, results.put, await pending.popleft() )
+                while pending:
+                    await loop.run_in_executor( None, results.put, await pending.popleft() )
+
+        def fetcher():
+            try:
+                asyncio.run( run() )
+                results.put( done )
+            except BaseException as e:
+                results.put( e )
+
+        threading.Thread( target=fetcher, daemon=True ).start()
+        while True:
+            result = results.get()
+            if result is done:
+                return
+            if isinstance( result, BaseException ):
+                raise result
+            entities, actions = result
+            yield from actions
+            self.checkpoint( entities )
+
+    def publish_to_es( self, actions ):
         """
         The majar method to publish the result of the Ingest process.
-        :param bulk:        the bulk file containing the ingest result
-        :param endpoint:    SPARQL endpoint
-        :param rebuild:
+        Actions are sent in _bulk requests of at most self.bulk_bytes and self.bulk_docs, over self.bulk_connections
+        concurrent connections, as soon as enough of them have been generated.  Items rejected by elasticsearch are
+        retried; the numbers of indexed and failed documents are reported at the end.
+        Note:   The index is prepared (and, with --rebuild, emptied) before the first action is consumed, i.e. while
+                the documents are still being generated.
+        With --blue-green the documents go to a fresh index of this type instead, see esHelpers.publish_blue_green.
+        With --fast-load refresh and replicas are turned off during the load (see esHelpers.fast_load), and with
+        --optimize the index is merged afterwards.  A timing report of the phases is printed either way, so runs with
+        and without these options can be compared.
+        With --manifest only the documents that changed since the previous run are sent, and deletes for the ones
+        that vanished, see bulkDiff.BulkDiff; a rebuilt or blue/green index still receives every document.  Nothing is
+        deleted while the retry list names entities that failed.
+        :param actions:     iterable of bulk actions containing the ingest result
         """
 
+        started = time.time()
+        diff = None
+        if self.manifest:
+            diff = BulkDiff( self.manifest, self.get_index(), self.get_type() )
+            actions = diff.diff( actions, full=self.blue_green or self.rebuild, retry=self.retry )
+
+        if self.blue_green:
+            publisher = publish_blue_green( self.es, self.get_index(), self.get_type(), self.mapping, actions,
+                                            keep=self.keep_indices, max_bytes=self.bulk_bytes,
+                                            max_actions=self.bulk_docs, connections=self.bulk_connections )
+            if diff is not None:
+                diff.commit( publisher )
+            self.report_timing( publisher, started, time.time() )
+            return publisher
+
+        # once types are published blue/green, the index is an alias that cannot be indexed into (or rebuilt) directly
+        check_not_alias( self.es, self.get_index() )
+
         # if configured to rebuild_index
         # Delete and then re-create to publication index (via PUT request)
 
@@ -128,16 +459,75 @@ class Ingest:
                     r.raise_for_status()
 
         # bulk import new publication documents
-        bulk_import_url = self.es + "/_bulk"
-        r = requests.post( bulk_import_url, data=bulk )
-        if r.status_code != requests.codes.ok:
-            print(r.url, r.status_code)
-            r.raise_for_status()
+        publisher = BulkPublisher( self.es, max_bytes=self.bulk_bytes, max_actions=self.bulk_docs,
+                                   connections=self.bulk_connections )
+        loading = time.time()
+        with fast_load( self.es, self.get_index() ) if self.fast_load else contextlib.nullcontext():
+            publisher.publish( actions )
+            loaded = time.time()
+        publisher.report()
+
+        restored = time.time()
+        if self.optimize:
+            optimize( self.es, self.get_index() )
 
+        if diff is not None:
+            diff.commit( publisher )
+        self.report_timing( publisher, started, loading, loaded, restored, time.time() )
+        return publisher
+
+
+    def report_timing( self, publisher, *checkpoints ):
+        """
+        Print how long each phase of publish_to_es took.
+        :param publisher:       the BulkPublisher used, for the number of documents
+        :param checkpoints:     time.time() at the start and end of each phase; either (start, end) of a blue/green
+                                publish, or the start and the ends of index setup, load, restore and optimize
+        """
+        phases = ["setup", "load", "restore", "optimize"] if len( checkpoints ) > 2 else ["blue/green"]
+        durations = [end - start for start, end in zip( checkpoints, checkpoints[1:] )]
+        total = checkpoints[-1] - checkpoints[0]
+        print( "publish timing:", ", ".join( "%s %.1fs" % phase for phase in zip( phases, durations ) ),
+               "| total %.1fs, %.0f docs/s" % (total, (publisher.indexed + publisher.deleted) / max( total, 0.001 )) )
+
+
+    # create_document: builds the document of an entity with the document spec of get_spec_file(), see documentSpec.py;
+    # override it for a hand-written builder
+    def create_document( self, entity ):
+        if self.spec is None:
+            self.spec = DocumentSpec( self.get_spec_file() )
+        graph = self.describe_entity( entity )
+        return self.spec.build( graph.resource( entity ) )
+
+    # get_reference_variables: the variables of the describe query bound to entities of the reference store, which
+    # are left out of the describe query when the run uses one (see referenceStore.py); override it to list them
+    def get_reference_variables( self ):
+        return []
+
+    # get_reference_predicates: the predicates through which the describe query reaches its reference variables, whose
+    # entities GraphView completes from the reference store
+    def get_reference_predicates( self ):
+        return reference_predicates( load_file( self.get_describe_query_file() ), self.get_reference_variables() )
+
+    # get_describe_query: the describe query without the reference entities (see referenceStore.py), or its slim
+    # CONSTRUCT form with --slim (see describeProfile.py)
+    def get_describe_query( self ):
+        query = trim_describe( load_file( self.get_describe_query_file() ), self.get_reference_variables() )
+        return slim_describe( query, self.get_type() )
 
     # describe_entity: helper function for create_document
     def describe_entity( self, entity ):
-        query = load_file( self.get_describe_query_file() )
-        query = query.replace( self.get_subject_name(), "<" + entity + ">" )
-        return sparql_describe( self.endpoint, query )
+        if entity in self.views:
+            return self.views[entity]
+        query = self.get_describe_query().replace( self.get_subject_name(), "<" + entity + ">" )
+        graph = sparql_describe( self.endpoint, query, self.refresh_cache )
+        return GraphView( graph, self.get_reference_predicates() ) if graph is not None else None
+
+    # describe_entities: helper function for process_batch
+    def describe_entities( self, entities ):
+        return sparql_describe( self.endpoint, self.get_batch_query( entities ), self.refresh_cache )
+
+    # get_batch_query: the describe query bound to a batch of entities
+    def get_batch_query( self, entities ):
+        return bind_values( self.get_describe_query(), self.get_subject_name(), entities )
 
@@ -0,0 +1,140 @@
+import multiprocessing
+import time
+
+import sparqlClient
+
+
+def percentile( values, p ):
+    """:return: the p-th percentile of sorted values (nearest rank), e.g. percentile( latencies, 95 )"""
+    return values[min( len( values ) - 1, int( len( values ) * p / 100.0 ) )]
+
+
+class AdaptiveLimiter:
+    """
+    Limit on the number of SPARQL requests in flight, adapted to the endpoint by AIMD: after every `window` answered
+    requests the limit is raised by one while their median latency stays within `tolerance` times the lowest median
+    seen so far, and cut in half once it does not; a timeout, a dropped connection or a 5xx response cuts it in half
+    at once.  The limit stays between `floor` and `ceiling`, and every decision is printed with the latency
+    percentiles it was based on.
+    Its state is shared by the processes forked after it is created, so one limit covers all the workers of a run.
+    """
+
+    def __init__( self, floor, ceiling, window=20, tolerance=1.5, increase=1, decrease=0.5 ):
+        """
+        :param floor:       lowest limit, and the one to start from
+        :param ceiling:     highest limit, e.g. the number of workers
+        :param window:      number of answered requests per decision
+        :param tolerance:   factor by which the median latency may exceed the lowest one seen for the limit to rise
+        :param increase:    requests added to the limit per decision
+        :param decrease:    factor the limit is multiplied by when the latency rises or the endpoint is overloaded
+        """
+        self.floor = max( 1, floor )
+        self.ceiling = max( self.floor, ceiling )
+        self.window = max( 1, window )
+        self.tolerance = tolerance
+        self.increase = increase
+        self.decrease = decrease
+        self.started = time.time()
+
+        # shared with the forked workers; guarded by the condition, which also wakes the requests waiting for a slot
+        self.condition = multiprocessing.Condition()
+        self.limit = multiprocessing.RawValue( "d", self.floor )
+        self.in_flight = multiprocessing.RawValue( "i", 0 )
+        # the number of changes of the limit; a request only counts towards the decision on the limit it started under
+        self.epoch = multiprocessing.RawValue( "i", 0 )
+        self.latencies = multiprocessing.RawArray( "d", self.window )
+        self.samples = multiprocessing.RawValue( "i", 0 )
+        self.errors = multiprocessing.RawValue( "i", 0 )
+        self.lowest = multiprocessing.RawValue( "d", 0.0 )
+        print( "sparql concurrency: adaptive between %d and %d" % (self.floor, self.ceiling) )
+
+    def call( self, request, overloaded ):
+        """
+        Send a request once the number of requests in flight is below the limit.
+        :param request:     function sending the request, e.g. a requests.Session.post
+        :param overloaded:  function telling whether the response (or exception) of the request shows an overloaded
+                            endpoint, e.g. a timeout or a 5xx
+        :return:            the response
+        """
+        epoch = self.acquire()
+        started = time.time()
+        try:
+            response = request()
+        except Exception as e:
+            self.release( epoch, time.time() - started, overloaded( e ) )
+            raise
+        self.release( epoch, time.time() - started, overloaded( response ) )
+        return response
+
+    def acquire( self ):
+        """:return: the epoch of the limit the request starts under, once a slot is free"""
+        with self.condition:
+            while self.in_flight.value >= int( self.limit.value ):
+                self.condition.wait()
+            self.in_flight.value += 1
+            return self.epoch.value
+
+    def release( self, epoch, seconds, overloaded ):
+        """Free the slot of a request and record its latency, or cut the limit if the endpoint is overloaded."""
+        with self.condition:
+            self.in_flight.value -= 1
+            if epoch == self.epoch.value:
+                # requests that started under an earlier limit tell nothing about the current one, and a burst of
+                # errors cuts the limit once
+                if overloaded:
+                    self.errors.value += 1
+                    self.adjust( self.limit.value * self.decrease, "overloaded" )
+                else:
+                    self.latencies[self.samples.value] = seconds
+                    self.samples.value += 1
+                    if self.samples.value == self.window:
+                        self.decide()
+            self.condition.notify_all()
+
+    def decide( self ):
+        """Raise the limit if the latency of the window holds, otherwise cut it."""
+        p50 = percentile( sorted( self.latencies[:self.samples.value] ), 50 )
+        if not self.lowest.value or p50 < self.lowest.value:
+            self.lowest.value = p50
+        if p50 <= self.lowest.value * self.tolerance:
+            self.adjust( self.limit.value + self.increase, "latency holds" )
+        else:
+            self.adjust( self.limit.value * self.decrease, "latency rising" )
+
+    def adjust( self, limit, reason ):
+        """Set the limit within the floor and the ceiling, log the decision and start the next window."""
+        latencies = sorted( self.latencies[:self.samples.value] )
+        previous = int( self.limit.value )
+        self.limit.value = min( self.ceiling, max( self.floor, limit ) )
+        print( "sparql concurrency %d -> %d after %.0fs, %s: p50 %s, p95 %s, %d errors in %d requests" % (
+            previous, int( self.limit.value ), time.time() - self.started, reason,
+            "%.0f ms" % (percentile( latencies, 50 ) * 1000) if latencies else "-",
+            "%.0f ms" % (percentile( latencies, 95 ) * 1000) if latencies else "-",
+            self.errors.value, len( latencies ) + self.errors.value) )
+        self.epoch.value += 1
+        self.samples.value = 0
+        self.errors.value = 0
+
+
+def add_adaptive_arguments( parser ):
+    """Add the adaptive concurrency command line options to an argparse parser."""
+    parser.add_argument( '--adaptive', default=False, action="store_true", help='adapt the number of SPARQL requests in flight to the latency and errors of the endpoint (AIMD), between --adaptive-floor and --adaptive-ceiling' )
+    parser.add_argument( '--adaptive-floor', default=1, type=int, help='lowest number of SPARQL requests in flight with --adaptive, and the one to start from (default = %(default)s)' )
+    parser.add_argument( '--adaptive-ceiling', type=int, help='highest number of SPARQL requests in flight with --adaptive (default = the number of workers)' )
+    parser.add_argument( '--adaptive-window', default=20, type=int, help='number of SPARQL responses per adjustment with --adaptive (default = %(default)s)' )
+    parser.add_argument( '--adaptive-tolerance', default=1.5, type=float, help='factor by which the median latency may exceed the lowest one seen for --adaptive to raise the concurrency; beyond it the concurrency is halved (default = %(default)s)' )
+
+
+def configure_adaptive( args, ceiling ):
+    """
+    Apply the options added by add_adaptive_arguments; after configure_sparql and before worker pools are forked.
+    :param args:        the parsed arguments
+    :param ceiling:     the default ceiling, i.e. the concurrency of the run without --adaptive
+    :return:            the limiter, or None without --adaptive
+    """
+    if not args.adaptive:
+        return None
+    limiter = AdaptiveLimiter( args.adaptive_floor, args.adaptive_ceiling or ceiling, window=args.adaptive_window,
+                               tolerance=args.adaptive_tolerance )
+    sparqlClient.settings["limiter"] = limiter
+    return limiter
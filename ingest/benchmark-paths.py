@@ -0,0 +1,108 @@
+"""
+Microbenchmark of the compiled property paths (propertyPath.py) against the equivalent Maybe chains they replaced
+in ingest-people.py, on a synthetic graph of people with names, emails and positions.
+
+    e.g. `python3 benchmark-paths.py --people 1000 --repeat 5`
+"""
+
+import argparse
+import timeit
+
+from rdflib import Graph, Literal, RDF, RDFS, URIRef
+
+from Maybe import Maybe
+from graphView import GraphView
+from propertyPath import PropertyPath, PREFIXES
+
+OBO, VCARD, VIVO, FOAF = PREFIXES["obo"], PREFIXES["vcard"], PREFIXES["vivo"], PREFIXES["foaf"]
+
+non_empty_str = lambda s: True if s else False
+has_label = lambda o: True if o.label() else False
+has_type = lambda resource, type: type in resource.types
+
+GIVEN_NAME = PropertyPath("obo:ARG_2000028/vcard:hasName/vcard:givenName[nonempty]")
+EMAIL = PropertyPath("obo:ARG_2000028/vcard:hasEmail[a vcard:Work]/vcard:email[nonempty]")
+POSITIONS = PropertyPath("vivo:relatedBy[a vivo:Position]")
+POSITION_ORGANIZATION = PropertyPath("vivo:relates[a foaf:Organization]")
+
+
+def make_graph( people ):
+    graph = Graph()
+    for i in range( people ):
+        person, vcard, name, email = (URIRef( "http://example.org/%s%d" % (kind, i) )
+                                      for kind in ("person", "vcard", "name", "email"))
+        graph.add( (person, RDF.type, FOAF.Person) )
+        graph.add( (person, RDFS.label, Literal( "Person %d" % i )) )
+        graph.add( (person, OBO.ARG_2000028, vcard) )
+        graph.add( (vcard, VCARD.hasName, name) )
+        graph.add( (name, VCARD.givenName, Literal( "Given%d" % i )) )
+        graph.add( (name, VCARD.familyName, Literal( "Family%d" % i )) )
+        graph.add( (vcard, VCARD.hasEmail, email) )
+        graph.add( (email, RDF.type, VCARD.Work) )
+        graph.add( (email, VCARD.email, Literal( "person%d@example.org" % i )) )
+        for j in range( 3 ):
+            position, org = URIRef( "http://example.org/position%d-%d" % (i, j) ), URIRef( "http://example.org/org%d" % j )
+            graph.add( (person, VIVO.relatedBy, position) )
+            graph.add( (position, RDF.type, VIVO.Position) )
+            graph.add( (position, RDFS.label, Literal( "Position %d" % j )) )
+            graph.add( (position, VIVO.relates, person) )
+            graph.add( (position, VIVO.relates, org) )
+            graph.add( (org, RDF.type, FOAF.Organization) )
+            graph.add( (org, RDFS.label, Literal( "Organization %d" % j )) )
+    return graph
+
+
+def maybe_fields( person ):
+    given_name = Maybe.of( person ).stream() \
+        .flatmap( lambda p: p.objects( OBO.ARG_2000028 ) ) \
+        .flatmap( lambda v: v.objects( VCARD.hasName ) ) \
+        .flatmap( lambda n: n.objects( VCARD.givenName ) ) \
+        .filter( non_empty_str ) \
+        .one().value
+    email = Maybe.of( person ).stream() \
+        .flatmap( lambda p: p.objects( OBO.ARG_2000028 ) ) \
+        .flatmap( lambda v: v.objects( VCARD.hasEmail ) ) \
+        .filter( lambda f: has_type( f, VCARD.Work ) ) \
+        .flatmap( lambda e: e.objects( VCARD.email ) ) \
+        .filter( non_empty_str ) \
+        .one().value
+    orgs = []
+    orgroles = Maybe.of( person ).stream() \
+        .flatmap( lambda per: per.objects( VIVO.relatedBy ) ) \
+        .filter( lambda related: has_type( related, VIVO.Position ) ).list()
+    for orgrole in orgroles:
+        org = Maybe.of( orgrole ).stream() \
+            .flatmap( lambda r: r.objects( VIVO.relates ) ) \
+            .filter( lambda o: has_type( o, FOAF.Organization ) ) \
+            .filter( has_label ) \
+            .map( lambda o: {"uri": str( o.identifier ), "name": str( o.label() )} ) \
+            .one().value
+        if org:
+            orgs.append( {"orgrole": str( orgrole.label() ), "organization": org} )
+    return given_name, email, orgs
+
+
+def path_fields( person ):
+    orgs = []
+    for orgrole in POSITIONS.all( person ):
+        org = POSITION_ORGANIZATION.labelled( orgrole, first=True )
+        if org:
+            orgs.append( {"orgrole": str( orgrole.label() ), "organization": org} )
+    return GIVEN_NAME.first( person ), EMAIL.first( person ), orgs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--people', default=1000, type=int, help='number of synthetic people (default = %(default)s)' )
+    parser.add_argument( '--repeat', default=5, type=int, help='number of timed runs, the best one is reported (default = %(default)s)' )
+    args = parser.parse_args()
+
+    view = GraphView( make_graph( args.people ) )
+    people = [view.resource( "http://example.org/person%d" % i ) for i in range( args.people )]
+    assert [maybe_fields( p ) for p in people] == [path_fields( p ) for p in people]
+
+    maybe_time = min( timeit.repeat( lambda: [maybe_fields( p ) for p in people], number=1, repeat=args.repeat ) )
+    path_time = min( timeit.repeat( lambda: [path_fields( p ) for p in people], number=1, repeat=args.repeat ) )
+    print( "Maybe chains:    %.2f us/person" % (maybe_time / args.people * 1e6) )
+    print( "property paths:  %.2f us/person" % (path_time / args.people * 1e6) )
+    print( "speed-up:        %.1fx" % (maybe_time / path_time) )
@@ -0,0 +1,110 @@
+import gzip
+import hashlib
+import json
+import os
+
+from checkpointJournal import read_retry_list
+
+
+class BulkDiff:
+    """
+    Reduces the bulk actions of a complete ingest run to the changes since the previous run.
+    A hash manifest, {"<_id>": "<document hash>", ...}, is kept per type: index actions whose document hash is
+    unchanged are dropped, and for every _id of the previous manifest that was not generated again a delete action
+    is emitted.  The manifest is only written (see save) once the changes have been published, so a failed run is
+    simply repeated in full by the next one.
+    A document that was not generated again may belong to an entity whose document could not be built this time, e.g.
+    during a SPARQL outage, so no document is deleted while the retry list of the run names any failed entity: the
+    documents are kept along with their hashes, and are deleted by the next run without failures if they are gone.
+    """
+
+    def __init__( self, path, index, es_type ):
+        """
+        :param path:        the manifest file, gzipped JSON; a missing file makes every document new
+        :param index:       the index delete actions are sent to, e.g. "dco"
+        :param es_type:     the document type, e.g. "dataset"
+        """
+        self.path = path
+        self.index = index
+        self.es_type = es_type
+        self.previous = {}
+        if os.path.exists( path ):
+            with gzip.open( path, "rt" ) as manifest:
+                self.previous = json.load( manifest )
+        self.current = {}
+        self.unchanged = 0
+        self.changed = 0
+        self.new = 0
+        self.deleted = 0
+        self.kept = 0
+        self.failed = 0
+
+    @staticmethod
+    def hash( source ):
+        """:return: the hash of a document line, independent of the order of its keys"""
+        normalized = json.dumps( json.loads( source ), sort_keys=True, separators=(",", ":") )
+        return hashlib.sha1( normalized.encode( "utf-8" ) ).hexdigest()[:20]
+
+    def diff( self, actions, full=False, retry=None ):
+        """
+        :param actions:     iterable of the bulk actions of a complete run
+        :param full:        pass every action through while still hashing it, e.g. when the index was rebuilt
+        :param retry:       the retry list of the run (see checkpointJournal.record_failure), read once every action
+                            has been consumed
+        :return:            a generator over the index actions of new and changed documents, followed by the delete
+                            actions of documents that vanished, unless entities failed
+        """
+        for action in actions:
+            meta, _, source = action.partition( '\n' )
+            op = next( iter( json.loads( meta ).values() ) )
+            doc_id = op["_id"]
+            doc_hash = self.current[doc_id] = self.hash( source )
+
+            previous = self.previous.get( doc_id )
+            if previous == doc_hash:
+                self.unchanged += 1
+            elif previous is None:
+                self.new += 1
+            else:
+                self.changed += 1
+
+            if full or previous != doc_hash:
+                yield action
+
+        self.failed = len( read_retry_list( retry ) )
+        for doc_id, doc_hash in self.previous.items():
+            if doc_id not in self.current:
+                if self.failed and not full:
+                    # still in the index, and in the manifest until a run without failures deletes it
+                    self.current[doc_id] = doc_hash
+                    self.kept += 1
+                    continue
+                self.deleted += 1
+                if not full:
+                    yield json.dumps( {"delete": {"_index": self.index, "_type": self.es_type, "_id": doc_id}} )
+
+    def report( self ):
+        print( "new:", self.new, "changed:", self.changed, "unchanged:", self.unchanged, "deleted:", self.deleted )
+        if self.kept:
+            print( "not deleting", self.kept, "documents after", self.failed, "failed entities" )
+
+    def commit( self, publisher ):
+        """
+        Report the diff and save the manifest, unless some documents failed to publish; the next run then re-sends
+        every change since the last complete run.
+        :param publisher:   the BulkPublisher the actions were sent with
+        """
+        self.report()
+        if publisher.failed:
+            print( "not updating", self.path, "after", publisher.failed, "failed documents" )
+        else:
+            self.save()
+
+    def save( self ):
+        """Replace the manifest with the hashes of the documents generated by this run."""
+        directory = os.path.dirname( self.path )
+        if directory:
+            os.makedirs( directory, exist_ok=True )
+        with gzip.open( self.path + ".tmp", "wt" ) as manifest:
+            json.dump( self.current, manifest, separators=(",", ":") )
+        os.replace( self.path + ".tmp", self.path )
@@ -0,0 +1,132 @@
+import collections
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# item and request statuses worth retrying: the bulk thread pool queue of a node was full
+RETRY_STATUSES = (429, 503)
+
+
+def split_bulk( bulk ):
+    """
+    Split the text of a bulk file into bulk actions.
+    :param bulk:    newline separated bulk lines, e.g. the content of a bulk file, or an iterable of the lines, e.g.
+                    an open bulk file, which is then read line by line
+    :return:        a generator over the actions: the metadata line, followed by the document line for index actions
+    """
+    lines = bulk.split( '\n' ) if isinstance( bulk, str ) else (line.rstrip( '\n' ) for line in bulk)
+    lines = iter( line for line in lines if line.strip() )
+    for line in lines:
+        if "delete" in json.loads( line ):
+            yield line
+        else:
+            yield line + '\n' + next( lines )
+
+
+class BulkPublisher:
+    """
+    Publishes bulk actions to elasticsearch in chunks over several concurrent connections.
+    Chunks are cut by size and by number of actions.  The item-level results of every _bulk response are checked:
+    items rejected by a full bulk queue (429) are retried with exponential backoff, other item failures are counted
+    and the first few of them are kept for the report.
+    """
+
+    def __init__( self, es, max_bytes=5 * 1024 * 1024, max_actions=1000, connections=4, retries=5, backoff=1.0 ):
+        self.bulk_url = es + "/_bulk"
+        self.max_bytes = max_bytes
+        self.max_actions = max_actions
+        self.connections = connections
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        self.session.mount( "http://", HTTPAdapter( pool_maxsize=connections ) )
+        self.session.mount( "https://", HTTPAdapter( pool_maxsize=connections ) )
+
+        self.lock = threading.Lock()
+        self.indexed = 0
+        self.deleted = 0
+        self.failed = 0
+        self.errors = []
+
+    def publish( self, actions ):
+        """
+        Send bulk actions, at most `connections` chunks at a time.
+        :param actions:     iterable of bulk actions; consumed lazily
+        :return:            self, for the counters
+        """
+        with ThreadPoolExecutor( self.connections ) as executor:
+            pending = collections.deque()
+            for chunk in self.chunks( actions ):
+                pending.append( executor.submit( self.send, chunk ) )
+                if len( pending ) >= self.connections:
+                    pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        return self
+
+    def chunks( self, actions ):
+        chunk = []
+        size = 0
+        for action in actions:
+            action = action.encode( "utf-8" ) + b'\n'
+            if chunk and (size + len( action ) > self.max_bytes or len( chunk ) >= self.max_actions):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append( action )
+            size += len( action )
+        if chunk:
+            yield chunk
+
+    def send( self, chunk ):
+        """Send one chunk, then re-send its rejected items until they succeed or the retries are used up."""
+        for attempt in range( self.retries + 1 ):
+            if attempt:
+                time.sleep( self.backoff * 2 ** (attempt - 1) )
+
+            r = self.session.post( self.bulk_url, data=b''.join( chunk ) )
+            if r.status_code in RETRY_STATUSES:
+                continue
+            if r.status_code != requests.codes.ok:
+                print( r.url, r.status_code )
+                r.raise_for_status()
+
+            chunk = self.check( chunk, r.json()["items"] )
+            if not chunk:
+                return
+
+        with self.lock:
+            self.failed += len( chunk )
+            self.errors.extend( "retries exhausted: " + action.split( b'\n' )[0].decode( "utf-8" ) for action in chunk[:10] )
+
+    def check( self, chunk, items ):
+        """
+        Count the item-level results of a _bulk response.
+        :return:    the actions to retry
+        """
+        retry = []
+        with self.lock:
+            for action, item in zip( chunk, items ):
+                op, result = next( iter( item.items() ) )
+                status = result.get( "status", 500 )
+                if op == "delete" and status in (200, 404):
+                    self.deleted += 1
+                elif status < 300:
+                    self.indexed += 1
+                elif status in RETRY_STATUSES or "EsRejectedExecutionException" in str( result.get( "error" ) ):
+                    retry.append( action )
+                else:
+                    self.failed += 1
+                    if len( self.errors ) < 10:
+                        self.errors.append( "%s %s: %s" % (op, result.get( "_id" ), result.get( "error" )) )
+        return retry
+
+    def report( self ):
+        print( "indexed:", self.indexed, "deleted:", self.deleted, "failed:", self.failed )
+        for error in self.errors:
+            print( "  ", error )
@@ -0,0 +1,206 @@
+import gzip
+import json
+import os
+
+
+def record_failure( retry, entity, error ):
+    """
+    Report an entity whose document could not be built and append its URI to the retry list.  Called by the workers;
+    each URI is one short append, so the workers of a run can share the list.
+    :param retry:   the retry list, or None to only report the failure
+    :param entity:  the URI of the entity
+    :param error:   the exception
+    """
+    print( "failed:", entity, repr( error ) )
+    if retry:
+        with open( retry, "a" ) as retry_file:
+            retry_file.write( entity + '\n' )
+
+
+class Isolated:
+    """
+    A processing function of the function-style ingest scripts (e.g. process_project) that records the entities it
+    fails on (see record_failure) instead of raising, so one broken entity does not abort the run.  A function that
+    takes a batch of entities (e.g. process_people) is called again for each entity of a batch it fails on.
+    """
+
+    def __init__( self, function, retry=None, batched=False ):
+        self.function = function
+        self.retry = retry
+        self.batched = batched
+
+    def __call__( self, entities, *args, **kwargs ):
+        if not self.batched:
+            return self.call( entities, entities, *args, **kwargs )
+        try:
+            return self.function( entities, *args, **kwargs )
+        except Exception:
+            if len( entities ) == 1:
+                return self.call( entities, entities[0], *args, **kwargs )
+            return [line for entity in entities for line in self.call( [entity], entity, *args, **kwargs )]
+
+    def call( self, argument, entity, *args, **kwargs ):
+        try:
+            return self.function( argument, *args, **kwargs )
+        except Exception as e:
+            record_failure( self.retry, entity, e )
+            return []
+
+
+def open_bulk( path, mode ):
+    """:return: a bulk file, gzipped if its name ends with .gz, opened in binary `mode`"""
+    return gzip.open( path, mode ) if path.endswith( ".gz" ) else open( path, mode )
+
+
+class CheckpointJournal:
+    """
+    A journal of the progress of a run: after the bulk lines of each batch of entities have been written, the URIs of
+    the entities and the lengths of the bulk files are appended to it, followed by a "complete" entry once the files
+    are complete, so that only the publishing is left, and a "finished" entry once they are published.  With --resume,
+    a run that crashed or was killed continues from the journal of the previous one: the bulk files are cut back to
+    their lengths at the last checkpoint (dropping lines written after it) and the entities of the checkpoints are not
+    processed again.
+    The journal is JSON lines, the first one naming the bulk files; it is removed once its run has finished.
+    """
+
+    def __init__( self, path, bulk_paths=None, resume=False ):
+        """
+        :param path:        the journal file, e.g. datasets.bulk.journal
+        :param bulk_paths:  the bulk files of the run; with resume, the ones of the journal are used
+        :param resume:      continue the run of the journal, if there is one
+        """
+        self.path = path
+        self.done = set()
+        self.lengths = None
+        self.complete = False
+        self.finished = False
+
+        resumed = resume and os.path.exists( path )
+        if resumed:
+            with open( path, "r+b" ) as journal:
+                end = 0
+                for line in journal:
+                    try:
+                        entry = json.loads( line.decode( "utf-8" ) )
+                    except ValueError:
+                        # the last entry of a killed run may be incomplete
+                        break
+                    end += len( line )
+                    if "bulk" in entry:
+                        bulk_paths = entry["bulk"]
+                    elif "entities" in entry:
+                        self.done.update( entry["entities"] )
+                        self.lengths = entry["lengths"]
+                    self.complete = self.complete or entry.get( "complete", False )
+                    self.finished = self.finished or entry.get( "finished", False )
+                journal.truncate( end )
+            print( "resuming from %s: %d entities done%s" % (path, len( self.done ),
+                                                             ", bulk files complete" if self.complete else "") )
+        self.bulk_paths = list( bulk_paths )
+        self.bulk_files = None
+        self.resumed_lengths = None
+
+        if self.lengths is None:
+            self.lengths = [0] * len( self.bulk_paths )
+        if resumed:
+            self.journal = open( path, "a" )
+        else:
+            self.journal = open( path, "w" )
+            self.write( {"bulk": self.bulk_paths} )
+
+    def write( self, entry ):
+        self.journal.write( json.dumps( entry ) + '\n' )
+        self.journal.flush()
+
+    def pending( self, entities ):
+        """:return: a generator over the entities not done by the resumed run"""
+        return (entity for entity in entities if entity not in self.done)
+
+    def open( self ):
+        """
+        Open the bulk files for the lines of the entities still to do, after the lines of the resumed run up to its
+        last checkpoint, which are copied over from the previous files.
+        :return:    the bulk files, opened in binary mode
+        """
+        self.bulk_files = []
+        self.resumed_lengths = list( self.lengths )
+        for path, length in zip( self.bulk_paths, self.lengths ):
+            if not length:
+                self.bulk_files.append( open_bulk( path, "wb" ) )
+                continue
+            partial = "%s.partial%s" % os.path.splitext( path )
+            os.replace( path, partial )
+            bulk_file = open_bulk( path, "wb" )
+            with open_bulk( partial, "rb" ) as previous:
+                while length > 0:
+                    chunk = previous.read( min( length, 1024 * 1024 ) )
+                    if not chunk:
+                        raise ValueError( "%s is shorter than its journal says" % path )
+                    bulk_file.write( chunk )
+                    length -= len( chunk )
+            os.remove( partial )
+            self.bulk_files.append( bulk_file )
+        return self.bulk_files
+
+    def checkpoint( self, entities ):
+        """Record that the bulk lines of these entities have been written; on the same thread as the writes."""
+        for bulk_file in self.bulk_files:
+            bulk_file.flush()
+        self.lengths = [bulk_file.tell() for bulk_file in self.bulk_files]
+        self.write( {"entities": list( entities ), "lengths": self.lengths} )
+
+    def close( self ):
+        """Close the bulk files once they are complete."""
+        for bulk_file in self.bulk_files:
+            bulk_file.close()
+        self.write( {"complete": True} )
+        self.complete = True
+
+    def finish( self ):
+        """Record that the bulk files are published (or not to be published), so a resumed run leaves them alone."""
+        self.write( {"finished": True} )
+        self.finished = True
+
+    def remove( self ):
+        """Delete the journal once its run is done."""
+        self.journal.close()
+        os.remove( self.path )
+
+    def resumed( self, index=0 ):
+        """
+        :return:    a generator over the lines of bulk file `index` that were copied over from the resumed run by open(),
+                    e.g. to publish them along with the new ones
+        """
+        length = self.resumed_lengths[index]
+        if not length:
+            return
+        self.bulk_files[index].flush()
+        with open_bulk( self.bulk_paths[index], "rb" ) as bulk_file:
+            for line in bulk_file:
+                yield line.decode( "utf-8" )
+                length -= len( line )
+                if length <= 0:
+                    return
+
+
+def add_checkpoint_arguments( parser, resume=True ):
+    """Add the failure and checkpoint command line options to an argparse parser."""
+    parser.add_argument( '--retry-list', help='file the URIs of the entities whose documents could not be built are written to (default = OUT.failed)' )
+    if resume:
+        parser.add_argument( '--resume', default=False, action="store_true", help='continue the crashed or killed run of the journal OUT.journal instead of starting over' )
+
+
+def read_retry_list( path ):
+    """:return: the set of the URIs in a retry list, empty if there is none"""
+    if not path or not os.path.exists( path ):
+        return set()
+    with open( path ) as retry_file:
+        return set( line.strip() for line in retry_file if line.strip() )
+
+
+def retry_list( args, out ):
+    """:return: the retry list of a run, emptied unless the run resumes a previous one"""
+    path = args.retry_list or out + ".failed"
+    if not getattr( args, "resume", False ) and os.path.exists( path ):
+        os.remove( path )
+    return path
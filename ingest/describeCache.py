@@ -0,0 +1,81 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class DescribeCache:
+    """
+    Persistent cache of raw DESCRIBE/CONSTRUCT responses.
+    Entries are keyed by (endpoint, normalized query) and stored zlib-compressed in a single SQLite file, so that
+    every worker process of every ingest script can share it.  Entries older than `ttl` seconds are not served,
+    and once the stored size exceeds `max_bytes` the least recently used entries are evicted.
+    """
+
+    def __init__( self, path, ttl, max_bytes ):
+        directory = os.path.dirname( path )
+        if directory:
+            os.makedirs( directory, exist_ok=True )
+
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect( path, timeout=60, isolation_level=None, check_same_thread=False )
+        self.db.execute( "PRAGMA journal_mode=WAL" )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content_type TEXT, data BLOB, "
+                         "size INTEGER, created REAL, accessed REAL)" )
+        self.db.execute( "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)" )
+
+    @staticmethod
+    def key( endpoint, query ):
+        """
+        :param endpoint:    SPARQL endpoint
+        :param query:       the SPARQL query; runs of whitespace are collapsed so formatting does not matter
+        :return:            the cache key
+        """
+        normalized = " ".join( query.split() )
+        return hashlib.sha1( (endpoint + "\n" + normalized).encode( "utf-8" ) ).hexdigest()
+
+    def get( self, endpoint, query ):
+        """
+        :return:    the cached (bytes, content type) tuple, or None if there is no fresh entry
+        """
+        key = self.key( endpoint, query )
+        now = time.time()
+        with self.lock:
+            row = self.db.execute( "SELECT content_type, data, created FROM responses WHERE key = ?", (key,) ).fetchone()
+            if row is None or now - row[2] > self.ttl:
+                self.misses += 1
+                return None
+            self.db.execute( "UPDATE responses SET accessed = ? WHERE key = ?", (now, key) )
+            self.hits += 1
+        return zlib.decompress( row[1] ), row[0]
+
+    def put( self, endpoint, query, data, content_type ):
+        """Store a response and evict least recently used entries if the cache has grown past its size cap."""
+        compressed = zlib.compress( data )
+        now = time.time()
+        with self.lock:
+            self.db.execute( "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                             (self.key( endpoint, query ), content_type, compressed, len( compressed ), now, now) )
+            self.evict()
+
+    def evict( self ):
+        total = self.db.execute( "SELECT COALESCE(SUM(size), 0) FROM responses" ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # drop expired entries first, then the least recently used ones until the cache is back under its cap
+        self.db.execute( "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,) )
+        total = self.db.execute( "SELECT COALESCE(SUM(size), 0) FROM responses" ).fetchone()[0]
+        stale = []
+        for key, size in self.db.execute( "SELECT key, size FROM responses ORDER BY accessed" ):
+            if total <= self.max_bytes:
+                break
+            stale.append( (key,) )
+            total -= size
+        self.db.executemany( "DELETE FROM responses WHERE key = ?", stale )
@@ -0,0 +1,218 @@
+import collections
+import json
+import os
+import re
+from itertools import chain
+
+from rdflib import RDF, RDFS, URIRef
+
+from graphView import Node
+from ingestHelpers import bind_values
+from sparqlClient import get_client
+
+# whether the describe queries are replaced by the CONSTRUCT queries of the recorded profiles; set them (see
+# configure_slim) before worker pools are forked
+settings = {"slim": False, "profiles": "profiles"}
+
+# the profile of each document type and the queries derived from them, see slim_describe
+_profiles = {}
+_queries = {}
+
+# predicate of a profile that stands for every predicate of the resource
+ANY = "*"
+
+
+class RecordedProperties( dict ):
+    """The properties of a Node that tell a DescribeProfile which predicates the builder reads, see watch()."""
+
+    def __init__( self, profile, node, properties ):
+        dict.__init__( self, properties )
+        self.profile = profile
+        self.node = node
+
+    def get( self, predicate, default=None ):
+        self.profile.read( self.node, predicate, dict.get( self, predicate, () ) )
+        return dict.get( self, predicate, default )
+
+    def __getitem__( self, predicate ):
+        self.profile.read( self.node, predicate, dict.get( self, predicate, () ) )
+        return dict.__getitem__( self, predicate )
+
+    def values( self ):
+        self.profile.read( self.node, None, chain.from_iterable( dict.values( self ) ) )
+        return dict.values( self )
+
+    def items( self ):
+        self.profile.read( self.node, None, chain.from_iterable( dict.values( self ) ) )
+        return dict.items( self )
+
+
+class DescribeProfile:
+    """
+    Which predicates of which resources a document builder actually reads, recorded over a sample of entities.
+    The resources are told apart by the variable of the describe query they are bound to (e.g. ?vcard or ?org of
+    describePerson.rq), so the profile turns into a CONSTRUCT query (see construct_query) that keeps the WHERE clause
+    of the describe query, and so its filters, but returns only the recorded predicates of each variable instead of
+    every triple of every resource.  The label and types of every resource the builder reaches are always kept.
+    Reads of resources that no variable selects (e.g. blank nodes, which DESCRIBE follows) cannot be expressed this
+    way and are counted as unprofiled.
+    """
+
+    def __init__( self, query, variable ):
+        """
+        :param query:       the DESCRIBE query, e.g. the content of queries/describePerson.rq
+        :param variable:    the subject variable, e.g. "?person"
+        """
+        match = re.search( r'DESCRIBE\s+(.*?)\s*WHERE\s*\{', query, flags=re.IGNORECASE | re.DOTALL )
+        self.variable = variable
+        self.described = re.findall( r'[?$]\w+', match.group( 1 ) )
+        self.select = query[:match.start()] + "SELECT DISTINCT " + " ".join( self.described ) + " WHERE {" + \
+                      query[match.end():]
+        self.predicates = {v: set() for v in self.described}
+        self.reached = set()
+        self.unprofiled = collections.Counter()
+        self.entities = 0
+        self.reads = {}
+        self.reached_nodes = set()
+
+    def watch( self, view, entity ):
+        """Record the reads of the builder from the described graph of an entity; then call assign()."""
+        self.reads = {}
+        self.reached_nodes = {view.resource( entity )}
+        for node in list( view.nodes.values() ):
+            node.properties = RecordedProperties( self, node, node.properties )
+
+    def read( self, node, predicate, objects ):
+        self.reads.setdefault( node, set() ).add( predicate )
+        self.reached_nodes.add( node )
+        self.reached_nodes.update( o for o in objects if isinstance( o, Node ) )
+
+    def assign( self, endpoint, entity ):
+        """Attribute the reads recorded by watch() to the variables the resources of the entity are bound to."""
+        bound = collections.defaultdict( set )
+        for row in get_client( endpoint ).select( bind_values( self.select, self.variable, [entity] ) ):
+            for v in self.described:
+                if v[1:] in row and row[v[1:]]["type"] == "uri":
+                    bound[URIRef( row[v[1:]]["value"] )].add( v )
+
+        for node, predicates in self.reads.items():
+            variables = bound.get( node.identifier )
+            if variables:
+                for v in variables:
+                    self.predicates[v].update( predicates )
+            elif dict.__len__( node.properties ):
+                self.unprofiled.update( ANY if p is None else str( p ) for p in predicates )
+        for node in self.reached_nodes:
+            self.reached.update( bound.get( node.identifier, () ) )
+        self.entities += 1
+
+    def variables( self ):
+        """:return: {variable: [predicate URI or "*", ...]} of the variables the builder reads, for construct_query"""
+        variables = {}
+        for v in self.described:
+            predicates = self.predicates[v]
+            if v in self.reached:
+                predicates = predicates | {RDFS.label, RDF.type}
+            if None in predicates:
+                variables[v] = [ANY]
+            elif predicates:
+                variables[v] = sorted( str( p ) for p in predicates )
+        return variables
+
+    def save( self, path ):
+        directory = os.path.dirname( path )
+        if directory:
+            os.makedirs( directory, exist_ok=True )
+        with open( path, "w" ) as profile_file:
+            json.dump( {"entities": self.entities, "variables": self.variables(),
+                        "unprofiled": dict( self.unprofiled )}, profile_file, indent=2, sort_keys=True )
+            profile_file.write( "\n" )
+
+
+def construct_query( query, variables ):
+    """
+    :param query:       a DESCRIBE query, e.g. the content of queries/describePerson.rq
+    :param variables:   {variable: [predicate URI or "*", ...]}, see DescribeProfile.variables
+    :return:            a CONSTRUCT query with the same WHERE clause that returns only the given predicates of the
+                        resources bound to each variable; its first WHERE is the one of the describe query, so
+                        bind_values and the replacement of the subject variable work on it as on the describe query
+    """
+    match = re.search( r'DESCRIBE\s+(.*?)\s*WHERE\s*\{', query, flags=re.IGNORECASE | re.DOTALL )
+    prologue, body = query[:match.start()], query[match.end():query.rindex( "}" )]
+    described = [v for v in re.findall( r'[?$]\w+', match.group( 1 ) ) if variables.get( v )]
+    if not described:
+        return query
+
+    # one row per (subject, described resource) as in fingerprint_query, joined with the predicates of its variable
+    node = "".join( "IF( ?i = %d, %s, " % (i, v) for i, v in enumerate( described ) ) + "?unbound" + ")" * len( described )
+    pairs = " ".join( "(%d %s)" % (i, "UNDEF" if p == ANY else "<" + p + ">")
+                      for i, v in enumerate( described ) for p in variables[v] )
+    return prologue + """CONSTRUCT { ?node ?p ?o }
+{
+  { SELECT DISTINCT ?i ?node
+    WHERE {""" + body + """
+      VALUES ?i { """ + " ".join( str( i ) for i in range( len( described ) ) ) + """ }
+      BIND( """ + node + """ AS ?node )
+      FILTER( BOUND( ?node ) )
+    }
+  }
+  VALUES (?i ?p) { """ + pairs + """ }
+  ?node ?p ?o
+}
+"""
+
+
+def profile_path( name ):
+    """:return: the profile file of a document type, e.g. profiles/person.json"""
+    return os.path.join( settings["profiles"], name + ".json" )
+
+
+def load_profile( name ):
+    """:return: the recorded {variable: [predicate URI or "*", ...]} of a document type, or None if it has none"""
+    if name not in _profiles:
+        _profiles[name] = None
+        if os.path.exists( profile_path( name ) ):
+            with open( profile_path( name ) ) as profile_file:
+                _profiles[name] = json.load( profile_file )["variables"]
+        else:
+            print( "no describe profile", profile_path( name ), "- using the describe query" )
+    return _profiles[name]
+
+
+def merge_profiles( profiles ):
+    """:return: the profile that reads what any of the given profiles reads, for one description shared by types"""
+    merged = {}
+    for profile in profiles:
+        for variable, predicates in profile.items():
+            merged.setdefault( variable, set() ).update( predicates )
+    return {v: [ANY] if ANY in predicates else sorted( predicates ) for v, predicates in merged.items()}
+
+
+def slim_describe( query, name ):
+    """
+    :param query:   the describe query of a document type, after trim_describe
+    :param name:    the document type, e.g. "person", or a tuple of the types built from the same description, e.g.
+                    ("project", "field-study"), whose profiles are merged
+    :return:        the CONSTRUCT query of the recorded profile of the type if the run uses them (--slim) and the
+                    type has one, otherwise the describe query
+    """
+    if not settings["slim"]:
+        return query
+    slim = _queries.get( (query, name) )
+    if slim is None:
+        profiles = [load_profile( n ) for n in (name if isinstance( name, tuple ) else (name,))]
+        profile = merge_profiles( profiles ) if all( profiles ) else None
+        slim = _queries[(query, name)] = construct_query( query, profile ) if profile else query
+    return slim
+
+
+def add_slim_arguments( parser ):
+    """Add the describe profile command line options to an argparse parser."""
+    parser.add_argument( '--slim', default=False, action="store_true", help='describe with the CONSTRUCT queries derived from the profiles recorded by profile-describe.py instead of the DESCRIBE queries' )
+    parser.add_argument( '--profiles', default=settings["profiles"], help='directory of the describe profiles (default = %(default)s)' )
+
+
+def configure_slim( args ):
+    """Apply the options added by add_slim_arguments; before worker pools are forked."""
+    settings["slim"] = args.slim
+    settings["profiles"] = args.profiles
@@ -0,0 +1,236 @@
+import json
+import os
+import re
+
+from rdflib import Literal
+
+import ingestHelpers
+from graphView import Node
+from memoCache import memo
+from propertyPath import PropertyPath, PREFIXES, exec_source
+
+# compiled paths and sub-document extractors, shared by all the specs loaded in a process
+_paths = {}
+_extractors = {}
+
+
+class DocumentSpec:
+    """
+    The fields of the search documents of a type, declared in specs/<type>.json next to mappings/<type>.json and
+    compiled into one extractor function from a GraphView node to the document, e.g.
+
+        {"extends": "project.json",
+         "fields": [{"name": "fieldSites", "path": "dco:hasPhysicalLocation[a dco:PhysicalLocation]", "many": true,
+                     "value": {"fields": [...]}, "before": "thumbnail"}]}
+
+    A field takes the values of a property path (see propertyPath.py), or of the node itself if it has no "path", or
+    a list of paths whose values are concatenated.  Its "value" is one of
+        "literal"   the Python value of a literal, the URI of a resource (default)
+        "text"      the string of a value, optionally cut to "slice": [start, end] or to the first match of "pattern"
+        "uri"       the URI of a resource
+        "label"     the label of a resource
+        "resource"  {"uri": ..., "name": <label>} of a labelled resource
+        {"fields": [...]}  a sub-document built from a resource with fields of its own
+    and the other options are
+        "many"      a list of all the values, instead of the first one; or a string if "join" gives a separator
+        "required"  no document is built without the field
+        "default"   the value of a missing field, which is left out otherwise (empty lists are kept)
+        "omitEmpty" leave an empty list out
+        "warn"      a message printed with the URI when a required field is missing or a value is unusable
+        "function"  the name of a function of ingestHelpers that computes the field from the node instead
+        "memo"      build the sub-documents of a resource once per worker, in the named memo of the type (see
+                    memoCache.py), e.g. "participants" of specs/project.json is the memo "project participants"
+    {"group": [fields]} adds its fields only if they all have a value.  A spec may extend another one: its fields
+    replace the fields of the same name, are inserted "before" the named field, or appended.
+    """
+
+    def __init__( self, path ):
+        """
+        :param path:    the spec file, e.g. specs/project.json
+        """
+        self.path = path
+        self.fields = load_fields( path )
+        self.extract = compile_fields( self.fields, path )
+
+    def build( self, node ):
+        """:return: the document of a GraphView node, or {} if a required field is missing"""
+        return self.extract( node )
+
+    def __repr__( self ):
+        return "DocumentSpec(%r)" % self.path
+
+
+def load_fields( path ):
+    """:return: the fields of a spec file, merged with the fields of the specs it extends"""
+    with open( path ) as spec_file:
+        spec = json.load( spec_file )
+    if "extends" not in spec:
+        return spec["fields"]
+
+    fields = load_fields( os.path.join( os.path.dirname( path ), spec["extends"] ) )
+    for field in spec["fields"]:
+        names = [f.get( "name" ) for f in fields]
+        if field.get( "name" ) in names:
+            fields[names.index( field["name"] )] = field
+        elif field.get( "before" ) in names:
+            fields.insert( names.index( field["before"] ), field )
+        else:
+            fields.append( field )
+    return fields
+
+
+def get_path( expression ):
+    path = _paths.get( expression )
+    if path is None:
+        path = _paths[expression] = PropertyPath( expression, PREFIXES )
+    return path
+
+
+def literal( v ):
+    if isinstance( v, Literal ):
+        return v.toPython()
+    if isinstance( v, Node ):
+        return str( v.identifier )
+    return v
+
+
+def first_match( pattern, text ):
+    match = pattern.search( text )
+    return match.group( 0 ) if match else text
+
+
+def compile_fields( fields, name="" ):
+    """
+    Compile the fields of a (sub-)document into an extractor function; identical field lists share one function.
+    :param name:    the spec (and field) the fields come from, which names the generated source in tracebacks
+    :return:        a function from a GraphView node to the document, {} if a required field is missing
+    """
+    key = json.dumps( fields, sort_keys=True )
+    extractor = _extractors.get( key )
+    if extractor is None:
+        extractor = _extractors[key] = _Compiler( name ).compile( fields )
+    return extractor
+
+
+class _Compiler:
+    """Generates the source of one extractor function, which assigns the fields in order into a single dict."""
+
+    def __init__( self, name ):
+        self.name = name
+        # the memos are per type: each type's describe query (or slim profile) fetches different properties
+        self.type = os.path.splitext( os.path.basename( name.split()[0] ) )[0] if name else ""
+        self.constants = {"Node": Node, "literal": literal, "first_match": first_match}
+        self.lines = []
+        self.locals = 0
+
+    def constant( self, value ):
+        for name, known in self.constants.items():
+            if known is value:
+                return name
+        name = "c%d" % len( self.constants )
+        self.constants[name] = value
+        return name
+
+    def local( self ):
+        self.locals += 1
+        return "x%d" % self.locals
+
+    def emit( self, indent, line ):
+        self.lines.append( "    " * indent + line )
+
+    def compile( self, fields ):
+        self.emit( 0, "def extract( node ):" )
+        self.emit( 1, "doc = {}" )
+        for field in fields:
+            if "group" in field:
+                results = [(member, self.field( member )) for member in field["group"]]
+                self.emit( 1, "if " + " and ".join( x for _, x in results ) + ":" )
+                for member, x in results:
+                    self.emit( 2, "doc[%r] = %s" % (member["name"], x) )
+            else:
+                self.assign( field, self.field( field ) )
+        self.emit( 1, "return doc" )
+
+        exec_source( "\n".join( self.lines ), "<documentSpec %s>" % self.name, self.constants )
+        return self.constants["extract"]
+
+    def convert( self, field, v ):
+        """:return: the expression of the value of `v`, None if it has none"""
+        value = field.get( "value", "literal" )
+        if isinstance( value, dict ):
+            extractor = self.constant( compile_fields( value["fields"], "%s %s" % (self.name, field.get( "name" )) ) )
+            if "memo" in field:
+                return "(%s.get( %s.identifier, %s, %s ) or None) if isinstance( %s, Node ) else None" % (
+                    self.constant( memo( "%s %s" % (self.type, field["memo"]) ) ), v, extractor, v, v)
+            return "(%s( %s ) or None) if isinstance( %s, Node ) else None" % (extractor, v, v)
+        if value == "uri":
+            return "str( %s.identifier ) if isinstance( %s, Node ) else None" % (v, v)
+        if value == "label":
+            return "str( %s.label_value ) if isinstance( %s, Node ) and %s.label_value else None" % (v, v, v)
+        if value == "resource":
+            return '{"uri": str( %s.identifier ), "name": str( %s.label_value )} ' \
+                   'if isinstance( %s, Node ) and %s.label_value else None' % (v, v, v, v)
+        if value == "literal":
+            return "literal( %s )" % v
+        if value == "text":
+            text = "str( %s )" % v
+            if "slice" in field:
+                text += "[%d:%d]" % tuple( field["slice"] )
+            if "pattern" in field:
+                text = "first_match( %s, %s )" % (self.constant( re.compile( field["pattern"] ) ), text)
+            return text
+        raise ValueError( "invalid value of field %s: %r" % (field.get( "name" ), value) )
+
+    def field( self, field ):
+        """Emit the computation of a field into a local variable. :return: the name of the variable"""
+        x = self.local()
+        if "function" in field:
+            self.emit( 1, "%s = %s( node )" % (x, self.constant( getattr( ingestHelpers, field["function"] ) )) )
+            return x
+
+        paths = field.get( "path" )
+        paths = [paths] if isinstance( paths, str ) else paths
+
+        if field.get( "many" ):
+            self.emit( 1, "%s = []" % x )
+            for path in paths or [None]:
+                if path is None:
+                    self.emit( 1, "for v in (node,):" )
+                else:
+                    self.emit( 1, "for v in %s.all( node ):" % self.constant( get_path( path ) ) )
+                self.emit( 2, "value = " + self.convert( field, "v" ) )
+                self.emit( 2, "if value:" )
+                self.emit( 3, "%s.append( value )" % x )
+            if "join" in field:
+                self.emit( 1, "%s = %r.join( %s )" % (x, field["join"], x) )
+            return x
+
+        if paths is None:
+            self.emit( 1, "v = node" )
+        else:
+            self.emit( 1, "v = " + " or ".join( "%s.first( node )" % self.constant( get_path( p ) ) for p in paths ) )
+        self.emit( 1, "%s = (%s) if v is not None else None" % (x, self.convert( field, "v" )) )
+        if field.get( "warn" ) and not field.get( "required" ):
+            self.emit( 1, "if v is not None and not %s:" % x )
+            self.emit( 2, "print( %r, str( v ) )" % field["warn"] )
+        return x
+
+    def assign( self, field, x ):
+        name = field["name"]
+        if field.get( "required" ):
+            self.emit( 1, "if not %s:" % x )
+            if field.get( "warn" ):
+                self.emit( 2, "print( %r, str( node ) )" % field["warn"] )
+            self.emit( 2, "return {}" )
+            self.emit( 1, "doc[%r] = %s" % (name, x) )
+        elif field.get( "many" ) or "function" in field:
+            if field.get( "omitEmpty" ):
+                self.emit( 1, "if %s:" % x )
+                self.emit( 2, "doc[%r] = %s" % (name, x) )
+            else:
+                self.emit( 1, "doc[%r] = %s" % (name, x) )
+        elif "default" in field:
+            self.emit( 1, "doc[%r] = %s if %s else %r" % (name, x, x, field["default"]) )
+        else:
+            self.emit( 1, "if %s:" % x )
+            self.emit( 2, "doc[%r] = %s" % (name, x) )
@@ -0,0 +1,194 @@
+import contextlib
+import json
+import time
+
+import requests
+
+from bulkPublisher import BulkPublisher
+
+
+def check( r ):
+    """Helper function to print and raise the error of a failed elasticsearch request."""
+    if r.status_code != requests.codes.ok:
+        print( r.url, r.status_code, r.text )
+        r.raise_for_status()
+    return r
+
+
+def get_settings( es, index ):
+    """
+    :return:    the settings of an index (or of the indices behind an alias), e.g.
+                    {"dco": {"settings": {"index": {"refresh_interval": "1s", "number_of_replicas": "1", ...}}}}
+    """
+    return check( requests.get( es + "/" + index + "/_settings" ) ).json()
+
+
+def put_settings( es, index, settings ):
+    """
+    :param settings:    dynamic index settings, e.g. {"refresh_interval": "-1", "number_of_replicas": 0}
+    """
+    check( requests.put( es + "/" + index + "/_settings", data=json.dumps( {"index": settings} ) ) )
+
+
+def refresh( es, index ):
+    check( requests.post( es + "/" + index + "/_refresh" ) )
+
+
+def optimize( es, index, max_num_segments=1 ):
+    """Merge the segments of an index (the _optimize API, called force merge in later elasticsearch versions)."""
+    check( requests.post( es + "/" + index + "/_optimize", params={"max_num_segments": max_num_segments} ) )
+
+
+@contextlib.contextmanager
+def fast_load( es, index ):
+    """
+    Context manager for bulk loading into an existing index: refresh is disabled and replicas are dropped for the
+    duration of the load, then the saved settings are restored and the index is refreshed once, also if the load
+    fails.
+    :param es:          elasticsearch service URL
+    :param index:       the index (or alias) being loaded
+    """
+    saved = {}
+    for name, settings in get_settings( es, index ).items():
+        settings = settings["settings"]["index"]
+        saved[name] = {"refresh_interval": settings.get( "refresh_interval", "1s" ),
+                       "number_of_replicas": settings.get( "number_of_replicas", "1" )}
+
+    put_settings( es, index, {"refresh_interval": "-1", "number_of_replicas": 0} )
+    try:
+        yield
+    finally:
+        for name, settings in saved.items():
+            put_settings( es, name, settings )
+        refresh( es, index )
+
+
+def get_indices( es, pattern ):
+    """
+    :param pattern:     index name pattern, e.g. "dco-dataset-*"
+    :return:            the names of the matching indices, oldest (by timestamp suffix) first
+    """
+    r = requests.get( es + "/" + pattern + "/_settings" )
+    if r.status_code == requests.codes.not_found:
+        return []
+    return sorted( check( r ).json() )
+
+
+def is_index( es, name ):
+    """:return: True if `name` is a concrete index, False if it is an alias or does not exist"""
+    r = requests.get( es + "/" + name + "/_settings" )
+    return r.status_code == requests.codes.ok and list( r.json() ) == [name]
+
+
+def is_alias( es, name ):
+    """:return: True if `name` is an alias, e.g. "dco" once types are published blue/green"""
+    r = requests.get( es + "/" + name + "/_settings" )
+    return r.status_code == requests.codes.ok and name not in r.json()
+
+
+def check_not_alias( es, index ):
+    """
+    Refuse to publish into `index` directly if it is an alias: once types are published blue/green, "dco" is an alias
+    of several indices, which elasticsearch does not index into, and which a rebuild would delete with all of them.
+    """
+    if is_alias( es, index ):
+        raise RuntimeError( "'" + index + "' is an alias of blue/green indices; publish with --blue-green" )
+
+
+def get_aliases( es, index ):
+    """:return: the names of the aliases of an index"""
+    r = requests.get( es + "/" + index + "/_alias" )
+    if r.status_code == requests.codes.not_found:
+        return []
+    return list( check( r ).json().get( index, {} ).get( "aliases", {} ) )
+
+
+def retarget( actions, index ):
+    """
+    Rewrite the _index of bulk actions.
+    :param actions:     iterable of bulk actions
+    :param index:       the index the actions should go to
+    :return:            a generator over the rewritten actions
+    """
+    for action in actions:
+        meta, newline, source = action.partition( '\n' )
+        meta = json.loads( meta )
+        for op in meta.values():
+            op["_index"] = index
+        yield json.dumps( meta ) + newline + source
+
+
+def publish_blue_green( es, alias, es_type, mapping, actions, keep=1, **publisher_options ):
+    """
+    Publish a complete set of documents of one type into a fresh index and atomically move the alias to it.
+    The new index, "<alias>-<type>-<timestamp>", is created with the type mapping, refresh disabled and no replicas,
+    bulk-loaded, switched back to the refresh interval and replica count of the index it replaces, refreshed and
+    warmed.  Only then is the previous index of the type swapped out of the alias, so searches through the alias never
+    see a partial or empty type: if any document failed, the new index is deleted, the alias is left unchanged and an
+    error is raised; if no document was generated at all, e.g. for a type without entities, the new index is deleted
+    and the alias left unchanged too, with a message.  All but the `keep` most recent previous indices of the type are
+    deleted.
+    Note:   `alias` must not be a concrete index; an old single "dco" index has to be deleted once before the first
+            blue/green run, after which every type has to be published this way: the ingest scripts refuse to publish
+            into the alias directly (see check_not_alias).
+    :param es:          elasticsearch service URL
+    :param alias:       the alias searched by the browsers, e.g. "dco"
+    :param es_type:     the document type, e.g. "dataset"
+    :param mapping:     the mapping file of the type, e.g. mappings/dataset.json
+    :param actions:     iterable of bulk actions with all documents of the type
+    :param keep:        number of previous indices to keep for rollback
+    :return:            the BulkPublisher, for its counters
+    """
+    if is_index( es, alias ):
+        raise RuntimeError( "'" + alias + "' is an index, not an alias; delete it once before publishing blue/green" )
+
+    prefix = alias + "-" + es_type + "-"
+    previous = get_indices( es, prefix + "*" )
+    index = prefix + time.strftime( "%Y%m%d%H%M%S" )
+
+    # the settings the new index gets after the load; those of the index it replaces, or the elasticsearch defaults
+    replicas, refresh_interval = "1", "1s"
+    if previous:
+        settings = get_settings( es, previous[-1] )[previous[-1]]["settings"]["index"]
+        replicas = settings.get( "number_of_replicas", replicas )
+        refresh_interval = settings.get( "refresh_interval", refresh_interval )
+
+    with open( mapping ) as mapping_file:
+        body = {"settings": {"refresh_interval": "-1", "number_of_replicas": 0}, "mappings": json.load( mapping_file )}
+    check( requests.put( es + "/" + index, data=json.dumps( body ) ) )
+
+    publisher = BulkPublisher( es, **publisher_options )
+    try:
+        publisher.publish( retarget( actions, index ) )
+    except Exception:
+        requests.delete( es + "/" + index )
+        raise
+    publisher.report()
+
+    if publisher.failed:
+        requests.delete( es + "/" + index )
+        raise RuntimeError( "%d documents failed to be indexed into %s; alias '%s' left unchanged" % (
+            publisher.failed, index, alias) )
+    if publisher.indexed == 0:
+        requests.delete( es + "/" + index )
+        print( "no documents to index into", index + "; alias", alias, "left unchanged" )
+        return publisher
+
+    # warm up: restore refresh and replicas, make every document searchable and wait for the shards
+    put_settings( es, index, {"refresh_interval": refresh_interval, "number_of_replicas": replicas} )
+    refresh( es, index )
+    requests.get( es + "/_cluster/health/" + index, params={"wait_for_status": "yellow", "timeout": "60s"} )
+    requests.get( es + "/" + index + "/_search", params={"size": 0} )
+
+    # atomically point the alias at the new index instead of the previous ones of this type
+    swap = [{"remove": {"index": old, "alias": alias}} for old in previous if alias in get_aliases( es, old )]
+    swap.append( {"add": {"index": index, "alias": alias}} )
+    check( requests.post( es + "/_aliases", data=json.dumps( {"actions": swap} ) ) )
+    print( "alias", alias, "->", index )
+
+    # retire old indices of this type
+    for old in previous[:max( len( previous ) - keep, 0 )]:
+        check( requests.delete( es + "/" + old ) )
+        print( "deleted", old )
+
+    return publisher
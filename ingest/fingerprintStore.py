@@ -0,0 +1,40 @@
+import os
+import sqlite3
+import zlib
+
+
+class FingerprintStore:
+    """
+    What the previous runs built from the triple store, per entity: the fingerprint of its description (see
+    ingestHelpers.fingerprint_query) and the bulk action generated from it, or an empty action if the entity was
+    not indexed.  Entities whose fingerprint is unchanged do not have to be described and built again; their stored
+    action is replayed instead.  Kept zlib-compressed in a single SQLite file, like the describe cache.
+    """
+
+    def __init__( self, path ):
+        directory = os.path.dirname( path )
+        if directory:
+            os.makedirs( directory, exist_ok=True )
+
+        self.db = sqlite3.connect( path, timeout=60 )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS entities (uri TEXT PRIMARY KEY, fingerprint TEXT, action BLOB)" )
+
+    def fingerprints( self ):
+        """:return: the stored fingerprints, {uri: fingerprint}"""
+        return dict( self.db.execute( "SELECT uri, fingerprint FROM entities" ) )
+
+    def get( self, uri ):
+        """:return: the stored bulk action of an entity, "" if it was not indexed, or None if it is unknown"""
+        row = self.db.execute( "SELECT action FROM entities WHERE uri = ?", (uri,) ).fetchone()
+        return zlib.decompress( row[0] ).decode( "utf-8" ) if row is not None else None
+
+    def put( self, uri, fingerprint, action ):
+        self.db.execute( "INSERT OR REPLACE INTO entities VALUES (?, ?, ?)",
+                         (uri, fingerprint, zlib.compress( action.encode( "utf-8" ) )) )
+
+    def retain( self, uris ):
+        """Forget the entities that are not in `uris` any more and commit the changes of this run."""
+        uris = set( uris )
+        gone = [(uri,) for uri, in self.db.execute( "SELECT uri FROM entities" ) if uri not in uris]
+        self.db.executemany( "DELETE FROM entities WHERE uri = ?", gone )
+        self.db.commit()
@@ -0,0 +1,99 @@
+from itertools import chain
+
+from rdflib import RDF, RDFS, URIRef, BNode, Literal
+
+from referenceStore import get_store
+
+
+class GraphView:
+    """
+    Compact read-only view of a described graph for the document builders.
+    It is built in one pass over the triples: every resource (URI or blank node) is interned into a single Node that
+    maps each predicate to a tuple of objects, and the label and the set of types of every resource are resolved up
+    front.  The view and its nodes offer the part of the rdflib Graph/Resource API the builders use (resource,
+    objects, label, identifier, graph), so builders run unchanged without rdflib's triple-pattern matching.
+    """
+
+    def __init__( self, graph, references=() ):
+        """
+        :param graph:       an rdflib Graph, e.g. the result of a DESCRIBE query
+        :param references:  the predicates through which the describe query reaches the reference entities it leaves
+                            out with a reference store, see referenceStore.reference_predicates
+        """
+        self.nodes = {}
+        properties = {}
+        for s, p, o in graph:
+            objects = properties.setdefault( self.node( s ), {} ).setdefault( p, [] )
+            objects.append( o if isinstance( o, Literal ) else self.node( o ) )
+
+        for node, objects in properties.items():
+            node.set_properties( {p: tuple( values ) for p, values in objects.items()} )
+
+        # the reference entities left out of the description, see referenceStore.py
+        store = get_store()
+        if store is not None and references:
+            store.complete( self, references )
+
+    def node( self, identifier ):
+        node = self.nodes.get( identifier )
+        if node is None:
+            node = self.nodes[identifier] = Node( self, identifier )
+        return node
+
+    def resource( self, identifier ):
+        """:return: the Node of a resource (a URI string or term); an empty one if the graph does not describe it"""
+        if not isinstance( identifier, (URIRef, BNode) ):
+            identifier = URIRef( identifier )
+        return self.node( identifier )
+
+    def __len__( self ):
+        return sum( len( objects ) for node in self.nodes.values() for objects in node.properties.values() )
+
+
+class Node:
+    """A resource of a GraphView, standing in for an rdflib Resource."""
+
+    __slots__ = ("graph", "identifier", "properties", "label_value", "types")
+
+    def __init__( self, graph, identifier ):
+        self.graph = graph
+        self.identifier = identifier
+        self.properties = {}
+        self.label_value = ""
+        self.types = frozenset()
+
+    def set_properties( self, properties ):
+        """:param properties: {predicate: tuple of objects}, from which the label and the types are resolved"""
+        self.properties = properties
+        labels = properties.get( RDFS.label )
+        self.label_value = labels[0] if labels else ""
+        # the interned URIs of the types, so that a type check is a set lookup
+        self.types = frozenset( t.identifier for t in properties.get( RDF.type, () ) if isinstance( t, Node ) )
+
+    def objects( self, predicate=None ):
+        """:return: the tuple of objects of a predicate (all objects if None): Nodes, or Literals for literal values"""
+        if predicate is None:
+            return tuple( chain.from_iterable( self.properties.values() ) )
+        return self.properties.get( predicate, () )
+
+    def objects_of_type( self, predicate, type ):
+        """:return: the tuple of objects of a predicate that are resources of the given type, e.g. the Persons
+                    an authorship relates"""
+        return tuple( o for o in self.properties.get( predicate, () ) if isinstance( o, Node ) and type in o.types )
+
+    def has_type( self, type ):
+        """:return: True if the resource has the given rdf:type (a URIRef, e.g. FOAF.Person)"""
+        return type in self.types
+
+    def label( self ):
+        """:return: the rdfs:label of the resource, or "" if it has none, like rdflib's Resource.label"""
+        return self.label_value
+
+    def __lt__( self, other ):
+        return isinstance( other, Node ) and self.identifier < other.identifier
+
+    def __str__( self ):
+        return str( self.identifier )
+
+    def __repr__( self ):
+        return "Node(%s)" % self.identifier
@@ -0,0 +1,327 @@
+"""
+Runs the ingest of every document type at once, instead of one ingest script after the other (scripts/es-ingest.sh).
+The ingest-*.py scripts are loaded as modules: a script that subclasses Ingest is run through its class, the
+function-style scripts through their listing and processing functions (see SCRIPTS).  All types share one pool of
+--threads workers and one budget of --sparql-budget SPARQL requests in flight across every process, so a type with
+few entities does not hold workers the others could use, and the endpoint sees the same load however many types run.
+Each type streams its documents to its own gzipped bulk file, <out>/<timestamp>.<type>.bulk.gz, and is published as
+soon as it is complete, while the other types are still being built; a full refresh takes as long as its slowest type.
+
+    e.g. `python3 ingest-all.py --threads 8 --sparql-budget 8 --manifests manifests --out bulk --publish`
+"""
+
+import argparse
+import contextlib
+import functools
+import glob
+import gzip
+import importlib.util
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from Ingest import Ingest
+from adaptiveLimiter import add_adaptive_arguments, configure_adaptive
+from bulkPublisher import split_bulk
+from checkpointJournal import CheckpointJournal, Isolated, add_checkpoint_arguments, retry_list
+from describeProfile import add_slim_arguments, configure_slim
+from fingerprintStore import FingerprintStore
+from ingestHelpers import batches, bounded_imap
+from memoCache import add_memo_arguments, configure_memo
+from referenceStore import add_reference_arguments, configure_references
+from selectExtraction import add_select_arguments, configure_select, settings as select_settings
+from sparqlClient import add_sparql_arguments, configure_sparql, settings as sparql_settings
+
+# function-style scripts: type name (ingest-<name>.py): (elasticsearch type, listing function, processing function,
+# whether the processing function takes a batch of entities); the processing functions return the bulk lines
+SCRIPTS = {
+    "people": ("person", "get_people", "process_people", True),
+    "projects": ("project", "get_projects", "process_projects", True),
+    "publications": ("publication", "get_publications", "process_publications", True),
+    "field-studies": ("field-study", "get_projects", "process_projects", True),
+    "datatypes": ("datatype", "get_dataTypes", "process_dataTypes", True),
+    "sample-repositories": ("sample-repository", "get_sample_repositories", "process_sample_repositories", True),
+}
+
+# function-style scripts that build the documents of several types from one description of each entity, used when
+# all of the types are ingested: (types, processing function of the script of the first type, which takes a batch of
+# entities and returns the bulk lines of each of the types for each entity); the listing of the first type has to
+# include the entities of the others
+COMBINED = [
+    (("projects", "field-studies"), "process_projects_and_field_studies"),
+]
+
+# the jobs of the run by name, created before the pool is forked so that the workers find them, see process_task
+_jobs = {}
+
+
+def load_script( name ):
+    """:return: the module of ingest-<name>.py"""
+    spec = importlib.util.spec_from_file_location( "ingest_" + name.replace( "-", "_" ), "ingest-%s.py" % name )
+    module = importlib.util.module_from_spec( spec )
+    spec.loader.exec_module( module )
+    return module
+
+
+def process_task( name, entities ):
+    """Runs on the workers: :return: the bulk lines of a batch of entities of the job `name`"""
+    return _jobs[name].process( entities )
+
+
+class ScriptJob:
+    """The ingest of a function-style script, e.g. ingest-people.py."""
+
+    def __init__( self, name, module, args ):
+        es_type, listing, process, batched = SCRIPTS[name]
+        self.name = name
+        self.names = [name]
+        self.module = module
+        self.endpoint = args.sparql
+        self.mapping = "mappings/%s.json" % es_type
+        self.listing = getattr( module, listing )
+        self.batch_size = int( args.batch_size ) if batched else 1
+        if name == "publications" and select_settings["select"]:
+            # a page of publications per task, built from two SELECT result sets, see selectExtraction.py
+            process, batched, self.batch_size = "process_publication_page", True, select_settings["page_size"]
+        self.retry = job_retry_list( args, name )
+        self.function = Isolated( getattr( module, process ), self.retry, batched )
+        self.batched = batched
+
+    def process( self, entities ):
+        if self.batched:
+            return self.function( entities, self.endpoint )
+        return [line for entity in entities for line in self.function( entity, self.endpoint )]
+
+    def records( self, pool, window, journal ):
+        """
+        :param journal: the CheckpointJournal of the job, whose entities are skipped and which every batch is
+                        checkpointed to once its lines have been consumed
+        :return:        a generator over the (type, bulk line) of the documents
+        """
+        task = functools.partial( process_task, self.name )
+        entity_batches = batches( journal.pending( self.listing( self.endpoint ) ), self.batch_size )
+        for entities, lines in bounded_imap( pool, task, entity_batches, window, with_items=True ):
+            for line in lines:
+                yield self.name, line
+            journal.checkpoint( entities )
+
+    def publish( self, name, bulk_file, args ):
+        self.module.publish( bulk=bulk_file, endpoint=args.es, rebuild=False, mapping=self.mapping,
+                             blue_green=args.blue_green, keep=int( args.keep_indices ),
+                             manifest=manifest_path( args, self.name ), retry=self.retry )
+
+
+class IngestJob:
+    """The ingest of a script that subclasses Ingest, e.g. ingest-datasets.py."""
+
+    def __init__( self, name, ingest, args ):
+        self.name = name
+        self.names = [name]
+        self.ingest = ingest
+        ingest.threads = int( args.threads )
+        ingest.batch_size = int( args.batch_size )
+        ingest.endpoint = args.sparql
+        ingest.es = args.es
+        ingest.publish = args.publish
+        ingest.rebuild = False
+        ingest.blue_green = args.blue_green
+        ingest.keep_indices = int( args.keep_indices )
+        ingest.manifest = manifest_path( args, name )
+        ingest.mapping = ingest.get_mapping()
+        ingest.retry = job_retry_list( args, name )
+        self.fingerprints = os.path.join( args.fingerprints, name + ".sqlite" ) if args.fingerprints else None
+        # only the changed entities are described, and a cached description would be stale; set before the fork
+        ingest.refresh_cache = bool( self.fingerprints )
+
+    def process( self, entities ):
+        return self.ingest.process_batch( entities )
+
+    def generate( self, pool, window, entities=None ):
+        """Like Ingest.generate, on the shared pool."""
+        task = functools.partial( process_task, self.name )
+        entity_batches = batches( self.ingest.get_pending( entities ), self.ingest.batch_size )
+        for entities, actions in bounded_imap( pool, task, entity_batches, window, with_items=True ):
+            yield from actions
+            self.ingest.checkpoint( entities )
+
+    def records( self, pool, window, journal ):
+        self.ingest.journal = journal
+        if self.fingerprints:
+            generate = functools.partial( self.generate, pool, window )
+            actions = self.ingest.generate_changes( generate, FingerprintStore( self.fingerprints ) )
+        else:
+            actions = self.generate( pool, window )
+        for action in actions:
+            yield self.name, action
+
+    def publish( self, name, bulk_file, args ):
+        self.ingest.publish_to_es( split_bulk( bulk_file ) )
+
+
+class CombinedJob:
+    """The types of several function-style scripts built in one pass over the entities, see COMBINED."""
+
+    def __init__( self, jobs, process, args ):
+        self.jobs = jobs
+        self.names = [job.name for job in jobs]
+        self.name = "+".join( self.names )
+        # an entity that fails has no lines for any of the types, whose manifests then delete nothing
+        self.retry = job_retry_list( args, self.name )
+        self.function = Isolated( getattr( jobs[0].module, process ), self.retry, batched=True )
+        for job in jobs:
+            job.retry = self.retry
+
+    def process( self, entities ):
+        records = [[] for job in self.jobs]
+        for entity_records in self.function( entities, self.jobs[0].endpoint ):
+            for lines, entity_lines in zip( records, entity_records ):
+                lines.extend( entity_lines )
+        return records
+
+    def records( self, pool, window, journal ):
+        first = self.jobs[0]
+        task = functools.partial( process_task, self.name )
+        entity_batches = batches( journal.pending( first.listing( first.endpoint ) ), first.batch_size )
+        for entities, records in bounded_imap( pool, task, entity_batches, window, with_items=True ):
+            for name, lines in zip( self.names, records ):
+                for line in lines:
+                    yield name, line
+            journal.checkpoint( entities )
+
+    def publish( self, name, bulk_file, args ):
+        self.jobs[self.names.index( name )].publish( name, bulk_file, args )
+
+
+def manifest_path( args, name ):
+    return os.path.join( args.manifests, name + ".json.gz" ) if args.manifests else None
+
+
+def job_retry_list( args, name ):
+    """:return: the retry list of a job, <out>/<name>.failed unless --retry-list names one for all of them"""
+    return retry_list( args, os.path.join( args.out, name ) )
+
+
+def create_job( name, args ):
+    """:return: the job of ingest-<name>.py: an IngestJob if the script subclasses Ingest, else a ScriptJob"""
+    module = load_script( name )
+    for value in vars( module ).values():
+        if isinstance( value, type ) and issubclass( value, Ingest ) and value.__module__ == module.__name__:
+            return IngestJob( name, value(), args )
+    if name not in SCRIPTS:
+        raise ValueError( "ingest-%s.py neither subclasses Ingest nor is listed in SCRIPTS" % name )
+    return ScriptJob( name, module, args )
+
+
+def run_job( job, pool, window, args, paths, journals, failed ):
+    """
+    Build the documents of a job into the bulk files of its types, then publish them; runs on a thread per job.
+    The progress is journaled to <out>/<job>.journal, so that --resume continues the job where a crashed or killed
+    run left it, in the bulk files of that run (see checkpointJournal.CheckpointJournal).
+    :param paths:       {type: gzipped bulk file}
+    :param journals:    list the journal of the job is appended to, to be removed once every job is done
+    :param failed:      list the names of the types are appended to if the job fails
+    """
+    started = time.time()
+    try:
+        journal = CheckpointJournal( os.path.join( args.out, job.name + ".journal" ),
+                                     [paths[name] for name in job.names], resume=args.resume )
+        journals.append( journal )
+        if journal.finished:
+            return
+        paths = dict( zip( job.names, journal.bulk_paths ) )
+        if not journal.complete:
+            lines = dict.fromkeys( job.names, 0 )
+            bulk_files = dict( zip( job.names, journal.open() ) )
+            for name, record in job.records( pool, window, journal ):
+                bulk_files[name].write( (record + '\n').encode( "utf-8" ) )
+                lines[name] += record.count( '\n' ) + 1
+            journal.close()
+            for name in job.names:
+                print( "%s: %d bulk lines in %.1fs, %s" % (name, lines[name], time.time() - started, paths[name]) )
+
+        if args.publish:
+            for name in job.names:
+                published = time.time()
+                with gzip.open( paths[name], "rt" ) as bulk_file:
+                    job.publish( name, bulk_file, args )
+                print( "%s: published in %.1fs" % (name, time.time() - published) )
+        journal.finish()
+    except Exception as e:
+        print( "%s: failed after %.1fs: %r" % (job.name, time.time() - started, e) )
+        failed.extend( job.names )
+
+
+if __name__ == "__main__":
+    names = sorted( os.path.basename( path )[len( "ingest-" ):-len( ".py" )] for path in glob.glob( "ingest-*.py" ) )
+    names.remove( "all" )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'types', nargs='*', metavar='TYPE', help='types to ingest: %s (default = all)' % ", ".join( names ) )
+    parser.add_argument( '--threads', default=4, help='number of workers shared by all types (default = 4)' )
+    parser.add_argument( '--sparql-budget', type=int, help='number of SPARQL requests in flight across all workers and listings (default = --threads)' )
+    parser.add_argument( '--batch-size', default=50, help='number of entities per task, described with one SPARQL query (default = 50)' )
+    parser.add_argument( '--out', default=".", help='directory of the gzipped bulk files (default = .)' )
+    parser.add_argument( '--es', default="http://localhost:9200", help="elasticsearch service URL" )
+    parser.add_argument( '--publish', default=False, action="store_true", help="publish each type to elasticsearch as soon as it is built" )
+    parser.add_argument( '--blue-green', default=False, action="store_true", help="publish each type into a fresh index and swap the alias to it when complete" )
+    parser.add_argument( '--keep-indices', default=1, help="number of previous indices of each type to keep with --blue-green (default = 1)" )
+    parser.add_argument( '--manifests', help="directory of the hash manifests of the previously published documents, <type>.json.gz; only new, changed and deleted documents are published" )
+    parser.add_argument( '--fingerprints', help="directory of the fingerprint stores of the Ingest subclasses, <type>.sqlite; only changed and new entities are described and built" )
+    parser.add_argument( '--sparql', default='http://deepcarbon.tw.rpi.edu:3030/VIVO/query', help='sparql endpoint' )
+    add_sparql_arguments( parser )
+    add_adaptive_arguments( parser )
+    add_memo_arguments( parser )
+    add_reference_arguments( parser )
+    add_slim_arguments( parser )
+    add_select_arguments( parser )
+    add_checkpoint_arguments( parser )
+    args = parser.parse_args()
+
+    unknown = set( args.types ) - set( names )
+    if unknown:
+        parser.error( "unknown types: %s" % ", ".join( sorted( unknown ) ) )
+
+    configure_sparql( args )
+    configure_memo( args )
+    configure_slim( args )
+    configure_select( args )
+    configure_references( args, args.sparql )
+    threads = int( args.threads )
+    # with --adaptive the limiter takes the place of the fixed budget, which becomes its default ceiling
+    if not configure_adaptive( args, args.sparql_budget or threads ):
+        sparql_settings["budget"] = multiprocessing.BoundedSemaphore( args.sparql_budget or threads )
+
+    os.makedirs( args.out, exist_ok=True )
+    stamp = time.strftime( "%Y%m%d-%H-%M-%S" )
+    types = args.types or names
+    for name in types:
+        _jobs[name] = create_job( name, args )
+    for combined, process in COMBINED:
+        if all( name in _jobs for name in combined ):
+            job = CombinedJob( [_jobs.pop( name ) for name in combined], process, args )
+            _jobs[job.name] = job
+
+    started = time.time()
+    journals = []
+    failed = []
+    with multiprocessing.Pool( threads ) as pool:
+        # every type keeps at most two tasks per worker pending, so the types take turns on the workers
+        paths = {name: os.path.join( args.out, "%s.%s.bulk.gz" % (stamp, name) ) for name in types}
+        runs = [threading.Thread( target=run_job, args=(job, pool, 2 * threads, args, paths, journals, failed) )
+                for job in _jobs.values()]
+        for run in runs:
+            run.start()
+        for run in runs:
+            run.join()
+        # let the workers exit on their own, so they report their memo statistics
+        pool.close()
+        pool.join()
+
+    print( "ingest of %d types done in %.1fs" % (len( types ), time.time() - started) )
+    if failed:
+        print( "failed types:", ", ".join( failed ) )
+        sys.exit( 1 )
+    for journal in journals:
+        journal.remove()
@@ -22,10 +22,13 @@ SUBJECT_NAME = "?dataset"
 INDEX = "dco"
 TYPE = "dataset"
 MAPPING = "mappings/dataset.json"
+SPEC = "specs/dataset.json"
+REFERENCE_VARIABLES = ["?mostSpecificType", "?community", "?team", "?researchArea", "?org"]
 
 # Second, extend the Ingest base class to class 'XIngest' below, where X is the singular form, with capitalized
 # initial letter, of the 'type' of search document generated. E.g. DatasetIngest, ProjectIngest, etc.
-# Overwrite the subclass attribute 'MAPPING' and the create_x_doc method with appropriate implementations.
+# Overwrite the subclass attributes 'MAPPING' and 'SPEC' with appropriate values, and declare the fields of the
+# documents in the SPEC file (see documentSpec.py), or override create_document for a hand-written builder.
 # (Existing examples are helpful.)
 
 class DatasetIngest(Ingest):
@@ -49,78 +52,11 @@ class DatasetIngest(Ingest):
     def get_type(self):
         return TYPE
 
-    def create_document( self, entity ):
-        graph = self.describe_entity( entity )
+    def get_spec_file(self):
+        return SPEC
 
-        ds = graph.resource( entity )
-
-        try:
-            title = ds.label().toPython()
-        except AttributeError:
-            print( "missing title:", entity )
-            return {}
-
-        dco_id = list(ds.objects(DCO.hasDcoId))
-        dco_id = str(dco_id[0].label().toPython()) if dco_id else None
-
-        doc = {"uri": entity, "title": title, "dcoId": dco_id}
-
-        most_specific_type = list(ds.objects(VITRO.mostSpecificType))
-        most_specific_type = most_specific_type[0].label().toPython() \
-            if most_specific_type and most_specific_type[0].label() \
-            else None
-        if most_specific_type:
-            doc.update({"mostSpecificType": most_specific_type})
-
-        doi = list(ds.objects(BIBO.doi))
-        doi = doi[0].toPython() if doi else None
-        if doi:
-            doc.update({"doi": doi})
-
-        abstract = list(ds.objects(BIBO.abstract))
-        abstract = abstract[0].toPython() if abstract else None
-        if abstract:
-            doc.update({"abstract": abstract})
-
-        publication_year = list(ds.objects(DCT.issued))
-        publication_year = publication_year[0] if publication_year else None
-        if publication_year:
-            doc.update({"publicationYear": str(publication_year)[0:4]})
-
-
-        dco_communities = get_dco_communities(ds)
-        if dco_communities:
-            doc.update({"dcoCommunities": dco_communities})
-
-        # teams
-        teams = get_teams(ds)
-        if teams:
-            doc.update({"teams": teams})
-
-        # projects
-        projects = get_projects_of_dataset(ds)
-        if projects:
-            doc.update({"projects": projects})
-
-        # dataType
-        data_types = get_data_types(ds)
-        if data_types:
-            doc.update({"dataTypes": data_types})
-
-        # dataset wasQuotedFrom
-        wasQuotedFrom = get_wasQuotedFrom(ds)
-        if wasQuotedFrom:
-            doc.update({"wasQuotedFrom": wasQuotedFrom})
-
-        # authors: if none, will return an empty list []
-        creators = get_creators(ds)
-        doc.update({"creators": creators})
-
-        # distributions: if none, will return an empty list []
-        distributions = get_distributions(ds)
-        doc.update({"distributions": distributions})
-
-        return doc
+    def get_reference_variables(self):
+        return REFERENCE_VARIABLES
 
 
 # Third, pass the name of the sub-class just created above to argument 'XIngest=' below in the usage of main().
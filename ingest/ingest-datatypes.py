@@ -1,11 +1,22 @@
 __author__ = 'szednik'
 #Edited by Ahmed (am-e) to ingest dataTypes
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+from sparqlClient import get_client, add_sparql_arguments, configure_sparql
+from adaptiveLimiter import add_adaptive_arguments, configure_adaptive
+from ingestHelpers import batches, bind_values, iter_entities, bounded_imap, write_bulk_lines
+from bulkPublisher import BulkPublisher, split_bulk
+from bulkDiff import BulkDiff
+from graphView import GraphView, Node
+from documentSpec import DocumentSpec
+from describeProfile import add_slim_arguments, configure_slim, slim_describe
+from checkpointJournal import Isolated, add_checkpoint_arguments, retry_list
+from esHelpers import publish_blue_green, check_not_alias
 import json
+import collections
 from rdflib import Namespace, RDF
 import multiprocessing
 import itertools
+import functools
 from itertools import chain
 import argparse
 import requests
@@ -13,59 +24,6 @@ import warnings
 import pprint
 
 
-class Maybe:
-    def __init__(self, v=None):
-        self.value = v
-
-    @staticmethod
-    def nothing():
-        return Maybe()
-
-    @staticmethod
-    def of(t):
-        return Maybe(t)
-
-    def reduce(self, action):
-        return Maybe.of(functools.reduce(action, self.value)) if self.value else Maybe.nothing()
-
-    def stream(self):
-        return Maybe.of([self.value]) if self.value is not None else Maybe.nothing()
-
-    def map(self, action):
-        return Maybe.of(chain(map(action, self.value))) if self.value is not None else Maybe.nothing()
-
-    def flatmap(self, action):
-        return Maybe.of(chain.from_iterable(map(action, self.value))) if self.value is not None else Maybe.nothing()
-
-    def andThen(self, action):
-        return Maybe.of(action(self.value)) if self.value is not None else Maybe.nothing()
-
-    def orElse(self, action):
-        return Maybe.of(action()) if self.value is None else Maybe.of(self.value)
-
-    def do(self, action):
-        if self.value:
-            action(self.value)
-        return self
-
-    def filter(self, action):
-        return Maybe.of(filter(action, self.value)) if self.value is not None else Maybe.nothing()
-
-    def followedBy(self, action):
-        return self.andThen(lambda _: action)
-
-    def one(self):
-        try:
-            return Maybe.of(next(self.value)) if self.value is not None else Maybe.nothing()
-        except StopIteration:
-            return Maybe.nothing()
-        except TypeError:
-            return self
-
-    def list(self):
-        return list(self.value) if self.value is not None else []
-
-
 def load_file(filepath):
     with open(filepath) as _file:
         return _file.read().replace('\n', " ")
@@ -74,6 +32,7 @@ def load_file(filepath):
 # Global variables for the ingest process for: ***dataType***
 get_dataTypes_query = load_file("queries/listDataTypes.rq")
 describe_dataType_query = load_file("queries/describeDataType.rq")
+dataType_spec = DocumentSpec("specs/datatype.json")
 
 PROV = Namespace("http://www.w3.org/ns/prov#")
 BIBO = Namespace("http://purl.org/ontology/bibo/")
@@ -99,30 +58,21 @@ def get_id(dco_id):
 
 # select: run the supplied SPARQL SELECT query
 def select(endpoint, query):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    return results["results"]["bindings"]
+    return get_client(endpoint).select_iter(query)
 
 # describe: run the supplied SPARQL DESCRIBE query
 def describe(endpoint, query):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    try:
-        return sparql.query().convert()
-    except RuntimeWarning:
-        pass
-
-# get_dataTypes: run the dataTypes SELECT query and return the result set
+    graph = get_client(endpoint).describe(query)
+    return GraphView(graph) if graph is not None else None
+
+# get_dataTypes: list the dataTypes page by page, see ingestHelpers.iter_entities
 def get_dataTypes(endpoint):
-    r = select(endpoint, get_dataTypes_query)
-    return [rs["dataType"]["value"] for rs in r]
+    return iter_entities(endpoint, get_dataTypes_query, "?dataType")
 
 
-# process_dataType: used by generate
-def process_dataType(dataType, endpoint):
-    dt = create_dataType_doc(dataType=dataType, endpoint=endpoint)
+# process_dataType: used by process_dataTypes
+def process_dataType(dataType, endpoint, graph=None):
+    dt = create_dataType_doc(dataType=dataType, endpoint=endpoint, graph=graph)
     if "dcoId" in dt and dt["dcoId"] is not None:
         return [json.dumps(get_metadata(get_id(dt["dcoId"]))), json.dumps(dt)]
     else:
@@ -131,109 +81,50 @@ def process_dataType(dataType, endpoint):
 # describe_dataType: used by create_projcet_doc
 # change the "?dataType" variable to whatever variable name you use in the listXXX.rq file
 def describe_dataType(endpoint, dataType):
-    q = describe_dataType_query.replace("?dataType", "<" + dataType + ">")
+    q = slim_describe(describe_dataType_query, "datatype").replace("?dataType", "<" + dataType + ">")
     return describe(endpoint, q)
 
-# create_dataType_doc: used by process_dataType
-# creates a document to insert into elasticsearch based on the mapping in mappings/dataType.json
-def create_dataType_doc(dataType, endpoint):
-    graph = describe_dataType(endpoint=endpoint, dataType=dataType)
-
-    dt = graph.resource(dataType)
-
-    try:
-        title = dt.label().toPython()
-    except AttributeError:
-        print("missing title:", dataType)
-        return {}
-
-    # dcoId of this dataType
-    dco_id = list(dt.objects(DCO.hasDcoId))
-    dco_id = str(dco_id[0].label().toPython()) if dco_id else None
-
-    doc = {"uri": dataType, "title": title, "dcoId": dco_id}
-
-    # creation year of this dataType
-    creation_year = list(dt.objects(DCO.createdAtTime))
-    creation_year = creation_year[0].toPython() \
-        if creation_year and creation_year[0] \
-        else None
-    if creation_year:
-        doc.update({"creationYear": creation_year})
-
-    # source datatype of this dataType
-    source_datatype = list(dt.objects(DCO.sourceDataType))
-    source_datatype_label = source_datatype[0].label().toPython() \
-        if source_datatype and source_datatype[0].label() \
-        else None
-    if source_datatype:
-        source_datatype_obj = {"uri": str(source_datatype[0].identifier), "title": source_datatype_label}
-        doc.update({"sourceDataType": source_datatype_obj})
-
-    # source standard of this dataType
-    source_standard = list(dt.objects(DCO.sourceStandard))
-    source_standard_label = source_standard[0].label().toPython() \
-        if source_standard and source_standard[0].label() \
-        else None
-    if source_standard:
-        source_standard_obj = {"uri": str(source_standard[0].identifier), "title": source_standard_label}
-        doc.update({"sourceStandard": source_standard_obj})
-
-    # author(s) of this dataType
-    authorsArr = []
-    authors = [faux for faux in dt.objects(PROV.wasAttributedTo) if has_type(faux, PROV.Agent)]
-
-    if authors:
-        for author in authors:
-            #print(community)
-            name = author.label().toPython() if author else None
-
-            obj = {"uri": str(author.identifier), "name": name}
-
-            authorsArr.append(obj)
-
-    doc.update({"authors": authorsArr})
-
-    subjectAreasArr = []
-    subjectAreas = [faux for faux in dt.objects(DCO.dataTypeSubjectArea)]
-    #print(subjectAreas)
-    if subjectAreas:
-        for subjectArea in subjectAreas:
-            #print(subjectArea)
-            title = subjectArea.label().toPython() if subjectAreas else None
-
-            obj = {"uri": str(subjectArea.identifier), "title": title}
-
-            subjectAreasArr.append(obj)
-
-    doc.update({"subjectAreas": subjectAreasArr})
-
-    parametersArr = []
-    parameters = [faux for faux in dt.objects(DCO.hasParameter)]
-    #print(subjectAreas)
-    if parameters:
-        for parameter in parameters:
-            #print(parameter)
-            title = parameter.label().toPython() if parameter else None
-
-            obj = {"uri": str(parameter.identifier), "title": title}
-
-            parametersArr.append(obj)
-
-    doc.update({"parameters": parametersArr})
+# describe_dataTypes: describe a batch of data types with one query, the subject variable bound with a VALUES block
+def describe_dataTypes(endpoint, dataTypes):
+    q = bind_values(slim_describe(describe_dataType_query, "datatype"), "?dataType", dataTypes)
+    return describe(endpoint, q)
 
+# process_dataTypes: used by generate
+# describes a batch of data types with one query and builds each document from the combined graph
+def process_dataTypes(dataTypes, endpoint):
+    graph = describe_dataTypes(endpoint=endpoint, dataTypes=dataTypes)
+    return list(chain.from_iterable(process_dataType(dataType, endpoint, graph) for dataType in dataTypes))
 
-    return doc
+# create_dataType_doc: used by process_dataType
+# creates a document to insert into elasticsearch with the fields declared in specs/datatype.json
+def create_dataType_doc(dataType, endpoint, graph=None):
+    if graph is None:
+        graph = describe_dataType(endpoint=endpoint, dataType=dataType)
+    return dataType_spec.build(graph.resource(dataType))
 
 # has_type: asserts whether a resource if of a certain type
 def has_type(resource, type):
-    for rtype in resource.objects(RDF.type):
-        if str(rtype.identifier) == str(type):
-            return True
-    return False
+    return isinstance(resource, Node) and type in resource.types
 
 # publish: publishes extracted data to elasticsearch node
-def publish(bulk, endpoint, rebuild, mapping):
+def publish(bulk, endpoint, rebuild, mapping, blue_green=False, keep=1, manifest=None, retry=None):
+    # with a manifest, only send the documents that changed since the previous run (everything to a fresh index)
+    actions = split_bulk(bulk)
+    diff = None
+    if manifest:
+        diff = BulkDiff(manifest, "dco", "datatype")
+        actions = diff.diff(actions, full=blue_green or rebuild, retry=retry)
+
+    # blue/green: load a fresh index for this type and move the alias to it once it is complete
+    if blue_green:
+        publisher = publish_blue_green(endpoint, "dco", "datatype", mapping, actions, keep=keep)
+        if diff is not None:
+            diff.commit(publisher)
+        return
+
+    # once types are published blue/green, dco is an alias that cannot be indexed into (or rebuilt) directly
+    check_not_alias(endpoint, "dco")
+
     # if configured to rebuild_index
     # Delete and then re-create to dataType index (via PUT request)
 
@@ -262,45 +153,69 @@ def publish(bulk, endpoint, rebuild, mapping):
                 print(r.url, r.status_code)
                 r.raise_for_status()
 
-    # bulk import new dataType documents
-    bulk_import_url = endpoint + "/_bulk"
-    r = requests.post(bulk_import_url, data=bulk)
-    if r.status_code != requests.codes.ok:
-        print(r.url, r.status_code)
-        r.raise_for_status()
+    # bulk import new dataType documents in chunks, retrying items rejected by elasticsearch
+    publisher = BulkPublisher(endpoint)
+    publisher.publish(actions)
+    publisher.report()
+    if diff is not None:
+        diff.commit(publisher)
+
 
-# generate: startes the ingest process
-def generate(threads, sparql):
-    pool = multiprocessing.Pool(threads)
-    params = [(dataType, sparql) for dataType in get_dataTypes(endpoint=sparql)]
-    return list(itertools.chain.from_iterable(pool.starmap(process_dataType, params)))
+# generate: startes the ingest process; a generator over the bulk lines, in listing order
+def generate(threads, sparql, batch_size=1, retry=None):
+    with multiprocessing.Pool(threads) as pool:
+        # the workers start on the first page of the listing while the next pages are fetched; at most two batches
+        # per worker are pending, so the records never pile up faster than the bulk file is written
+        process = functools.partial(Isolated(process_dataTypes, retry, batched=True), endpoint=sparql)
+        for records in bounded_imap(pool, process, batches(get_dataTypes(endpoint=sparql), batch_size), 2 * threads):
+            yield from records
+        # let the workers exit on their own, so they report their memo statistics
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--threads', default=2, help='number of threads to use (default = 8)')
+    parser.add_argument('--batch-size', default=50, help='number of data types to describe per SPARQL query (default = 50)')
     parser.add_argument('--es', default="http://data.deepcarbon.net/es", help="elasticsearch service URL")
     parser.add_argument('--publish', default=False, action="store_true", help="publish to elasticsearch?")
     parser.add_argument('--rebuild', default=False, action="store_true", help="rebuild elasticsearch index?")
+    parser.add_argument('--blue-green', default=False, action="store_true", help="publish into a fresh index and swap the alias to it when complete")
+    parser.add_argument('--manifest', help="hash manifest of the previously published documents; only new, changed and deleted documents are published")
+    parser.add_argument('--keep-indices', default=1, help="number of previous indices to keep with --blue-green (default = 1)")
     parser.add_argument('--mapping', default="mappings/datatype.json", help="dataType elasticsearch mapping document")
     parser.add_argument('--sparql', default='http://deepcarbon.tw.rpi.edu:3030/VIVO/query', help='sparql endpoint')
+    add_sparql_arguments(parser)
+    add_adaptive_arguments(parser)
+    add_slim_arguments(parser)
+    add_checkpoint_arguments(parser, resume=False)
     #parser.add_argument('--sparql', default='http://udco.tw.rpi.edu/fuseki/vivo/query', help='sparql endpoint')
     parser.add_argument('out', metavar='OUT', help='elasticsearch bulk ingest file')
 
     args = parser.parse_args()
+    configure_sparql(args)
+    configure_adaptive(args, int(args.threads))
+    configure_slim(args)
+
+    # entities whose documents fail are written to the retry list; while it names any, the manifest deletes nothing
+    retry = retry_list(args, args.out)
 
     # generate bulk import document for dataTypes
-    records = generate(threads=int(args.threads), sparql=args.sparql)
+    records = generate(threads=int(args.threads), sparql=args.sparql, batch_size=int(args.batch_size), retry=retry)
 
-    # save generated bulk import file so it can be backed up or reviewed if there are publish errors
+    # save generated bulk import file so it can be backed up or reviewed if there are publish errors; the records are
+    # written, and published, as the workers return them instead of being collected first
     with open(args.out, "w") as bulk_file:
-        bulk_file.write('\n'.join(records)+'\n')
-
-    # publish the results to elasticsearch if "--publish" was specified on the command line
-    if args.publish:
-        bulk_str = '\n'.join(records)+'\n'
-        publish(bulk=bulk_str, endpoint=args.es, rebuild=args.rebuild, mapping=args.mapping)
+        records = write_bulk_lines(records, bulk_file)
+
+        # publish the results to elasticsearch if "--publish" was specified on the command line
+        if args.publish:
+            publish(bulk=records, endpoint=args.es, rebuild=args.rebuild, mapping=args.mapping,
+                    blue_green=args.blue_green, keep=int(args.keep_indices), manifest=args.manifest, retry=retry)
+        else:
+            collections.deque(records, maxlen=0)
 
 
 ########################################
@@ -1,14 +1,26 @@
 __author__ = 'szednik'
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+from sparqlClient import get_client, add_sparql_arguments, configure_sparql
+from adaptiveLimiter import add_adaptive_arguments, configure_adaptive
+from referenceStore import add_reference_arguments, configure_references, trim_describe, reference_predicates
+from describeProfile import add_slim_arguments, configure_slim, slim_describe
+from checkpointJournal import Isolated, add_checkpoint_arguments, retry_list
+from bulkPublisher import BulkPublisher, split_bulk
+from bulkDiff import BulkDiff
+from graphView import GraphView, Node
+from propertyPath import PropertyPath
+from esHelpers import publish_blue_green, check_not_alias
 from rdflib import Namespace, RDF
 import json
+import collections
 import requests
 import multiprocessing
 from itertools import chain
 import functools
 import argparse
 
+from ingestHelpers import batches, bind_values, iter_entities, bounded_imap, write_bulk_lines
+
 
 class Maybe:
     def __init__(self, v=None):
@@ -81,6 +93,10 @@ NET_ID = Namespace("http://vivo.mydomain.edu/ns#")
 
 get_people_query = load_file("queries/listPeople.rq")
 describe_person_query = load_file("queries/describePerson.rq")
+# variables of the describe query bound to reference entities, left out with --references
+reference_variables = ["?mostSpecificType", "?org", "?dco_community", "?team", "?research_area"]
+# the predicates to the reference entities, which GraphView completes from the store
+reference_links = reference_predicates(describe_person_query, reference_variables)
 
 # standard filters
 non_empty_str = lambda s: True if s else False
@@ -96,119 +112,93 @@ def get_id(dco_id):
 
 
 def select(endpoint, query):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    return results["results"]["bindings"]
+    return get_client(endpoint).select_iter(query)
 
 
 def describe(endpoint, query):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    try:
-        return sparql.query().convert()
-    except RuntimeWarning:
-        pass
+    graph = get_client(endpoint).describe(query)
+    return GraphView(graph, reference_links) if graph is not None else None
 
 
 def has_type(resource, type):
-    for rtype in resource.objects(RDF.type):
-        if str(rtype.identifier) == str(type):
-            return True
-    return False
+    return isinstance(resource, Node) and type in resource.types
 
 
 def get_people(endpoint):
-    r = select(endpoint, get_people_query)
-    return [rs["person"]["value"] for rs in r]
+    return iter_entities(endpoint, get_people_query, "?person")
 
 
 def describe_person(endpoint, person):
-    q = describe_person_query.replace("?person", "<" + person + ">")
+    q = slim_describe(trim_describe(describe_person_query, reference_variables), "person").replace("?person", "<" + person + ">")
+    return describe(endpoint, q)
+
+
+def describe_people(endpoint, people):
+    q = bind_values(slim_describe(trim_describe(describe_person_query, reference_variables), "person"), "?person", people)
     return describe(endpoint, q)
 
 
+# property paths of the person document fields, compiled once
+DCO_ID = PropertyPath("dco:hasDcoId")
+ORCID = PropertyPath("vivo:orcidId")
+MOST_SPECIFIC_TYPE = PropertyPath("vitro:mostSpecificType[labelled]")
+NETWORK_ID = PropertyPath("netid:networkId[nonempty]")
+GIVEN_NAME = PropertyPath("obo:ARG_2000028/vcard:hasName/vcard:givenName[nonempty]")
+FAMILY_NAME = PropertyPath("obo:ARG_2000028/vcard:hasName/vcard:familyName[nonempty]")
+EMAIL = PropertyPath("obo:ARG_2000028/vcard:hasEmail[a vcard:Work]/vcard:email[nonempty]")
+RESEARCH_AREAS = PropertyPath("vivo:hasResearchArea")
+POSITIONS = PropertyPath("vivo:relatedBy[a vivo:Position]")
+POSITION_ORGANIZATION = PropertyPath("vivo:relates[a foaf:Organization]")
+MEMBER_ROLES = PropertyPath("obo:RO_0000053[a vivo:MemberRole]")
+ROLE_TEAM = PropertyPath("vivo:roleContributesTo[a dco:Team]")
+ROLE_COMMUNITY = PropertyPath("vivo:roleContributesTo[a dco:ResearchCommunity]")
+HOME_COUNTRY = PropertyPath("dco:homeCountry")
+THUMBNAIL = PropertyPath("vitro-public:mainImage/vitro-public:thumbnailImage/vitro-public:downloadLocation")
+
+
 def get_dcoid(person):
-    return Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(DCO.hasDcoId)) \
-        .orElse(lambda: person.graph.subjects(DCO.dcoIdFor, person)) \
-        .map(lambda i: i.label()) \
-        .one().value
+    dcoid = DCO_ID.first(person)
+    return dcoid.label() if dcoid is not None else None
 
 
 def get_orcid(person):
-    return Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(VIVO.orcidId)) \
-        .map(lambda o: o.identifier) \
-        .map(lambda o: o[o.rfind('/') + 1:]).one().value
+    orcid = ORCID.first(person)
+    if orcid is None:
+        return None
+    orcid = orcid.identifier
+    return orcid[orcid.rfind('/') + 1:]
 
 
 def get_most_specific_type(person):
-    return Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(VITRO.mostSpecificType)) \
-        .map(lambda t: t.label()) \
-        .filter(non_empty_str) \
-        .one().value
+    most_specific_type = MOST_SPECIFIC_TYPE.first(person)
+    return most_specific_type.label() if most_specific_type is not None else None
 
 
 def get_network_id(person):
-    return Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(NET_ID.networkId)) \
-        .filter(non_empty_str) \
-        .one().value
+    return NETWORK_ID.first(person)
 
 
 def get_given_name(person):
-    return Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(OBO.ARG_2000028)) \
-        .flatmap(lambda v: v.objects(VCARD.hasName)) \
-        .flatmap(lambda n: n.objects(VCARD.givenName)) \
-        .filter(non_empty_str) \
-        .one().value
+    return GIVEN_NAME.first(person)
 
 
 def get_family_name(person):
-    return Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(OBO.ARG_2000028)) \
-        .flatmap(lambda v: v.objects(VCARD.hasName)) \
-        .flatmap(lambda n: n.objects(VCARD.familyName)) \
-        .filter(non_empty_str) \
-        .one().value
+    return FAMILY_NAME.first(person)
 
 
 def get_email(person):
-    return Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(OBO.ARG_2000028)) \
-        .flatmap(lambda v: v.objects(VCARD.hasEmail)) \
-        .filter(lambda f: has_type(f, VCARD.Work)) \
-        .flatmap(lambda e: e.objects(VCARD.email)) \
-        .filter(non_empty_str) \
-        .one().value
+    return EMAIL.first(person)
 
 
 def get_research_areas(person):
-    return Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(VIVO.hasResearchArea)) \
-        .filter(has_label) \
-        .map(lambda r: {"uri": str(r.identifier), "name": str(r.label())}).list()
+    return RESEARCH_AREAS.labelled(person)
 
 
 def get_organizations(person):
     orgs = []
 
-    orgroles = Maybe.of(person).stream() \
-        .flatmap(lambda per: per.objects(VIVO.relatedBy)) \
-        .filter(lambda related: has_type(related, VIVO.Position)).list()
-
-    for orgrole in orgroles:
-        org = Maybe.of(orgrole).stream() \
-            .flatmap(lambda r: r.objects(VIVO.relates)) \
-            .filter(lambda o: has_type(o, FOAF.Organization)) \
-            .filter(has_label) \
-            .map(lambda o: {"uri": str(o.identifier), "name": str(o.label())}) \
-            .one().value
-
+    for orgrole in POSITIONS.all(person):
+        org = POSITION_ORGANIZATION.labelled(orgrole, first=True)
         if org:
             orgs.append({"orgrole": str(orgrole.label()), "organization": org})
 
@@ -218,18 +208,8 @@ def get_organizations(person):
 def get_teams(person):
     teams = []
 
-    teamroles = Maybe.of(person).stream() \
-        .flatmap(lambda per: per.objects(OBO.RO_0000053)) \
-        .filter(lambda related: has_type(related, VIVO.MemberRole)).list()
-
-    for teamrole in teamroles:
-        team = Maybe.of(teamrole).stream() \
-            .flatmap(lambda r: r.objects(VIVO.roleContributesTo)) \
-            .filter(lambda o: has_type(o, DCO.Team)) \
-            .filter(has_label) \
-            .map(lambda o: {"uri": str(o.identifier), "name": str(o.label())}) \
-            .one().value
-
+    for teamrole in MEMBER_ROLES.all(person):
+        team = ROLE_TEAM.labelled(teamrole, first=True)
         if team:
             teams.append({"teamrole": str(teamrole.label()), "team": team})
 
@@ -239,18 +219,8 @@ def get_teams(person):
 def get_dco_communities(person):
     comms = []
 
-    commroles = Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(OBO.RO_0000053)) \
-        .filter(lambda related: has_type(related, VIVO.MemberRole)).list()
-
-    for commrole in commroles:
-        comm = Maybe.of(commrole).stream() \
-            .flatmap(lambda r: r.objects(VIVO.roleContributesTo)) \
-            .filter(lambda o: has_type(o, DCO.ResearchCommunity)) \
-            .filter(has_label) \
-            .map(lambda o: {"uri": str(o.identifier), "name": str(o.label())}) \
-            .one().value
-
+    for commrole in MEMBER_ROLES.all(person):
+        comm = ROLE_COMMUNITY.labelled(commrole, first=True)
         if comm:
             comms.append({"commrole": str(commrole.label()), "community": comm})
 
@@ -258,23 +228,17 @@ def get_dco_communities(person):
 
 
 def get_home_country(person):
-    return Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(DCO.homeCountry)) \
-        .filter(has_label) \
-        .map(lambda r: {"uri": str(r.identifier), "name": str(r.label())}).one().value
+    return HOME_COUNTRY.labelled(person, first=True)
 
 
 def get_thumbnail(person):
-    return Maybe.of(person).stream() \
-        .flatmap(lambda p: p.objects(VITRO_PUB.mainImage)) \
-        .flatmap(lambda i: i.objects(VITRO_PUB.thumbnailImage)) \
-        .flatmap(lambda t: t.objects(VITRO_PUB.downloadLocation)) \
-        .map(lambda t: t.identifier) \
-        .one().value
+    thumbnail = THUMBNAIL.first(person)
+    return thumbnail.identifier if thumbnail is not None else None
 
 
-def create_person_doc(person, endpoint):
-    graph = describe_person(endpoint=endpoint, person=person)
+def create_person_doc(person, endpoint, graph=None):
+    if graph is None:
+        graph = describe_person(endpoint=endpoint, person=person)
 
     per = graph.resource(person)
 
@@ -340,14 +304,37 @@ def create_person_doc(person, endpoint):
     return doc
 
 
-def process_person(person, endpoint):
-    per = create_person_doc(person=person, endpoint=endpoint)
+def process_person(person, endpoint, graph=None):
+    per = create_person_doc(person=person, endpoint=endpoint, graph=graph)
     es_id = per["dcoId"] if "dcoId" in per and per["dcoId"] is not None else per["uri"]
     es_id = get_id(es_id)
     return [json.dumps(get_metadata(es_id)), json.dumps(per)]
 
 
-def publish(bulk, endpoint, rebuild, mapping):
+# process_people: describe a batch of people with one query and build each document from the combined graph
+def process_people(people, endpoint):
+    graph = describe_people(endpoint=endpoint, people=people)
+    return list(chain.from_iterable(process_person(person, endpoint, graph) for person in people))
+
+
+def publish(bulk, endpoint, rebuild, mapping, blue_green=False, keep=1, manifest=None, retry=None):
+    # with a manifest, only send the documents that changed since the previous run (everything to a fresh index)
+    actions = split_bulk(bulk)
+    diff = None
+    if manifest:
+        diff = BulkDiff(manifest, "dco", "person")
+        actions = diff.diff(actions, full=blue_green or rebuild, retry=retry)
+
+    # blue/green: load a fresh index for this type and move the alias to it once it is complete
+    if blue_green:
+        publisher = publish_blue_green(endpoint, "dco", "person", mapping, actions, keep=keep)
+        if diff is not None:
+            diff.commit(publisher)
+        return
+
+    # once types are published blue/green, dco is an alias that cannot be indexed into (or rebuilt) directly
+    check_not_alias(endpoint, "dco")
+
     # if configured to rebuild_index
     # Delete and then re-create to publication index (via PUT request)
 
@@ -376,41 +363,67 @@ def publish(bulk, endpoint, rebuild, mapping):
                 print(r.url, r.status_code)
                 r.raise_for_status()
 
-    # bulk import new publication documents
-    bulk_import_url = endpoint + "/_bulk"
-    r = requests.post(bulk_import_url, data=bulk)
-    if r.status_code != requests.codes.ok:
-        print(r.url, r.status_code)
-        r.raise_for_status()
+    # bulk import new publication documents in chunks, retrying items rejected by elasticsearch
+    publisher = BulkPublisher(endpoint)
+    publisher.publish(actions)
+    publisher.report()
+    if diff is not None:
+        diff.commit(publisher)
+
 
 
-def generate(threads, sparql):
-    pool = multiprocessing.Pool(threads)
-    params = [(person, sparql) for person in get_people(endpoint=sparql)]
-    return list(chain.from_iterable(pool.starmap(process_person, params)))
+def generate(threads, sparql, batch_size=1, retry=None):
+    with multiprocessing.Pool(threads) as pool:
+        # the workers start on the first page of the listing while the next pages are fetched; at most two batches
+        # per worker are pending, so the records never pile up faster than the bulk file is written
+        process = functools.partial(Isolated(process_people, retry, batched=True), endpoint=sparql)
+        for records in bounded_imap(pool, process, batches(get_people(endpoint=sparql), batch_size), 2 * threads):
+            yield from records
+        # let the workers exit on their own, so they report their memo statistics
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--threads', default=8, help='number of threads to use (default = 8)')
+    parser.add_argument('--batch-size', default=50, help='number of people to describe per SPARQL query (default = 50)')
     parser.add_argument('--es', default="http://data.deepcarbon.net/es", help="elasticsearch service URL")
     parser.add_argument('--publish', default=False, action="store_true", help="publish to elasticsearch?")
     parser.add_argument('--rebuild', default=False, action="store_true", help="rebuild elasticsearch index?")
+    parser.add_argument('--blue-green', default=False, action="store_true", help="publish into a fresh index and swap the alias to it when complete")
+    parser.add_argument('--manifest', help="hash manifest of the previously published documents; only new, changed and deleted documents are published")
+    parser.add_argument('--keep-indices', default=1, help="number of previous indices to keep with --blue-green (default = 1)")
     parser.add_argument('--mapping', default="mappings/person.json", help="publication elasticsearch mapping document")
     parser.add_argument('--sparql', default='http://deepcarbon.tw.rpi.edu:3030/VIVO/query', help='sparql endpoint')
+    add_sparql_arguments(parser)
+    add_adaptive_arguments(parser)
+    add_reference_arguments(parser)
+    add_slim_arguments(parser)
+    add_checkpoint_arguments(parser, resume=False)
     parser.add_argument('out', metavar='OUT', help='elasticsearch bulk ingest file')
 
     args = parser.parse_args()
+    configure_sparql(args)
+    configure_adaptive(args, int(args.threads))
+    configure_references(args, args.sparql)
+    configure_slim(args)
+
+    # entities whose documents fail are written to the retry list; while it names any, the manifest deletes nothing
+    retry = retry_list(args, args.out)
 
     # generate bulk import document for publications
-    records = generate(threads=int(args.threads), sparql=args.sparql)
+    records = generate(threads=int(args.threads), sparql=args.sparql, batch_size=int(args.batch_size), retry=retry)
 
-    # save generated bulk import file so it can be backed up or reviewed if there are publish errors
+    # save generated bulk import file so it can be backed up or reviewed if there are publish errors; the records are
+    # written, and published, as the workers return them instead of being collected first
     with open(args.out, "w") as bulk_file:
-        bulk_file.write('\n'.join(records)+'\n')
-
-    # publish the results to elasticsearch if "--publish" was specified on the command line
-    if args.publish:
-        bulk_str = '\n'.join(records)+'\n'
-        publish(bulk=bulk_str, endpoint=args.es, rebuild=args.rebuild, mapping=args.mapping)
+        records = write_bulk_lines(records, bulk_file)
+
+        # publish the results to elasticsearch if "--publish" was specified on the command line
+        if args.publish:
+            publish(bulk=records, endpoint=args.es, rebuild=args.rebuild, mapping=args.mapping,
+                    blue_green=args.blue_green, keep=int(args.keep_indices), manifest=args.manifest, retry=retry)
+        else:
+            collections.deque(records, maxlen=0)
@@ -1,11 +1,24 @@
 __author__ = 'szednik'
 #Edited by Ahmed (am-e) to ingest projects
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+from sparqlClient import get_client, add_sparql_arguments, configure_sparql
+from adaptiveLimiter import add_adaptive_arguments, configure_adaptive
+from ingestHelpers import batches, bind_values, iter_entities, bounded_imap, write_bulk_lines
+from referenceStore import add_reference_arguments, configure_references, trim_describe, reference_predicates
+from describeProfile import add_slim_arguments, configure_slim, slim_describe
+from checkpointJournal import Isolated, add_checkpoint_arguments, retry_list
+from bulkPublisher import BulkPublisher, split_bulk
+from bulkDiff import BulkDiff
+from graphView import GraphView, Node
+from documentSpec import DocumentSpec
+from memoCache import add_memo_arguments, configure_memo
+from esHelpers import publish_blue_green, check_not_alias
 import json
+import collections
 from rdflib import Namespace, RDF
 import multiprocessing
 import itertools
+import functools
 from itertools import chain
 import argparse
 import requests
@@ -13,59 +26,6 @@ import warnings
 import pprint
 
 
-class Maybe:
-    def __init__(self, v=None):
-        self.value = v
-
-    @staticmethod
-    def nothing():
-        return Maybe()
-
-    @staticmethod
-    def of(t):
-        return Maybe(t)
-
-    def reduce(self, action):
-        return Maybe.of(functools.reduce(action, self.value)) if self.value else Maybe.nothing()
-
-    def stream(self):
-        return Maybe.of([self.value]) if self.value is not None else Maybe.nothing()
-
-    def map(self, action):
-        return Maybe.of(chain(map(action, self.value))) if self.value is not None else Maybe.nothing()
-
-    def flatmap(self, action):
-        return Maybe.of(chain.from_iterable(map(action, self.value))) if self.value is not None else Maybe.nothing()
-
-    def andThen(self, action):
-        return Maybe.of(action(self.value)) if self.value is not None else Maybe.nothing()
-
-    def orElse(self, action):
-        return Maybe.of(action()) if self.value is None else Maybe.of(self.value)
-
-    def do(self, action):
-        if self.value:
-            action(self.value)
-        return self
-
-    def filter(self, action):
-        return Maybe.of(filter(action, self.value)) if self.value is not None else Maybe.nothing()
-
-    def followedBy(self, action):
-        return self.andThen(lambda _: action)
-
-    def one(self):
-        try:
-            return Maybe.of(next(self.value)) if self.value is not None else Maybe.nothing()
-        except StopIteration:
-            return Maybe.nothing()
-        except TypeError:
-            return self
-
-    def list(self):
-        return list(self.value) if self.value is not None else []
-
-
 def load_file(filepath):
     with open(filepath) as _file:
         return _file.read().replace('\n', " ")
@@ -74,6 +34,13 @@ def load_file(filepath):
 # Global variables for the ingest process for: ***project***
 get_projects_query = load_file("queries/listProjects.rq")
 describe_project_query = load_file("queries/describeProject.rq")
+# variables of the describe query bound to reference entities, left out with --references
+reference_variables = ["?mostSpecificType", "?community", "?team", "?reportingYear"]
+# the predicates to the reference entities, which GraphView completes from the store
+reference_links = reference_predicates(describe_project_query, reference_variables)
+project_spec = DocumentSpec("specs/project.json")
+# with --field-studies the field-study documents are built from the same descriptions
+field_study_spec = DocumentSpec("specs/field-study.json")
 
 PROV = Namespace("http://www.w3.org/ns/prov#")
 BIBO = Namespace("http://purl.org/ontology/bibo/")
@@ -87,8 +54,8 @@ FOAF = Namespace("http://xmlns.com/foaf/0.1/")
 
 
 # get_metadata: returns the index and type of the specified id
-def get_metadata(id):
-    return {"index": {"_index": "dco", "_type": "project", "_id": id}}
+def get_metadata(id, es_type="project"):
+    return {"index": {"_index": "dco", "_type": es_type, "_id": id}}
 
 
 # get_id: returns dcoId of entity being ingested
@@ -98,253 +65,99 @@ def get_id(dco_id):
 
 # select: run the supplied SPARQL SELECT query
 def select(endpoint, query):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    return results["results"]["bindings"]
+    return get_client(endpoint).select_iter(query)
 
 # describe: run the supplied SPARQL DESCRIBE query
 def describe(endpoint, query):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    try:
-        return sparql.query().convert()
-    except RuntimeWarning:
-        pass
-
-# get_projects: run the projects SELECT query and return the result set
+    graph = get_client(endpoint).describe(query)
+    return GraphView(graph, reference_links) if graph is not None else None
+
+# get_projects: list the projects page by page, see ingestHelpers.iter_entities
 def get_projects(endpoint):
-    r = select(endpoint, get_projects_query)
-    return [rs["project"]["value"] for rs in r]
+    return iter_entities(endpoint, get_projects_query, "?project")
 
 
-# process_project: used by generate
-def process_project(project, endpoint):
-    prj = create_project_doc(project=project, endpoint=endpoint)
+# process_project: used by process_projects
+def process_project(project, endpoint, graph=None):
+    prj = create_project_doc(project=project, endpoint=endpoint, graph=graph)
     if "dcoId" in prj and prj["dcoId"] is not None:
         return [json.dumps(get_metadata(get_id(prj["dcoId"]))), json.dumps(prj)]
     else:
         return []
 
+# process_projects: used by generate
+# describes a batch of projects with one query and builds each document from the combined graph
+def process_projects(projects, endpoint):
+    graph = describe_projects(endpoint=endpoint, projects=projects)
+    return list(chain.from_iterable(process_project(project, endpoint, graph) for project in projects))
+
+# process_project_and_field_study: used by process_projects_and_field_studies
+# one description of the project gives the records of its project document and, if the project is a field study,
+# of its field-study document (see ingest-field-studies.py)
+def process_project_and_field_study(project, endpoint, graph=None):
+    if graph is None:
+        graph = describe_project(endpoint=endpoint, project=project, profile=("project", "field-study"))
+    resource = graph.resource(project)
+    records = []
+    for spec, es_type in [(project_spec, "project"), (field_study_spec, "field-study")]:
+        if es_type == "field-study" and not resource.has_type(DCO.FieldStudy):
+            records.append([])
+            continue
+        prj = spec.build(resource)
+        if "dcoId" in prj and prj["dcoId"] is not None:
+            records.append([json.dumps(get_metadata(get_id(prj["dcoId"]), es_type)), json.dumps(prj)])
+        else:
+            records.append([])
+    return records
+
+# process_projects_and_field_studies: used by generate_with_field_studies
+# describes a batch of projects with one query; returns the [project records, field-study records] of each project
+def process_projects_and_field_studies(projects, endpoint):
+    graph = describe_projects(endpoint=endpoint, projects=projects, profile=("project", "field-study"))
+    return [process_project_and_field_study(project, endpoint, graph) for project in projects]
+
 # describe_project: used by create_projcet_doc
 # change the "?project" variable to whatever variable name you use in the listXXX.rq file
-def describe_project(endpoint, project):
-    q = describe_project_query.replace("?project", "<" + project + ">")
+def describe_project(endpoint, project, profile="project"):
+    q = slim_describe(trim_describe(describe_project_query, reference_variables), profile).replace("?project", "<" + project + ">")
     return describe(endpoint, q)
 
-def get_thumbnail(project):
-    return Maybe.of(project).stream() \
-        .flatmap(lambda p: p.objects(VITRO_PUB.mainImage)) \
-        .flatmap(lambda i: i.objects(VITRO_PUB.thumbnailImage)) \
-        .flatmap(lambda t: t.objects(VITRO_PUB.downloadLocation)) \
-        .map(lambda t: t.identifier) \
-        .one().value
+# describe_projects: describe a batch of projects with one query, the subject variable bound with a VALUES block
+def describe_projects(endpoint, projects, profile="project"):
+    q = bind_values(slim_describe(trim_describe(describe_project_query, reference_variables), profile), "?project", projects)
+    return describe(endpoint, q)
 
 # create_project_doc: used by process_project
-# creates a document to insert into elasticsearch based on the mapping in mappings/project.json
-def create_project_doc(project, endpoint):
-    graph = describe_project(endpoint=endpoint, project=project)
-
-    prj = graph.resource(project)
-
-    try:
-        title = prj.label().toPython()
-    except AttributeError:
-        print("missing title:", project)
-        return {}
-
-    #dcoId of this project
-    dco_id = list(prj.objects(DCO.hasDcoId))
-    dco_id = str(dco_id[0].label().toPython()) if dco_id else None
-
-    doc = {"uri": project, "title": title, "dcoId": dco_id}
-
-    #type of this project: Project/Field Study
-    most_specific_type = list(prj.objects(VITRO.mostSpecificType))
-    most_specific_type = most_specific_type[0].label().toPython() \
-        if most_specific_type and most_specific_type[0].label() \
-        else None
-    if most_specific_type:
-        doc.update({"mostSpecificType": most_specific_type})
-
-    #project submitted by - under investigation
-    submitted_by = list(prj.objects(DCO.submittedBy))
-    submitted_by = submitted_by[0] if submitted_by else None
-    if submitted_by and submitted_by.label():
-        doc.update({"submittedBy": {"uri": str(submitted_by.identifier), "name": submitted_by.label().toPython()}})
-    elif submitted_by:
-        print("submitted-by label missing:", str(submitted_by.identifier))
-
-    #leader of this project
-    leader = list(prj.objects(DCO.fieldworkLeader))
-    leader = leader[0] if leader else None
-    if leader and leader.label():
-        doc.update({"leader": {"uri": str(leader.identifier), "name": leader.label().toPython()}})
-    elif leader:
-        print("leader label missing:", str(leader.identifier))
-
-    #date/time interval when this project took place
-    date_time_interval = list(prj.objects(VIVO.dateTimeInterval))
-    date_time_interval = date_time_interval[0] if date_time_interval else None
-
-    if date_time_interval is not None:
-
-        start = list(date_time_interval.objects(VIVO.start))
-        start = start[0] if start else None
-
-        end = list(date_time_interval.objects(VIVO.end))
-        end = end[0] if end else None
-
-        if start is not None:
-            start_date_time = list(start.objects(VIVO.dateTime))
-            start_date_time = start_date_time[0] if start_date_time else None
-
-        if end is not None:
-            end_date_time = list(end.objects(VIVO.dateTime))
-            end_date_time = end_date_time[0] if end_date_time else None
-
-
-        if start is not None and end is not None:
-            doc.update({"dateTimeInterval": {"uri": str(date_time_interval.identifier), "startDate": str(start_date_time)[:10], "startYear": str(start_date_time)[:4], "endDate": str(end_date_time)[:10], "endYear": str(end_date_time)[:4]}})
-
-        if start is not None and end is None:
-            doc.update({"dateTimeInterval": {"uri": str(date_time_interval.identifier), "startDate": str(start_date_time)[:10], "startYear": str(start_date_time)[:4]}})
-
-        if end is not None and start is None:
-            doc.update({"dateTimeInterval": {"uri": str(date_time_interval.identifier), "endDate": str(end_date_time)[:10], "endYear": str(end_date_time)[:4]}})
-
-    #dcoCommunities associated with this project
-    associatedCommunities = []
-    communities = [faux for faux in prj.objects(DCO.associatedDCOCommunity) if has_type(faux, DCO.ResearchCommunity)]
-
-    if communities:
-        for community in communities:
-            #print(community)
-            name = community.label().toPython() if community else None
-
-            obj = {"uri": str(community.identifier), "name": name}
-
-            associatedCommunities.append(obj)
-
-    doc.update({"dcoCommunities": associatedCommunities})
-
-    #teams associated with this project
-    associatedTeams = []
-    teams = [faux for faux in prj.objects(DCO.associatedDCOTeam) if has_type(faux, DCO.Team)]
-
-    if teams:
-        for team in teams:
-
-            name = team.label().toPython() if team else None
-
-            obj = {"uri": str(team.identifier), "name": name}
-
-            associatedTeams.append(obj)
-
-    doc.update({"teams": associatedTeams})
-
-    #people who have participated in this project
-    participants = []
-
-    #get roles linked to project by "BFO_0000055" property
-    roles = [faux for faux in prj.objects(OBO.BFO_0000055) if has_type(faux, VIVO.Role)]
-
-    if roles:
-        for role in roles:
-
-            #get participants for each role
-            participant = [person for person in role.objects(OBO.RO_0000052) if has_type(person, FOAF.Person)][0]
-            name = participant.label().toPython() if participant else None
-
-            obj = {"uri": str(participant.identifier), "name": name}
-
-            research_areas = [research_area.label().toPython() for research_area in participant.objects(VIVO.hasResearchArea) if research_area.label()]
-
-            if research_areas:
-                obj.update({"researchArea": research_areas})
-
-            org = list(participant.objects(DCO.inOrganization))
-            org = org[0] if org else None
-            if org and org.label():
-                obj.update({"organization": {"uri": str(org.identifier), "name": org.label().toPython()}})
-
-            participants.append(obj)
-
-    #get roles linked to this project by "contributingRole" property
-    roles = [faux for faux in prj.objects(VIVO.contributingRole) if has_type(faux, VIVO.Role)]
-
-    if roles:
-        for role in roles:
-
-            #get participants for each role
-            participant = [person for person in role.objects(OBO.RO_0000052) if has_type(person, FOAF.Person)][0]
-            name = participant.label().toPython() if participant else None
-
-            obj = {"uri": str(participant.identifier), "name": name}
-
-            research_areas = [research_area.label().toPython() for research_area in participant.objects(VIVO.hasResearchArea) if research_area.label()]
-
-            if research_areas:
-                obj.update({"researchArea": research_areas})
-
-            org = list(participant.objects(DCO.inOrganization))
-            org = org[0] if org else None
-            if org and org.label():
-                obj.update({"organization": {"uri": str(org.identifier), "name": org.label().toPython()}})
-
-            participants.append(obj)
-
-    doc.update({"participants": participants})
-
-    #reporting years for this project updates related to project
-    reporting_years = []
-    project_updates = [faux for faux in prj.objects(DCO.hasProjectUpdate) if has_type(faux, DCO.ProjectUpdate)]
-
-    if project_updates:
-        for project_update in project_updates:
-
-            reporting_year = list(project_update.objects(DCO.forReportingYear))
-            reporting_year = reporting_year[0] if reporting_year else None
-
-
-            obj = {"uri": str(reporting_year.identifier), "year": reporting_year.label().toPython()}
-
-            reporting_years.append(obj)
-
-    doc.update({"reportingYear": reporting_years})
-
-    #grants that fund this project
-    grants = []
-    fundingVehicles = [faux for faux in prj.objects(VIVO.hasFundingVehicle) if has_type(faux, VIVO.Grant)]
-
-    if fundingVehicles:
-        for fundingVehicle in fundingVehicles:
-
-            name = fundingVehicle.label().toPython() if fundingVehicle else None
-
-            obj = {"uri": str(fundingVehicle.identifier), "name": name}
-
-            grants.append(obj)
-
-    doc.update({"grants": grants})
-
-    #thumbnail for this project if found
-    thumbnail = get_thumbnail(prj)
-    if thumbnail:
-        doc.update({"thumbnail": thumbnail})
-
-    return doc
+# creates a document to insert into elasticsearch with the fields declared in specs/project.json
+def create_project_doc(project, endpoint, graph=None):
+    if graph is None:
+        graph = describe_project(endpoint=endpoint, project=project)
+    return project_spec.build(graph.resource(project))
 
 # has_type: asserts whether a resource if of a certain type
 def has_type(resource, type):
-    for rtype in resource.objects(RDF.type):
-        if str(rtype.identifier) == str(type):
-            return True
-    return False
+    return isinstance(resource, Node) and type in resource.types
 
 # publish: publishes extracted data to elasticsearch node
-def publish(bulk, endpoint, rebuild, mapping):
+# es_type: "field-study" for the field-study documents of generate_with_field_studies
+def publish(bulk, endpoint, rebuild, mapping, blue_green=False, keep=1, manifest=None, retry=None, es_type="project"):
+    # with a manifest, only send the documents that changed since the previous run (everything to a fresh index)
+    actions = split_bulk(bulk)
+    diff = None
+    if manifest:
+        diff = BulkDiff(manifest, "dco", es_type)
+        actions = diff.diff(actions, full=blue_green or rebuild, retry=retry)
+
+    # blue/green: load a fresh index for this type and move the alias to it once it is complete
+    if blue_green:
+        publisher = publish_blue_green(endpoint, "dco", es_type, mapping, actions, keep=keep)
+        if diff is not None:
+            diff.commit(publisher)
+        return
+
+    # once types are published blue/green, dco is an alias that cannot be indexed into (or rebuilt) directly
+    check_not_alias(endpoint, "dco")
+
     # if configured to rebuild_index
     # Delete and then re-create to project index (via PUT request)
 
@@ -359,7 +172,7 @@ def publish(bulk, endpoint, rebuild, mapping):
 
     # push current project document mapping
 
-    mapping_url = endpoint + "/dco/project/_mapping"
+    mapping_url = endpoint + "/dco/" + es_type + "/_mapping"
     with open(mapping) as mapping_file:
         r = requests.put(mapping_url, data=mapping_file)
         if r.status_code != requests.codes.ok:
@@ -373,44 +186,101 @@ def publish(bulk, endpoint, rebuild, mapping):
                 print(r.url, r.status_code)
                 r.raise_for_status()
 
-    # bulk import new project documents
-    bulk_import_url = endpoint + "/_bulk"
-    r = requests.post(bulk_import_url, data=bulk)
-    if r.status_code != requests.codes.ok:
-        print(r.url, r.status_code)
-        r.raise_for_status()
-
-# generate: startes the ingest process
-def generate(threads, sparql):
-    pool = multiprocessing.Pool(threads)
-    params = [(project, sparql) for project in get_projects(endpoint=sparql)]
-    return list(itertools.chain.from_iterable(pool.starmap(process_project, params)))
+    # bulk import new project documents in chunks, retrying items rejected by elasticsearch
+    publisher = BulkPublisher(endpoint)
+    publisher.publish(actions)
+    publisher.report()
+    if diff is not None:
+        diff.commit(publisher)
+
+
+# generate: startes the ingest process; a generator over the bulk lines, in listing order
+def generate(threads, sparql, batch_size=1, retry=None):
+    with multiprocessing.Pool(threads) as pool:
+        # the workers start on the first page of the listing while the next pages are fetched; at most two batches
+        # per worker are pending, so the records never pile up faster than the bulk file is written
+        process = functools.partial(Isolated(process_projects, retry, batched=True), endpoint=sparql)
+        for records in bounded_imap(pool, process, batches(get_projects(endpoint=sparql), batch_size), 2 * threads):
+            yield from records
+        # let the workers exit on their own, so they report their memo statistics
+        pool.close()
+        pool.join()
+
+
+# generate_with_field_studies: like generate, also writes the records of the field-study documents to the
+# field_studies_out bulk file as they come, built from the same descriptions instead of describing every field study
+# again in ingest-field-studies.py
+def generate_with_field_studies(threads, sparql, field_studies_out, batch_size=1, retry=None):
+    with multiprocessing.Pool(threads) as pool, open(field_studies_out, "w") as field_study_file:
+        process = functools.partial(Isolated(process_projects_and_field_studies, retry, batched=True), endpoint=sparql)
+        # a project that failed has no records, see checkpointJournal.Isolated
+        for batch_records in bounded_imap(pool, process, batches(get_projects(endpoint=sparql), batch_size), 2 * threads):
+            for project_records, field_records in batch_records:
+                field_study_file.writelines(record + '\n' for record in field_records)
+                yield from project_records
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--threads', default=2, help='number of threads to use (default = 8)')
+    parser.add_argument('--batch-size', default=50, help='number of projects to describe per SPARQL query (default = 50)')
     parser.add_argument('--es', default="http://localhost:9200", help="elasticsearch service URL")
     parser.add_argument('--publish', default=False, action="store_true", help="publish to elasticsearch?")
     parser.add_argument('--rebuild', default=False, action="store_true", help="rebuild elasticsearch index?")
+    parser.add_argument('--blue-green', default=False, action="store_true", help="publish into a fresh index and swap the alias to it when complete")
+    parser.add_argument('--manifest', help="hash manifest of the previously published documents; only new, changed and deleted documents are published")
+    parser.add_argument('--keep-indices', default=1, help="number of previous indices to keep with --blue-green (default = 1)")
     parser.add_argument('--mapping', default="mappings/project.json", help="project elasticsearch mapping document")
+    parser.add_argument('--field-studies', metavar='FIELD_STUDIES_OUT', help="also build the field-study documents from the project descriptions, into this bulk file")
+    parser.add_argument('--field-study-mapping', default="mappings/field-study.json", help="field study elasticsearch mapping document")
+    parser.add_argument('--field-study-manifest', help="hash manifest of the previously published field-study documents")
     parser.add_argument('--sparql', default='http://deepcarbon.tw.rpi.edu:3030/VIVO/query', help='sparql endpoint')
+    add_sparql_arguments(parser)
+    add_adaptive_arguments(parser)
+    add_reference_arguments(parser)
+    add_slim_arguments(parser)
+    add_checkpoint_arguments(parser, resume=False)
+    add_memo_arguments(parser)
     parser.add_argument('out', metavar='OUT', help='elasticsearch bulk ingest file')
 
     args = parser.parse_args()
+    configure_sparql(args)
+    configure_adaptive(args, int(args.threads))
+    configure_references(args, args.sparql)
+    configure_slim(args)
+    configure_memo(args)
+
+    # entities whose documents fail are written to the retry list; while it names any, the manifest deletes nothing
+    retry = retry_list(args, args.out)
+
+    # generate bulk import document for projects, and for field studies with --field-studies
+    if args.field_studies:
+        records = generate_with_field_studies(threads=int(args.threads), sparql=args.sparql, field_studies_out=args.field_studies, batch_size=int(args.batch_size), retry=retry)
+    else:
+        records = generate(threads=int(args.threads), sparql=args.sparql, batch_size=int(args.batch_size), retry=retry)
 
-    # generate bulk import document for projects
-    records = generate(threads=int(args.threads), sparql=args.sparql)
-
-    # save generated bulk import file so it can be backed up or reviewed if there are publish errors
+    # save generated bulk import file so it can be backed up or reviewed if there are publish errors; the records are
+    # written, and published, as the workers return them instead of being collected first
     with open(args.out, "w") as bulk_file:
-        bulk_file.write('\n'.join(records)+'\n')
-
-    # publish the results to elasticsearch if "--publish" was specified on the command line
-    if args.publish:
-        bulk_str = '\n'.join(records)+'\n'
-        publish(bulk=bulk_str, endpoint=args.es, rebuild=args.rebuild, mapping=args.mapping)
+        records = write_bulk_lines(records, bulk_file)
+
+        # publish the results to elasticsearch if "--publish" was specified on the command line
+        if args.publish:
+            publish(bulk=records, endpoint=args.es, rebuild=args.rebuild, mapping=args.mapping,
+                    blue_green=args.blue_green, keep=int(args.keep_indices), manifest=args.manifest, retry=retry)
+        else:
+            collections.deque(records, maxlen=0)
+
+    # the field-study bulk file is complete once the project records have been consumed
+    if args.publish and args.field_studies:
+        # the index has been rebuilt by the projects already
+        with open(args.field_studies) as bulk_file:
+            publish(bulk=bulk_file, endpoint=args.es, rebuild=False, mapping=args.field_study_mapping,
+                    blue_green=args.blue_green, keep=int(args.keep_indices), manifest=args.field_study_manifest, retry=retry,
+                    es_type="field-study")
 
 
 ########################################
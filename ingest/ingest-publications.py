@@ -1,10 +1,24 @@
 __author__ = 'szednik'
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+from sparqlClient import get_client, add_sparql_arguments, configure_sparql
+from adaptiveLimiter import add_adaptive_arguments, configure_adaptive
+from referenceStore import add_reference_arguments, configure_references, trim_describe, reference_predicates
+from describeProfile import add_slim_arguments, configure_slim, slim_describe
+from checkpointJournal import Isolated, add_checkpoint_arguments, retry_list
+from bulkPublisher import BulkPublisher, split_bulk
+from bulkDiff import BulkDiff
+from graphView import GraphView, Node
+from ingestHelpers import get_authorship_person, batches, bind_values, iter_entities, bounded_imap, write_bulk_lines
+from memoCache import add_memo_arguments, configure_memo
+from selectExtraction import Bindings, select_bindings, add_select_arguments, configure_select, \
+    settings as select_settings
+from esHelpers import publish_blue_green, check_not_alias
 import json
+import collections
 from rdflib import Namespace, RDF
 import multiprocessing
 import itertools
+import functools
 import argparse
 import requests
 import warnings
@@ -17,6 +31,13 @@ def load_file(filepath):
 
 get_publications_query = load_file("queries/listPublications.rq")
 describe_publication_query = load_file("queries/describePublication.rq")
+# the SELECT queries of --select, see selectExtraction.py
+publication_info_query = load_file("queries/getPublicationInfo.rq")
+publication_authors_query = load_file("queries/getPublicationAuthors.rq")
+# variables of the describe query bound to reference entities, left out with --references
+reference_variables = ["?mostSpecificType", "?subjectArea", "?community", "?team", "?researchArea", "?org"]
+# the predicates to the reference entities, which GraphView completes from the store
+reference_links = reference_predicates(describe_publication_query, reference_variables)
 
 PROV = Namespace("http://www.w3.org/ns/prov#")
 BIBO = Namespace("http://purl.org/ontology/bibo/")
@@ -40,29 +61,20 @@ def get_id(dco_id):
 
 
 def select(endpoint, query):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    return results["results"]["bindings"]
+    return get_client(endpoint).select_iter(query)
 
 
 def describe(endpoint, query):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    try:
-        return sparql.query().convert()
-    except RuntimeWarning:
-        pass
+    graph = get_client(endpoint).describe(query)
+    return GraphView(graph, reference_links) if graph is not None else None
 
 
 def get_publications(endpoint):
-    r = select(endpoint, get_publications_query)
-    return [rs["publication"]["value"] for rs in r]
+    return iter_entities(endpoint, get_publications_query, "?publication")
 
 
-def process_publication(publication, endpoint):
-    pub = create_publication_doc(publication=publication, endpoint=endpoint)
+def process_publication(publication, endpoint, graph=None):
+    pub = create_publication_doc(publication=publication, endpoint=endpoint, graph=graph)
     if "dcoId" in pub and pub["dcoId"] is not None:
         return [json.dumps(get_metadata(get_id(pub["dcoId"]))), json.dumps(pub)]
     else:
@@ -70,12 +82,24 @@ def process_publication(publication, endpoint):
 
 
 def describe_publication(endpoint, publication):
-    q = describe_publication_query.replace("?publication", "<" + publication + ">")
+    q = slim_describe(trim_describe(describe_publication_query, reference_variables), _type).replace("?publication", "<" + publication + ">")
+    return describe(endpoint, q)
+
+
+def describe_publications(endpoint, publications):
+    q = bind_values(slim_describe(trim_describe(describe_publication_query, reference_variables), _type), "?publication", publications)
     return describe(endpoint, q)
 
 
-def create_publication_doc(publication, endpoint):
-    graph = describe_publication(endpoint=endpoint, publication=publication)
+# process_publications: describe a batch of publications with one query and build each document from the combined graph
+def process_publications(publications, endpoint):
+    graph = describe_publications(endpoint=endpoint, publications=publications)
+    return list(itertools.chain.from_iterable(process_publication(publication, endpoint, graph) for publication in publications))
+
+
+def create_publication_doc(publication, endpoint, graph=None):
+    if graph is None:
+        graph = describe_publication(endpoint=endpoint, publication=publication)
 
     pub = graph.resource(publication)
 
@@ -175,30 +199,122 @@ def create_publication_doc(publication, endpoint):
         doc.update({"subjectArea": subject_areas})
 
     authors = []
-    authorships = [faux for faux in pub.objects(VIVO.relatedBy) if has_type(faux, VIVO.Authorship)]
+    authorships = pub.objects_of_type(VIVO.relatedBy, VIVO.Authorship)
     for authorship in authorships:
 
-        author = [person for person in authorship.objects(VIVO.relates) if has_type(person, FOAF.Person)][0]
-        name = author.label().toPython() if author else None
-
-        obj = {"uri": str(author.identifier), "name": name}
-
         rank = list(authorship.objects(VIVO.rank))
         rank = rank[0].toPython() if rank else None
-        if rank:
-            obj.update({"rank": rank})
 
-        research_areas = [research_area.label().toPython() for research_area in author.objects(VIVO.hasResearchArea) if research_area.label()]
+        # the person part of the author is built once per worker, see memoCache.py
+        authors.append(get_authorship_person(authorship, rank, "publication authors"))
+
+    try:
+        authors = sorted(authors, key=lambda a: a["rank"]) if len(authors) > 1 else authors
+    except KeyError:
+        print("missing rank for one or more authors of:", publication)
+
+    doc.update({"authors": authors})
+
+    return doc
+
+
+def process_publication_page(publications, endpoint):
+    info = select_bindings(endpoint, publication_info_query, "?publication", publications)
+    authors = select_bindings(endpoint, publication_authors_query, "?publication", publications)
+    records = []
+    for publication in publications:
+        pub = create_publication_doc_from_bindings(publication, info.get(publication, Bindings()),
+                                                   authors.get(publication, Bindings()))
+        if "dcoId" in pub and pub["dcoId"] is not None:
+            records.extend([json.dumps(get_metadata(get_id(pub["dcoId"]))), json.dumps(pub)])
+    return records
+
+
+# create_publication_doc_from_bindings: the document of create_publication_doc, assembled from the rows of
+# getPublicationInfo.rq and getPublicationAuthors.rq of the publication instead of its described graph
+def create_publication_doc_from_bindings(publication, info, authorships):
+    title = info.first("title")
+    if title is None:
+        print("missing title:", publication)
+        return {}
+    title = title.toPython()
+
+    dco_id = info.first("dcoId")
+    dco_id = str(dco_id.toPython()) if dco_id is not None else None
+
+    is_dco_publication = info.first("isDcoPublication")
+    is_dco_publication_str = is_dco_publication.toPython() if is_dco_publication is not None else ""
+    is_dco_publication = True if is_dco_publication_str.lower() == "yes" or is_dco_publication_str.lower() == "true" else False
+
+    doc = {"uri": publication, "title": title, "dcoId": dco_id, "isDcoPublication": is_dco_publication}
+
+    for field in ["doi", "volume", "issue", "pageStart", "pageEnd", "abstract"]:
+        value = info.first(field)
+        value = value.toPython() if value is not None else None
+        if value:
+            doc.update({field: value})
+
+    most_specific_type = info.first("mostSpecificType")
+    if most_specific_type:
+        doc.update({"mostSpecificType": most_specific_type.toPython()})
+
+    publication_year = info.first("publicationYear")
+    if publication_year:
+        doc.update({"publicationYear": str(publication_year)})
+
+    for variable, field, missing in [("community", "community", "community label missing:"),
+                                     ("team", "team", "team label missing:"),
+                                     ("event", "presentedAt", "event missing label:"),
+                                     ("venue", "publishedIn", "venue missing label:")]:
+        for entity, bindings in itertools.islice(info.group(variable).items(), 1):
+            name = bindings.first(variable + "Name")
+            if name:
+                doc.update({field: {"uri": str(entity), "name": name.toPython()}})
+            else:
+                print(missing, str(entity))
+
+    subject_areas = []
+    for subject_area, bindings in info.group("subjectArea").items():
+        sa = {"uri": str(subject_area)}
+        name = bindings.first("subjectAreaName")
+        if name:
+            sa.update({"name": name.toPython()})
+        subject_areas.append(sa)
 
+    if subject_areas:
+        doc.update({"subjectArea": subject_areas})
+
+    authors = []
+    for authorship, bindings in authorships.group("authorship").items():
+
+        rank = bindings.first("rank")
+        rank = rank.toPython() if rank is not None else None
+
+        person, person_bindings = next(iter(bindings.group("author").items()))
+        author = {"uri": str(person)}
+        name = person_bindings.first("name")
+        if name:
+            author.update({"name": name.toPython()})
+        else:
+            print("author missing label:", str(person))
+        if rank:
+            author.update({"rank": rank})
+
+        research_areas = [research_area.first("researchAreaName").toPython()
+                          for research_area in person_bindings.group("researchArea").values()
+                          if research_area.first("researchAreaName")]
         if research_areas:
-            obj.update({"researchArea": research_areas})
+            author.update({"researchArea": research_areas})
 
-        positions = [orgfaux for orgfaux in author.objects(VIVO.relatedBy) if has_type(orgfaux, VIVO.Position)]
-        for position in positions:
-            org = [organization for organization in position.objects(VIVO.relates) if has_type(organization, FOAF.Organization)][0]
-            obj.update({"organization": {"uri": str(org.identifier), "name": org.label().toPython()}})
+        for position in person_bindings.group("orgrole").values():
+            org, org_bindings = next(iter(position.group("org").items()))
+            org_name = org_bindings.first("orgName")
+            if org_name:
+                author.update({"organization": {"uri": str(org), "name": org_name.toPython()}})
+            else:
+                print("organization missing label:", str(org))
 
-        authors.append(obj)
+        authors.append(author)
 
     try:
         authors = sorted(authors, key=lambda a: a["rank"]) if len(authors) > 1 else authors
@@ -211,13 +327,27 @@ def create_publication_doc(publication, endpoint):
 
 
 def has_type(resource, type):
-    for rtype in resource.objects(RDF.type):
-        if str(rtype.identifier) == str(type):
-            return True
-    return False
+    return isinstance(resource, Node) and type in resource.types
+
 
+def publish(bulk, endpoint, rebuild, mapping, blue_green=False, keep=1, manifest=None, retry=None):
+    # with a manifest, only send the documents that changed since the previous run (everything to a fresh index)
+    actions = split_bulk(bulk)
+    diff = None
+    if manifest:
+        diff = BulkDiff(manifest, _index, _type)
+        actions = diff.diff(actions, full=blue_green or rebuild, retry=retry)
+
+    # blue/green: load a fresh index for this type and move the alias to it once it is complete
+    if blue_green:
+        publisher = publish_blue_green(endpoint, _index, _type, mapping, actions, keep=keep)
+        if diff is not None:
+            diff.commit(publisher)
+        return
+
+    # once types are published blue/green, dco is an alias that cannot be indexed into (or rebuilt) directly
+    check_not_alias(endpoint, _index)
 
-def publish(bulk, endpoint, rebuild, mapping):
     # if configured to rebuild_index
     # Delete and then re-create to publication index (via PUT request)
 
@@ -246,41 +376,79 @@ def publish(bulk, endpoint, rebuild, mapping):
                 print(r.url, r.status_code)
                 r.raise_for_status()
 
-    # bulk import new publication documents
-    bulk_import_url = endpoint + "/_bulk"
-    r = requests.post(bulk_import_url, data=bulk)
-    if r.status_code != requests.codes.ok:
-        print(r.url, r.status_code)
-        r.raise_for_status()
-
-
-def generate(threads, sparql):
-    pool = multiprocessing.Pool(threads)
-    params = [(publication, sparql) for publication in get_publications(endpoint=sparql)]
-    return list(itertools.chain.from_iterable(pool.starmap(process_publication, params)))
+    # bulk import new publication documents in chunks, retrying items rejected by elasticsearch
+    publisher = BulkPublisher(endpoint)
+    publisher.publish(actions)
+    publisher.report()
+    if diff is not None:
+        diff.commit(publisher)
+
+
+
+# generate: starts the ingest process; a generator over the bulk lines, in listing order
+def generate(threads, sparql, batch_size=1, retry=None):
+    with multiprocessing.Pool(threads) as pool:
+        publications = get_publications(endpoint=sparql)
+        # the workers start on the first page of the listing while the next pages are fetched; at most two batches
+        # per worker are pending, so the records never pile up faster than the bulk file is written
+        if select_settings["select"]:
+            # a page of publications per task, built from two SELECT result sets, see selectExtraction.py
+            process = functools.partial(Isolated(process_publication_page, retry, batched=True), endpoint=sparql)
+            publication_batches = batches(publications, select_settings["page_size"])
+        else:
+            process = functools.partial(Isolated(process_publications, retry, batched=True), endpoint=sparql)
+            publication_batches = batches(publications, batch_size)
+        for records in bounded_imap(pool, process, publication_batches, 2 * threads):
+            yield from records
+        # let the workers exit on their own, so they report their memo statistics
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--threads', default=8, help='number of threads to use (default = 8)')
+    parser.add_argument('--batch-size', default=50, help='number of publications to describe per SPARQL query (default = 50)')
     parser.add_argument('--es', default="http://data.deepcarbon.net/es", help="elasticsearch service URL")
     parser.add_argument('--publish', default=False, action="store_true", help="publish to elasticsearch?")
     parser.add_argument('--rebuild', default=False, action="store_true", help="rebuild elasticsearch index?")
+    parser.add_argument('--blue-green', default=False, action="store_true", help="publish into a fresh index and swap the alias to it when complete")
+    parser.add_argument('--manifest', help="hash manifest of the previously published documents; only new, changed and deleted documents are published")
+    parser.add_argument('--keep-indices', default=1, help="number of previous indices to keep with --blue-green (default = 1)")
     parser.add_argument('--mapping', default="mappings/publication.json", help="publication elasticsearch mapping document")
     parser.add_argument('--sparql', default='http://deepcarbon.tw.rpi.edu:3030/VIVO/query', help='sparql endpoint')
+    add_sparql_arguments(parser)
+    add_adaptive_arguments(parser)
+    add_reference_arguments(parser)
+    add_slim_arguments(parser)
+    add_checkpoint_arguments(parser, resume=False)
+    add_memo_arguments(parser)
+    add_select_arguments(parser)
     parser.add_argument('out', metavar='OUT', help='elasticsearch bulk ingest file')
 
     args = parser.parse_args()
+    configure_sparql(args)
+    configure_adaptive(args, int(args.threads))
+    configure_references(args, args.sparql)
+    configure_slim(args)
+    configure_memo(args)
+    configure_select(args)
+
+    # entities whose documents fail are written to the retry list; while it names any, the manifest deletes nothing
+    retry = retry_list(args, args.out)
 
     # generate bulk import document for publications
-    records = generate(threads=int(args.threads), sparql=args.sparql)
+    records = generate(threads=int(args.threads), sparql=args.sparql, batch_size=int(args.batch_size), retry=retry)
 
-    # save generated bulk import file so it can be backed up or reviewed if there are publish errors
+    # save generated bulk import file so it can be backed up or reviewed if there are publish errors; the records are
+    # written, and published, as the workers return them instead of being collected first
     with open(args.out, "w") as bulk_file:
-        bulk_file.write('\n'.join(records)+'\n')
-
-    # publish the results to elasticsearch if "--publish" was specified on the command line
-    if args.publish:
-        bulk_str = '\n'.join(records)+'\n'
-        publish(bulk=bulk_str, endpoint=args.es, rebuild=args.rebuild, mapping=args.mapping)
+        records = write_bulk_lines(records, bulk_file)
+
+        # publish the results to elasticsearch if "--publish" was specified on the command line
+        if args.publish:
+            publish(bulk=records, endpoint=args.es, rebuild=args.rebuild, mapping=args.mapping,
+                    blue_green=args.blue_green, keep=int(args.keep_indices), manifest=args.manifest, retry=retry)
+        else:
+            collections.deque(records, maxlen=0)
@@ -1,11 +1,23 @@
 __author__ = 'szednik'
 #Edited by Ahmed (am-e) to ingest sample repositories
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+from sparqlClient import get_client, add_sparql_arguments, configure_sparql
+from adaptiveLimiter import add_adaptive_arguments, configure_adaptive
+from ingestHelpers import batches, bind_values, iter_entities, bounded_imap, write_bulk_lines
+from referenceStore import add_reference_arguments, configure_references, trim_describe, reference_predicates
+from describeProfile import add_slim_arguments, configure_slim, slim_describe
+from checkpointJournal import Isolated, add_checkpoint_arguments, retry_list
+from bulkPublisher import BulkPublisher, split_bulk
+from bulkDiff import BulkDiff
+from graphView import GraphView, Node
+from documentSpec import DocumentSpec
+from esHelpers import publish_blue_green, check_not_alias
 import json
+import collections
 from rdflib import Namespace, RDF
 import multiprocessing
 import itertools
+import functools
 from itertools import chain
 import argparse
 import requests
@@ -13,59 +25,6 @@ import warnings
 import pprint
 
 
-class Maybe:
-    def __init__(self, v=None):
-        self.value = v
-
-    @staticmethod
-    def nothing():
-        return Maybe()
-
-    @staticmethod
-    def of(t):
-        return Maybe(t)
-
-    def reduce(self, action):
-        return Maybe.of(functools.reduce(action, self.value)) if self.value else Maybe.nothing()
-
-    def stream(self):
-        return Maybe.of([self.value]) if self.value is not None else Maybe.nothing()
-
-    def map(self, action):
-        return Maybe.of(chain(map(action, self.value))) if self.value is not None else Maybe.nothing()
-
-    def flatmap(self, action):
-        return Maybe.of(chain.from_iterable(map(action, self.value))) if self.value is not None else Maybe.nothing()
-
-    def andThen(self, action):
-        return Maybe.of(action(self.value)) if self.value is not None else Maybe.nothing()
-
-    def orElse(self, action):
-        return Maybe.of(action()) if self.value is None else Maybe.of(self.value)
-
-    def do(self, action):
-        if self.value:
-            action(self.value)
-        return self
-
-    def filter(self, action):
-        return Maybe.of(filter(action, self.value)) if self.value is not None else Maybe.nothing()
-
-    def followedBy(self, action):
-        return self.andThen(lambda _: action)
-
-    def one(self):
-        try:
-            return Maybe.of(next(self.value)) if self.value is not None else Maybe.nothing()
-        except StopIteration:
-            return Maybe.nothing()
-        except TypeError:
-            return self
-
-    def list(self):
-        return list(self.value) if self.value is not None else []
-
-
 def load_file(filepath):
     with open(filepath) as _file:
         return _file.read().replace('\n', " ")
@@ -74,6 +33,11 @@ def load_file(filepath):
 # Global variables for the ingest process for: ***sample_repository***
 get_sample_repositories_query = load_file("queries/listSampleRepositories.rq")
 describe_sample_repository_query = load_file("queries/describeSampleRepository.rq")
+# variables of the describe query bound to reference entities, left out with --references
+reference_variables = ["?mostSpecificType", "?community"]
+# the predicates to the reference entities, which GraphView completes from the store
+reference_links = reference_predicates(describe_sample_repository_query, reference_variables)
+sample_repository_spec = DocumentSpec("specs/sample-repository.json")
 
 PROV = Namespace("http://www.w3.org/ns/prov#")
 BIBO = Namespace("http://purl.org/ontology/bibo/")
@@ -99,30 +63,21 @@ def get_id(dco_id):
 
 # select: run the supplied SPARQL SELECT query
 def select(endpoint, query):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    return results["results"]["bindings"]
+    return get_client(endpoint).select_iter(query)
 
 # describe: run the supplied SPARQL DESCRIBE query
 def describe(endpoint, query):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    try:
-        return sparql.query().convert()
-    except RuntimeWarning:
-        pass
-
-# get_sample_repositories: run the sample_repositories SELECT query and return the result set
+    graph = get_client(endpoint).describe(query)
+    return GraphView(graph, reference_links) if graph is not None else None
+
+# get_sample_repositories: list the sample_repositories page by page, see ingestHelpers.iter_entities
 def get_sample_repositories(endpoint):
-    r = select(endpoint, get_sample_repositories_query)
-    return [rs["sampleRepository"]["value"] for rs in r]
+    return iter_entities(endpoint, get_sample_repositories_query, "?sampleRepository")
 
 
-# process_sample_repository: used by generate
-def process_sample_repository(sample_repository, endpoint):
-    repo = create_sample_repository_doc(sample_repository=sample_repository, endpoint=endpoint)
+# process_sample_repository: used by process_sample_repositories
+def process_sample_repository(sample_repository, endpoint, graph=None):
+    repo = create_sample_repository_doc(sample_repository=sample_repository, endpoint=endpoint, graph=graph)
     if "dcoId" in repo and repo["dcoId"] is not None:
         return [json.dumps(get_metadata(get_id(repo["dcoId"]))), json.dumps(repo)]
     else:
@@ -131,100 +86,50 @@ def process_sample_repository(sample_repository, endpoint):
 # describe_sample_repository: used by create_projcet_doc
 # change the "?sample_repository" variable to whatever variable name you use in the listXXX.rq file
 def describe_sample_repository(endpoint, sample_repository):
-    q = describe_sample_repository_query.replace("?sampleRepository", "<" + sample_repository + ">")
+    q = slim_describe(trim_describe(describe_sample_repository_query, reference_variables), "sample-repository").replace("?sampleRepository", "<" + sample_repository + ">")
     return describe(endpoint, q)
 
-def get_thumbnail(sample_repository):
-    return Maybe.of(sample_repository).stream() \
-        .flatmap(lambda p: p.objects(VITRO_PUB.mainImage)) \
-        .flatmap(lambda i: i.objects(VITRO_PUB.thumbnailImage)) \
-        .flatmap(lambda t: t.objects(VITRO_PUB.downloadLocation)) \
-        .map(lambda t: t.identifier) \
-        .one().value
-
-# create_sample_repository_doc: used by process_sample_repository
-# creates a document to insert into elasticsearch based on the mapping in mappings/sample-repository.json
-def create_sample_repository_doc(sample_repository, endpoint):
-    graph = describe_sample_repository(endpoint=endpoint, sample_repository=sample_repository)
-
-    repo = graph.resource(sample_repository)
-
-    try:
-        title = repo.label().toPython()
-    except AttributeError:
-        print("missing title:", sample_repository)
-        return {}
-
-    #dcoId of this sample_repository
-    dco_id = list(repo.objects(DCO.hasDcoId))
-    dco_id = str(dco_id[0].label().toPython()) if dco_id else None
-
-    doc = {"uri": sample_repository, "title": title, "dcoId": dco_id}
-
-    #type of this sample_repository
-    most_specific_type = list(repo.objects(VITRO.mostSpecificType))
-    most_specific_type = most_specific_type[0].label().toPython() \
-        if most_specific_type and most_specific_type[0].label() \
-        else None
-    if most_specific_type:
-        doc.update({"mostSpecificType": most_specific_type})
-
-    #description(s) of this sample_repository
-    description = ''
-    repository_descriptions = list(repo.objects(VIVO.description))
-
-    if repository_descriptions:
-        for repository_description in repository_descriptions:
-            description += ' ' + repository_description if repository_description else ''
-
-    doc.update({"description": description})
-
-    #dcoCommunities associated with this sample_repository
-    associatedCommunities = []
-    communities = [faux for faux in repo.objects(DCO.associatedDCOCommunity) if has_type(faux, DCO.ResearchCommunity)]
-
-    if communities:
-        for community in communities:
-            # print(community)
-            name = community.label().toPython() if community else None
-
-            obj = {"uri": str(community.identifier), "name": name}
-
-            associatedCommunities.append(obj)
-
-    doc.update({"dcoCommunities": associatedCommunities})
-
-    #online catalog for this sample repository
-    online_catalog = list(repo.objects(DCO.repositoryOnlineCatalog))
-    online_catalog = online_catalog[0] if online_catalog else None
-    doc.update({"onlineCatalog": online_catalog})
-
-    #website for this sample repository
-    website = list(repo.objects(DCO.repositoryWebsite))
-    website = website[0] if website else None
-    doc.update({"website": website})
-
-    #sample curation practice for this sample repository
-    sample_curation_practice = list(repo.objects(DCOSAMPLE.sampleCurationPractice))
-    sample_curation_practice = sample_curation_practice[0] if sample_curation_practice else None
-    doc.update({"sampleCurationPractice": sample_curation_practice})
+# describe_sample_repositories: describe a batch of sample repositories with one query, the subject variable bound with a VALUES block
+def describe_sample_repositories(endpoint, sample_repositories):
+    q = bind_values(slim_describe(trim_describe(describe_sample_repository_query, reference_variables), "sample-repository"), "?sampleRepository", sample_repositories)
+    return describe(endpoint, q)
 
-    #thumbnail for this sample repository if found
-    thumbnail = get_thumbnail(repo)
-    if thumbnail:
-        doc.update({"thumbnail": thumbnail})
+# process_sample_repositories: used by generate
+# describes a batch of sample repositories with one query and builds each document from the combined graph
+def process_sample_repositories(sample_repositories, endpoint):
+    graph = describe_sample_repositories(endpoint=endpoint, sample_repositories=sample_repositories)
+    return list(chain.from_iterable(process_sample_repository(sample_repository, endpoint, graph) for sample_repository in sample_repositories))
 
-    return doc
+# create_sample_repository_doc: used by process_sample_repository
+# creates a document to insert into elasticsearch with the fields declared in specs/sample-repository.json
+def create_sample_repository_doc(sample_repository, endpoint, graph=None):
+    if graph is None:
+        graph = describe_sample_repository(endpoint=endpoint, sample_repository=sample_repository)
+    return sample_repository_spec.build(graph.resource(sample_repository))
 
 # has_type: asserts whether a resource if of a certain type
 def has_type(resource, type):
-    for rtype in resource.objects(RDF.type):
-        if str(rtype.identifier) == str(type):
-            return True
-    return False
+    return isinstance(resource, Node) and type in resource.types
 
 # publish: publishes extracted data to elasticsearch node
-def publish(bulk, endpoint, rebuild, mapping):
+def publish(bulk, endpoint, rebuild, mapping, blue_green=False, keep=1, manifest=None, retry=None):
+    # with a manifest, only send the documents that changed since the previous run (everything to a fresh index)
+    actions = split_bulk(bulk)
+    diff = None
+    if manifest:
+        diff = BulkDiff(manifest, "dco", "sample-repository")
+        actions = diff.diff(actions, full=blue_green or rebuild, retry=retry)
+
+    # blue/green: load a fresh index for this type and move the alias to it once it is complete
+    if blue_green:
+        publisher = publish_blue_green(endpoint, "dco", "sample-repository", mapping, actions, keep=keep)
+        if diff is not None:
+            diff.commit(publisher)
+        return
+
+    # once types are published blue/green, dco is an alias that cannot be indexed into (or rebuilt) directly
+    check_not_alias(endpoint, "dco")
+
     # if configured to rebuild_index
     # Delete and then re-create to sample_repository index (via PUT request)
 
@@ -253,44 +158,70 @@ def publish(bulk, endpoint, rebuild, mapping):
                 print(r.url, r.status_code)
                 r.raise_for_status()
 
-    # bulk import new sample_repository documents
-    bulk_import_url = endpoint + "/_bulk"
-    r = requests.post(bulk_import_url, data=bulk)
-    if r.status_code != requests.codes.ok:
-        print(r.url, r.status_code)
-        r.raise_for_status()
+    # bulk import new sample_repository documents in chunks, retrying items rejected by elasticsearch
+    publisher = BulkPublisher(endpoint)
+    publisher.publish(actions)
+    publisher.report()
+    if diff is not None:
+        diff.commit(publisher)
+
 
-# generate: startes the ingest process
-def generate(threads, sparql):
-    pool = multiprocessing.Pool(threads)
-    params = [(sample_repository, sparql) for sample_repository in get_sample_repositories(endpoint=sparql)]
-    return list(itertools.chain.from_iterable(pool.starmap(process_sample_repository, params)))
+# generate: startes the ingest process; a generator over the bulk lines, in listing order
+def generate(threads, sparql, batch_size=1, retry=None):
+    with multiprocessing.Pool(threads) as pool:
+        # the workers start on the first page of the listing while the next pages are fetched; at most two batches
+        # per worker are pending, so the records never pile up faster than the bulk file is written
+        process = functools.partial(Isolated(process_sample_repositories, retry, batched=True), endpoint=sparql)
+        for records in bounded_imap(pool, process, batches(get_sample_repositories(endpoint=sparql), batch_size), 2 * threads):
+            yield from records
+        # let the workers exit on their own, so they report their memo statistics
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--threads', default=2, help='number of threads to use (default = 8)')
+    parser.add_argument('--batch-size', default=50, help='number of sample repositories to describe per SPARQL query (default = 50)')
     parser.add_argument('--es', default="http://localhost:9200", help="elasticsearch service URL")
     parser.add_argument('--publish', default=False, action="store_true", help="publish to elasticsearch?")
     parser.add_argument('--rebuild', default=False, action="store_true", help="rebuild elasticsearch index?")
+    parser.add_argument('--blue-green', default=False, action="store_true", help="publish into a fresh index and swap the alias to it when complete")
+    parser.add_argument('--manifest', help="hash manifest of the previously published documents; only new, changed and deleted documents are published")
+    parser.add_argument('--keep-indices', default=1, help="number of previous indices to keep with --blue-green (default = 1)")
     parser.add_argument('--mapping', default="mappings/sample-repository.json", help="sample-repository elasticsearch mapping document")
     parser.add_argument('--sparql', default='http://deepcarbon.tw.rpi.edu:3030/VIVO/query', help='sparql endpoint')
+    add_sparql_arguments(parser)
+    add_adaptive_arguments(parser)
+    add_reference_arguments(parser)
+    add_slim_arguments(parser)
+    add_checkpoint_arguments(parser, resume=False)
     parser.add_argument('out', metavar='OUT', help='elasticsearch bulk ingest file')
 
     args = parser.parse_args()
+    configure_sparql(args)
+    configure_adaptive(args, int(args.threads))
+    configure_references(args, args.sparql)
+    configure_slim(args)
+
+    # entities whose documents fail are written to the retry list; while it names any, the manifest deletes nothing
+    retry = retry_list(args, args.out)
 
     # generate bulk import document for sample_repositories
-    records = generate(threads=int(args.threads), sparql=args.sparql)
+    records = generate(threads=int(args.threads), sparql=args.sparql, batch_size=int(args.batch_size), retry=retry)
 
-    # save generated bulk import file so it can be backed up or reviewed if there are publish errors
+    # save generated bulk import file so it can be backed up or reviewed if there are publish errors; the records are
+    # written, and published, as the workers return them instead of being collected first
     with open(args.out, "w") as bulk_file:
-        bulk_file.write('\n'.join(records)+'\n')
-
-    # publish the results to elasticsearch if "--publish" was specified on the command line
-    if args.publish:
-        bulk_str = '\n'.join(records)+'\n'
-        publish(bulk=bulk_str, endpoint=args.es, rebuild=args.rebuild, mapping=args.mapping)
+        records = write_bulk_lines(records, bulk_file)
+
+        # publish the results to elasticsearch if "--publish" was specified on the command line
+        if args.publish:
+            publish(bulk=records, endpoint=args.es, rebuild=args.rebuild, mapping=args.mapping,
+                    blue_green=args.blue_green, keep=int(args.keep_indices), manifest=args.manifest, retry=retry)
+        else:
+            collections.deque(records, maxlen=0)
 
 
 ########################################
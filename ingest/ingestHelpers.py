@@ -3,8 +3,14 @@ __author__ = 'Hao'
 from rdflib import Namespace, RDF
 from itertools import chain
 import argparse
-from SPARQLWrapper import SPARQLWrapper, JSON
+import collections
+import itertools
+from sparqlClient import get_client, settings as sparql_settings
+from graphView import Node
+from propertyPath import PropertyPath
+from memoCache import memo
 import json
+import re
 
 from rdflib import Namespace, RDF
 PROV = Namespace("http://www.w3.org/ns/prov#")
@@ -45,27 +51,160 @@ def sparql_select(endpoint, query):
         a list of objects with its type and uri values, e.g.
             [{'dataset': {'value': 'http://...', 'type': 'uri'}}, ...]
     """
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    return results["results"]["bindings"]
+    return get_client(endpoint).select(query)
+
+def sparql_select_iter(endpoint, query, columns=None):
+    """
+    Helper function used to run a sparql select query whose result set may be large
+    :param endpoint:    SPARQL endpoint
+    :param query:       the SPARQL query to get the list of objects
+    :param columns:     the variables to keep in each binding, e.g. ["dataset"] (default = all)
+    :return:
+        a generator over the bindings as they are read off the response, in the form of sparql_select
+    """
+    return get_client(endpoint).select_iter(query, columns)
+
+def batches( items, size ):
+    """
+    Helper function to cut a list or stream of entities into consecutive batches.
+    :param items:       the iterable to split; consumed lazily, one batch at a time
+    :param size:        maximum number of items per batch (values below 1 are treated as 1)
+    :return:            a generator over lists
+    """
+    size = max( int( size ), 1 )
+    items = iter( items )
+    batch = list( itertools.islice( items, size ) )
+    while batch:
+        yield batch
+        batch = list( itertools.islice( items, size ) )
+
+def page_query( query, variable, after, size ):
+    """
+    Helper function to turn a listing query into the query of one page of its entities, in the order of their URIs.
+    Pages are keyed by the last URI of the previous page rather than by an OFFSET, so the endpoint never has to skip
+    over the entities of the previous pages.
+    :param query:       the listing query, "SELECT DISTINCT ?x WHERE { ... }" without solution modifiers
+    :param variable:    the entity variable, e.g. "?person"
+    :param after:       the last entity of the previous page, or None for the first page
+    :param size:        number of entities per page
+    :return:            the query of the page
+    """
+    end = query.rindex( "}" )
+    condition = "" if after is None else " FILTER( STR( %s ) > %s ) " % (variable, json.dumps( after ))
+    return query[:end] + condition + "}\nORDER BY STR( " + variable + " )\nLIMIT " + str( size ) + "\n"
+
+def iter_entities( endpoint, query, variable ):
+    """
+    Helper function to list the entities of a listing query page by page (see page_query), fetching the next page only
+    once the entities of the previous one have been consumed, so workers can start on the first page while the
+    listing continues.
+    :param endpoint:    SPARQL endpoint
+    :param query:       the listing query, e.g. the content of queries/listPeople.rq
+    :param variable:    the entity variable, e.g. "?person"
+    :return:            a generator over the entities' uri values
+    """
+    name = variable[1:]
+    size = sparql_settings["list_page_size"]
+    if size <= 0:
+        for rs in sparql_select_iter( endpoint, query, [name] ):
+            yield rs[name]["value"]
+        return
+
+    after = None
+    while True:
+        entities = [rs[name]["value"] for rs in sparql_select_iter( endpoint, page_query( query, variable, after, size ), [name] )]
+        yield from entities
+        if len( entities ) < size:
+            return
+        after = entities[-1]
+
+def bind_values( query, variable, uris ):
+    """
+    Helper function to turn a single-subject query into a batched one by binding the subject variable
+    with a VALUES block at the start of the WHERE clause.
+    :param query:       the SPARQL query, e.g. the content of queries/describeDataset.rq
+    :param variable:    the subject variable, e.g. "?dataset"
+    :param uris:        the URIs to bind the variable to
+    :return:            the query with a "VALUES ?x { <...> <...> }" block added
+    """
+    values = "VALUES " + variable + " { " + " ".join( "<" + uri + ">" for uri in uris ) + " } "
+    return re.sub( r'WHERE\s*\{', lambda m: m.group( 0 ) + " " + values, query, count=1, flags=re.IGNORECASE )
+
+def fingerprint_query( query, variable ):
+    """
+    Helper function to derive a change-detection query from a describe query: one aggregate SELECT that returns, for
+    every subject, the number and a hash of the triples of all the resources the describe query would return.
+    Blank node labels are left out of the hash, since they are not stable between loads of the same data.
+    :param query:       the DESCRIBE query, e.g. the content of queries/describeDataset.rq
+    :param variable:    the subject variable, e.g. "?dataset"
+    :return:            a query with the result variables `variable`, ?triples and ?hash
+    """
+    match = re.search( r'DESCRIBE\s+(.*?)\s*WHERE\s*\{', query, flags=re.IGNORECASE | re.DOTALL )
+    prologue, body = query[:match.start()], query[match.end():query.rindex( "}" )]
+    described = re.findall( r'[?$]\w+', match.group( 1 ) )
+
+    # one row per (subject, described resource): ?i selects which of the described variables ?node is bound to
+    node = "".join( "IF( ?i = %d, %s, " % (i, v) for i, v in enumerate( described ) ) + "?unbound" + ")" * len( described )
+    # every triple is hashed to a number and the numbers are summed, so the order of the triples does not matter
+    return prologue + """SELECT """ + variable + """ (COUNT(*) AS ?triples) (SUM(?h) AS ?hash)
+WHERE {
+  { SELECT DISTINCT """ + variable + """ ?node
+    WHERE {""" + body + """
+      VALUES ?i { """ + " ".join( str( i ) for i in range( len( described ) ) ) + """ }
+      BIND( """ + node + """ AS ?node )
+      FILTER( BOUND( ?node ) )
+    }
+  }
+  ?node ?p ?o
+  BIND( CONCAT( STR( ?node ), " ", STR( ?p ), " ", IF( isBlank( ?o ), "_:", STR( ?o ) ) ) AS ?triple )
+  BIND( <http://www.w3.org/2001/XMLSchema#integer>( CONCAT( "0", REPLACE( SHA1( ?triple ), "[a-f]", "" ) ) ) AS ?h )
+}
+GROUP BY """ + variable + "\n"
+
+def bounded_imap( pool, func, items, window, with_items=False ):
+    """
+    Helper function like multiprocessing.Pool.imap that keeps at most `window` tasks pending, so results never pile up
+    faster than the caller consumes them.
+    :param pool:        a multiprocessing.Pool
+    :param func:        the function to apply to each item
+    :param items:       iterable of arguments; consumed lazily
+    :param window:      maximum number of submitted but not yet returned tasks
+    :param with_items:  yield (item, result) pairs instead of the results
+    :return:            a generator over the results, in the order of the items
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append( (item, pool.apply_async( func, (item,) )) )
+        if len( pending ) >= window:
+            item, result = pending.popleft()
+            yield (item, result.get()) if with_items else result.get()
+    while pending:
+        item, result = pending.popleft()
+        yield (item, result.get()) if with_items else result.get()
+
+def write_bulk_lines( lines, bulk_file ):
+    """
+    Helper function for the function-style ingest scripts: pass bulk lines through while writing each of them to the
+    bulk file, so the file is written (and the documents published) as they are generated instead of at the end.
+    :param lines:       iterable of bulk lines, e.g. the result of generate()
+    :param bulk_file:   the bulk file, open for writing
+    :return:            a generator over the same lines
+    """
+    for line in lines:
+        bulk_file.write( line + '\n' )
+        yield line
 
 # describe: helper function for describe_entity
-def sparql_describe( endpoint, query ):
+def sparql_describe( endpoint, query, refresh=False ):
     """
     Helper function used to run a sparql describe query
     :param endpoint:    SPARQL endpoint
     :param query:       the describe query to run
+    :param refresh:     bypass the describe cache (the response is cached again)
     :return:
-        a json object representing the entity
+        an rdflib Graph describing the entity, or None if the response could not be parsed
     """
-    sparql = SPARQLWrapper( endpoint )
-    sparql.setQuery( query )
-    try:
-        return sparql.query().convert()
-    except RuntimeWarning:
-        pass
+    return get_client( endpoint ).describe( query, refresh )
 
 def get_id( es_id ):
     return dco_id[dco_id.rfind('/') + 1:]
@@ -84,74 +223,76 @@ def get_metadata( es_index, es_type, es_id ):
 #    Helper functions to get different attributes
 #
 def has_type(resource, type):
-    for rtype in resource.objects(RDF.type):
-        if str(rtype.identifier) == str(type):
-            return True
-    return False
+    return isinstance(resource, Node) and type in resource.types
 
 
 def get_id(dco_id):
     return dco_id[dco_id.rfind('/') + 1:]
 
 
+# labelled resources related to an entity, as [{"uri": ..., "name": ...}, ...]
+DCO_COMMUNITIES = PropertyPath("dco:associatedDCOCommunity")
+TEAMS = PropertyPath("dco:associatedDCOTeam")
+DATA_TYPES = PropertyPath("dco:hasDataType")
+WAS_QUOTED_FROM = PropertyPath("prov:wasQuotedFrom")
+RELATED_PROJECTS = PropertyPath("dco:relatedProject")
+
 def get_dco_communities(x):
-    return Maybe.of(x).stream() \
-        .flatmap(lambda p: p.objects(DCO.associatedDCOCommunity)) \
-        .filter(has_label) \
-        .map(lambda r: {"uri": str(r.identifier), "name": str(r.label())}).list()
+    return DCO_COMMUNITIES.labelled(x)
 
 def get_teams(x):
-    return Maybe.of(x).stream() \
-        .flatmap(lambda p: p.objects(DCO.associatedDCOTeam)) \
-        .filter(has_label) \
-        .map(lambda r: {"uri": str(r.identifier), "name": str(r.label())}).list()
+    return TEAMS.labelled(x)
 
 def get_data_types(x):
-    return Maybe.of(x).stream() \
-        .flatmap(lambda p: p.objects(DCO.hasDataType)) \
-        .filter(has_label) \
-        .map(lambda r: {"uri": str(r.identifier), "name": str(r.label())}).list()
+    return DATA_TYPES.labelled(x)
 
 def get_wasQuotedFrom(x):
-    return Maybe.of(x).stream() \
-        .flatmap(lambda p: p.objects(PROV.wasQuotedFrom)) \
-        .filter(has_label) \
-        .map(lambda r: {"uri": str(r.identifier), "name": str(r.label())}).list()
+    return WAS_QUOTED_FROM.labelled(x)
 
 def get_projects_of_dataset(x):
-    return Maybe.of(x).stream() \
-        .flatmap(lambda p: p.objects(DCO.relatedProject)) \
-        .filter(has_label) \
-        .map(lambda r: {"uri": str(r.identifier), "name": str(r.label())}).list()
+    return RELATED_PROJECTS.labelled(x)
+
+
+# get_person_summary: person -> the part of an author or creator sub-document that does not depend on the authorship
+def get_person_summary(person):
+    obj = {"uri": str(person.identifier), "name": person.label().toPython()}
+
+    research_areas = [research_area.label().toPython() for research_area in person.objects(VIVO.hasResearchArea) if research_area.label()]
+
+    if research_areas:
+        obj.update({"researchArea": research_areas})
+
+    positions = person.objects_of_type(VIVO.relatedBy, VIVO.Position)
+    for position in positions:
+        org = position.objects_of_type(VIVO.relates, FOAF.Organization)[0]
+        obj.update({"organization": {"uri": str(org.identifier), "name": org.label().toPython()}})
+
+    return obj
+
+# get_authorship_person: authorship -> the sub-document of the person it relates, with its rank;
+# the person part is built once per worker and shared by all their authorships, see memoCache.py.  Every type
+# names its own memo (e.g. "publication authors"): the describe query of a type, or its slim profile, fetches only
+# what that type needs of the person, so a worker shared by several types must not reuse another type's summaries
+def get_authorship_person(authorship, rank, people):
+    person = authorship.objects_of_type(VIVO.relates, FOAF.Person)[0]
+    summary = memo(people).get(person.identifier, get_person_summary, person)
 
+    obj = {"uri": summary["uri"], "name": summary["name"]}
+    if rank:
+        obj.update({"rank": rank})
+    obj.update(summary)
+    return obj
 
 # get_authors: object -> [authors] for objects such as: datasets, publications, ...
 def get_authors(ds):
     authors = []
-    authorships = [faux for faux in ds.objects(VIVO.relatedBy) if has_type(faux, DCODATA.Creator)]
+    authorships = ds.objects_of_type(VIVO.relatedBy, DCODATA.Creator)
     for authorship in authorships:
 
-        author = [person for person in authorship.objects(VIVO.relates) if has_type(person, FOAF.Person)][0]
-        name = author.label().toPython() if author else None
-
-        obj = {"uri": str(author.identifier), "name": name}
-
         rank = list(authorship.objects(VIVO.rank))
         rank = str(rank[0].toPython()) if rank else None # added the str()
-        if rank:
-            obj.update({"rank": rank})
-
-        research_areas = [research_area.label().toPython() for research_area in author.objects(VIVO.hasResearchArea) if research_area.label()]
-
-        if research_areas:
-            obj.update({"researchArea": research_areas})
-
-        positions = [orgfaux for orgfaux in author.objects(VIVO.relatedBy) if has_type(orgfaux, VIVO.Position)]
-        for position in positions:
-            org = [organization for organization in position.objects(VIVO.relates) if has_type(organization, FOAF.Organization)][0]
-            obj.update({"organization": {"uri": str(org.identifier), "name": org.label().toPython()}})
 
-        authors.append(obj)
+        authors.append(get_authorship_person(authorship, rank, "dataset creators"))
 
     try:
         authors = sorted(authors, key=lambda a: a["rank"]) if len(authors) > 1 else authors
@@ -162,30 +303,13 @@ def get_authors(ds):
 
 def get_creators(ds):
     creators = []
-    authorships = [faux for faux in ds.objects(VIVO.relatedBy) if has_type(faux, DCODATA.Creator)]
+    authorships = ds.objects_of_type(VIVO.relatedBy, DCODATA.Creator)
     for authorship in authorships:
 
-        creator = [person for person in authorship.objects(VIVO.relates) if has_type(person, FOAF.Person)][0]
-        name = creator.label().toPython() if creator else None
-
-        obj = {"uri": str(creator.identifier), "name": name}
-
         rank = list(authorship.objects(VIVO.rank))
         rank = str(rank[0].toPython()) if rank else None # added the str()
-        if rank:
-            obj.update({"rank": rank})
-
-        research_areas = [research_area.label().toPython() for research_area in creator.objects(VIVO.hasResearchArea) if research_area.label()]
-
-        if research_areas:
-            obj.update({"researchArea": research_areas})
-
-        positions = [orgfaux for orgfaux in creator.objects(VIVO.relatedBy) if has_type(orgfaux, VIVO.Position)]
-        for position in positions:
-            org = [organization for organization in position.objects(VIVO.relates) if has_type(organization, FOAF.Organization)][0]
-            obj.update({"organization": {"uri": str(org.identifier), "name": org.label().toPython()}})
 
-        creators.append(obj)
+        creators.append(get_authorship_person(authorship, rank, "dataset creators"))
 
     try:
         creators = sorted(creators, key=lambda a: a["rank"]) if len(creators) > 1 else creators
@@ -198,7 +322,7 @@ def get_creators(ds):
 # get_distributions: object -> [distributions] for objects such as: datasets, publications, ...
 def get_distributions(ds):
     distributions = []
-    distributionList = [faux for faux in ds.objects(DCAT.distribution) if has_type(faux, DCODATA.Distribution)]
+    distributionList = ds.objects_of_type(DCAT.distribution, DCODATA.Distribution)
     for distribution in distributionList:
 
         accessURL = list(distribution.objects(DCAT.accessURL))
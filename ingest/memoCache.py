@@ -0,0 +1,82 @@
+import collections
+import os
+from multiprocessing import util
+
+# memo settings shared by every process; set them (see configure_memo) before worker pools are forked
+settings = {"size": 10000}
+
+# the memos of this process by name, see memo()
+_memos = {}
+
+
+class MemoCache:
+    """
+    Bounded memo of the sub-documents that many documents share, keyed by URI, e.g. the person part of every
+    authorship of a prolific author, which is then built once per worker instead of once per publication.
+    Beyond `size` entries the least recently used ones are dropped.  Every worker process has its own memo and
+    reports its hits and misses when it exits.
+    """
+
+    def __init__( self, name, size=None ):
+        """
+        :param name:    what is memoized, for the report, e.g. "authors"
+        :param size:    maximum number of entries (default = settings["size"] when first used, 0 disables the memo)
+        """
+        self.name = name
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.pid = None
+
+    def get( self, key, build, *args ):
+        """
+        :param key:     the URI of the sub-document
+        :param build:   the function building the sub-document from `args` if it is not memoized; the sub-document
+                        is shared by every caller afterwards, so it must not be modified
+        :return:        the memoized or newly built sub-document
+        """
+        if self.pid != os.getpid():
+            # a forked worker starts counting on its own and reports when it exits
+            self.pid = os.getpid()
+            self.hits = self.misses = 0
+            if self.size is None:
+                self.size = settings["size"]
+            util.Finalize( None, self.report, exitpriority=10 )
+
+        value = self.entries.get( key )
+        if value is not None:
+            self.hits += 1
+            self.entries.move_to_end( key )
+            return value
+
+        self.misses += 1
+        value = build( *args )
+        if self.size > 0:
+            self.entries[key] = value
+            if len( self.entries ) > self.size:
+                self.entries.popitem( last=False )
+        return value
+
+    def report( self ):
+        if self.hits or self.misses:
+            print( "memo %s (pid %d): %d hits, %d misses, %.0f%% hit rate" % (
+                self.name, os.getpid(), self.hits, self.misses, 100.0 * self.hits / (self.hits + self.misses)) )
+
+
+def memo( name ):
+    """:return: the MemoCache of this process for `name`, created on first use"""
+    cache = _memos.get( name )
+    if cache is None:
+        cache = _memos[name] = MemoCache( name )
+    return cache
+
+
+def add_memo_arguments( parser ):
+    """Add the memo command line options to an argparse parser."""
+    parser.add_argument( '--memo-size', default=settings["size"], type=int, help='number of shared sub-documents (authors, participants) memoized per worker; 0 disables the memo (default = %(default)s)' )
+
+
+def configure_memo( args ):
+    """Apply the options added by add_memo_arguments to every memo created afterwards."""
+    settings["size"] = args.memo_size
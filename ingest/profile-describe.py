@@ -0,0 +1,158 @@
+"""
+Records which predicates of which resources the document builders read over a sample of entities, and writes a
+profile per document type (profiles/<type>.json) from which the ingest scripts derive, with --slim, a CONSTRUCT
+query that returns only those triples instead of the full DESCRIBE (see describeProfile.py).  Each sampled document
+is then built again from the CONSTRUCT query, and the profile is only written if every document is the same.
+
+    e.g. `python3 profile-describe.py --sample 200 person publication`
+
+The profiles have to be recorded again after a builder or spec starts reading another property.
+"""
+
+import argparse
+import importlib.util
+import json
+import time
+
+import describeProfile
+import memoCache
+from describeProfile import DescribeProfile, construct_query, profile_path
+from sparqlClient import add_sparql_arguments, configure_sparql
+
+# document type: (ingest script, listing function, describe query, subject variable, builder); the listing function
+# is None for the scripts that subclass Ingest, the builder is then the class
+TYPES = {
+    "person": ("ingest-people.py", "get_people", "describe_person_query", "?person", "create_person_doc"),
+    "publication": ("ingest-publications.py", "get_publications", "describe_publication_query", "?publication",
+                    "create_publication_doc"),
+    "project": ("ingest-projects.py", "get_projects", "describe_project_query", "?project", "create_project_doc"),
+    "field-study": ("ingest-field-studies.py", "get_projects", "describe_project_query", "?project",
+                    "create_project_doc"),
+    "datatype": ("ingest-datatypes.py", "get_dataTypes", "describe_dataType_query", "?dataType",
+                 "create_dataType_doc"),
+    "sample-repository": ("ingest-sample-repositories.py", "get_sample_repositories",
+                          "describe_sample_repository_query", "?sampleRepository", "create_sample_repository_doc"),
+    "dataset": ("ingest-datasets.py", None, None, None, "DatasetIngest"),
+}
+
+
+def canonical( value ):
+    """:return: the JSON of a document with its lists sorted, since their order follows the order of the triples"""
+    def sort( v ):
+        if isinstance( v, dict ):
+            return {k: sort( x ) for k, x in v.items()}
+        if isinstance( v, (list, tuple) ):
+            return sorted( (sort( x ) for x in v), key=lambda x: json.dumps( x, sort_keys=True, default=str ) )
+        return v
+    return json.dumps( sort( value ), sort_keys=True, default=str )
+
+
+class Target:
+    """The entities, describe query and builder of a document type, with a hook on its describe function."""
+
+    def __init__( self, name, endpoint ):
+        script, listing, query, variable, builder = TYPES[name]
+        spec = importlib.util.spec_from_file_location( script[:-3].replace( "-", "_" ), script )
+        module = importlib.util.module_from_spec( spec )
+        spec.loader.exec_module( module )
+
+        self.name = name
+        self.current = None
+        self.hook = None
+        if listing is None:
+            ingest = getattr( module, builder )()
+            ingest.endpoint = endpoint
+            self.entities = list( ingest.get_entities() )
+            self.query = module.load_file( ingest.get_describe_query_file() )
+            self.variable = ingest.get_subject_name()
+            self.build = ingest.create_document
+            ingest.describe_entity = self.hooked( ingest.describe_entity )
+        else:
+            self.entities = list( getattr( module, listing )( endpoint ) )
+            self.query = getattr( module, query )
+            self.variable = variable
+            self.build = lambda entity: getattr( module, builder )( entity, endpoint )
+            module.describe = self.hooked( module.describe )
+
+    def hooked( self, describe ):
+        def hooked_describe( *args, **kwargs ):
+            start = time.time()
+            view = describe( *args, **kwargs )
+            if view is not None and self.hook is not None:
+                self.hook( view, time.time() - start )
+            return view
+        return hooked_describe
+
+    def run( self, entities, hook ):
+        """:return: the JSON of the documents of the entities, calling hook(view, seconds) on every description"""
+        documents = []
+        self.hook = hook
+        for entity in entities:
+            self.current = entity
+            documents.append( canonical( self.build( entity ) ) )
+        self.hook = None
+        return documents
+
+
+def profile_type( name, endpoint, sample, show ):
+    target = Target( name, endpoint )
+    step = max( 1, len( target.entities ) // sample )
+    entities = target.entities[::step][:sample]
+    profile = DescribeProfile( target.query, target.variable )
+
+    # record the reads of the builder from the full descriptions
+    full = {"triples": 0, "seconds": 0.0}
+    def record( view, seconds ):
+        full["triples"] += len( view )
+        full["seconds"] += seconds
+        profile.watch( view, target.current )
+    documents = []
+    for entity in entities:
+        documents.extend( target.run( [entity], record ) )
+        profile.assign( endpoint, entity )
+
+    # build the documents again from the CONSTRUCT query of the profile
+    slim = {"triples": 0, "seconds": 0.0}
+    def measure( view, seconds ):
+        slim["triples"] += len( view )
+        slim["seconds"] += seconds
+    describeProfile.settings["slim"] = True
+    describeProfile._profiles[name] = profile.variables()
+    slim_documents = target.run( entities, measure )
+    describeProfile.settings["slim"] = False
+
+    n = max( len( entities ), 1 )
+    print( "%s: %d entities, describe %.0f triples %.1f ms, construct %.0f triples %.1f ms per entity" % (
+        name, len( entities ), full["triples"] / n, full["seconds"] / n * 1000,
+        slim["triples"] / n, slim["seconds"] / n * 1000) )
+    if show:
+        print( construct_query( target.query, profile.variables() ) )
+    if profile.unprofiled:
+        print( "  reads of resources no variable of the describe query selects:", dict( profile.unprofiled ) )
+
+    differ = [e for e, a, b in zip( entities, documents, slim_documents ) if a != b]
+    if differ:
+        print( "  %d documents differ with the CONSTRUCT query, e.g. %s; profile not written" % (len( differ ), differ[0]) )
+        return False
+    profile.save( profile_path( name ) )
+    print( "  wrote", profile_path( name ) )
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'types', nargs='*', metavar='TYPE', help='document types to profile: %s (default = all)' % ", ".join( TYPES ) )
+    parser.add_argument( '--sample', default=100, type=int, help='number of entities per type, spread over the listing (default = %(default)s)' )
+    parser.add_argument( '--profiles', default=describeProfile.settings["profiles"], help='directory of the profiles (default = %(default)s)' )
+    parser.add_argument( '--show', default=False, action="store_true", help='print the CONSTRUCT query of each type' )
+    parser.add_argument( '--sparql', default='http://deepcarbon.tw.rpi.edu:3030/VIVO/query', help='sparql endpoint' )
+    add_sparql_arguments( parser )
+    args = parser.parse_args()
+    configure_sparql( args )
+    describeProfile.settings["profiles"] = args.profiles
+    # every document has to read its shared sub-documents itself
+    memoCache.settings["size"] = 0
+
+    results = [profile_type( name, args.sparql, args.sample, args.show ) for name in args.types or TYPES]
+    if not all( results ):
+        exit( 1 )
@@ -0,0 +1,143 @@
+import linecache
+import re
+
+from rdflib import Namespace, RDF, RDFS
+
+from graphView import Node
+
+# prefixes of the property path expressions
+PREFIXES = {
+    "rdf": RDF,
+    "rdfs": RDFS,
+    "bibo": Namespace("http://purl.org/ontology/bibo/"),
+    "dcat": Namespace("http://www.w3.org/ns/dcat#"),
+    "dco": Namespace("http://info.deepcarbon.net/schema#"),
+    "dcodata": Namespace("http://info.deepcarbon.net/data/schema#"),
+    "dcosample": Namespace("http://info.deepcarbon.net/sample/schema#"),
+    "dct": Namespace("http://purl.org/dc/terms/"),
+    "foaf": Namespace("http://xmlns.com/foaf/0.1/"),
+    "netid": Namespace("http://vivo.mydomain.edu/ns#"),
+    "obo": Namespace("http://purl.obolibrary.org/obo/"),
+    "prov": Namespace("http://www.w3.org/ns/prov#"),
+    "vcard": Namespace("http://www.w3.org/2006/vcard/ns#"),
+    "vivo": Namespace("http://vivoweb.org/ontology/core#"),
+    "vitro": Namespace("http://vitro.mannlib.cornell.edu/ns/vitro/0.7#"),
+    "vitro-public": Namespace("http://vitro.mannlib.cornell.edu/ns/vitro/public#"),
+}
+
+STEP = re.compile( r'([\w-]+):(\w+)((?:\[[^\]]*\])*)$' )
+FILTER = re.compile( r'\[([^\]]*)\]' )
+
+
+class PropertyPath:
+    """
+    A path of properties from a GraphView node, e.g. "obo:ARG_2000028/vcard:hasEmail[a vcard:Work]/vcard:email".
+    Every step may be followed by filters on the values it reaches:
+        [a prefix:Type]     only resources of the type
+        [labelled]          only resources with a label
+        [has prefix:p ...]  only resources with a value of any of the properties
+        [nonempty]          only non-empty values
+    The expression is compiled once into a function of nested loops over the nodes' predicate index, which returns
+    the first value as soon as it is found.  A path is also a function from a node to the tuple of all its values,
+    so it can be used in Maybe chains, e.g. Maybe.of(person).stream().flatmap(EMAIL).
+    """
+
+    def __init__( self, expression, prefixes=PREFIXES ):
+        self.expression = expression
+        self.traverse = compile_path( expression, prefixes )
+
+    def first( self, node ):
+        """:return: the first value of the path, or None"""
+        return self.traverse( node, True )
+
+    def all( self, node ):
+        """:return: the list of all values of the path"""
+        return self.traverse( node, False )
+
+    def labelled( self, node, first=False ):
+        """
+        :return:    the labelled resources at the end of the path as [{"uri": ..., "name": <label>}, ...],
+                    or just the first of them (or None) if `first`
+        """
+        values = [{"uri": str( v.identifier ), "name": str( v.label_value )}
+                  for v in self.traverse( node, False ) if isinstance( v, Node ) and v.label_value]
+        if first:
+            return values[0] if values else None
+        return values
+
+    def __call__( self, node ):
+        return tuple( self.traverse( node, False ) )
+
+    def __repr__( self ):
+        return "PropertyPath(%r)" % self.expression
+
+
+def compile_path( expression, prefixes=PREFIXES ):
+    """
+    Compile a property path expression (see PropertyPath) into a traversal function.
+    :return:    a function (node, first) returning the first value or None if `first`, else the list of all values
+    """
+    constants = {"Node": Node}
+    lines = ["def traverse( node, first ):",
+             "    values = []",
+             "    if isinstance( node, Node ):"]
+
+    steps = expression.split( "/" )
+    indent = "        "
+    for i, step in enumerate( steps ):
+        match = STEP.match( step.strip() )
+        if match is None:
+            raise ValueError( "invalid property path step: " + step )
+        prefix, local, filters = match.groups()
+        constants["p%d" % i] = prefixes[prefix][local]
+
+        conditions = []
+        for f in FILTER.findall( filters ):
+            f = f.split()
+            if len( f ) == 2 and f[0] == "a":
+                type_prefix, type_local = f[1].split( ":" )
+                constants["t%d_%d" % (i, len( conditions ))] = prefixes[type_prefix][type_local]
+                conditions.append( "isinstance( v%d, Node ) and t%d_%d in v%d.types" % (i, i, len( conditions ), i) )
+            elif len( f ) > 1 and f[0] == "has":
+                names = []
+                for name in f[1:]:
+                    property_prefix, property_local = name.split( ":" )
+                    names.append( "h%d_%d_%d" % (i, len( conditions ), len( names )) )
+                    constants[names[-1]] = prefixes[property_prefix][property_local]
+                conditions.append( "isinstance( v%d, Node ) and (%s)" % (
+                    i, " or ".join( "v%d.properties.get( %s )" % (i, name) for name in names )) )
+            elif f == ["labelled"]:
+                conditions.append( "isinstance( v%d, Node ) and v%d.label_value" % (i, i) )
+            elif f == ["nonempty"]:
+                conditions.append( "v%d" % i )
+            else:
+                raise ValueError( "invalid property path filter: " + " ".join( f ) )
+
+        lines.append( indent + "for v%d in %s.properties.get( p%d, () ):" % (i, "node" if i == 0 else "v%d" % (i - 1), i) )
+        indent += "    "
+        for condition in conditions:
+            lines.append( indent + "if " + condition + ":" )
+            indent += "    "
+        if i < len( steps ) - 1:
+            # only resources have properties to follow
+            lines.append( indent + "if isinstance( v%d, Node ):" % i )
+            indent += "    "
+
+    last = len( steps ) - 1
+    lines.append( indent + "if first:" )
+    lines.append( indent + "    return v%d" % last )
+    lines.append( indent + "values.append( v%d )" % last )
+    lines.append( "    return None if first else values" )
+
+    exec_source( "\n".join( lines ), "<propertyPath %s>" % expression, constants )
+    return constants["traverse"]
+
+
+def exec_source( source, filename, namespace ):
+    """
+    Execute generated source under a pseudo file name, registered in linecache so that tracebacks, pdb and
+    inspect.getsource() show the generated lines.
+    """
+    lines = [line + "\n" for line in source.split( "\n" )]
+    linecache.cache[filename] = (len( source ), None, lines, filename)
+    exec( compile( source, filename, "exec" ), namespace )
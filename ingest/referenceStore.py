@@ -0,0 +1,161 @@
+import os
+import re
+import sqlite3
+
+from rdflib import Literal, URIRef, RDF, RDFS
+
+from sparqlClient import get_client
+
+REFERENCE_QUERY = "queries/listReferences.rq"
+IN_ORGANIZATION = URIRef( "http://info.deepcarbon.net/schema#inOrganization" )
+
+# the reference store of the run; set it (see configure_references) before worker pools are forked
+settings = {"path": None}
+
+# the open store of each process, see get_store
+_stores = {}
+
+
+class ReferenceStore:
+    """
+    Label, types and organization of the reference entities that many documents link to: communities, teams,
+    organizations, research and subject areas, reporting years and most specific types.  The store is filled by one
+    bulk SELECT (queries/listReferences.rq) before the workers are started and kept in a single SQLite file, which
+    every worker reads through a memory map of its own, so a lookup needs neither a SPARQL request nor IPC.
+    Describe queries can then leave these entities out (see trim_describe), and GraphView completes the nodes they
+    link to without a description from the store (see complete).
+    """
+
+    def __init__( self, path ):
+        self.path = path
+        self.db = sqlite3.connect( "file:" + path + "?mode=ro", uri=True, check_same_thread=False )
+        self.db.execute( "PRAGMA mmap_size = 268435456" )
+
+    @staticmethod
+    def load( endpoint, path ):
+        """
+        Replace the contents of the store with the reference entities of the triple store.
+        :param endpoint:    SPARQL endpoint
+        :param path:        the store file
+        """
+        with open( REFERENCE_QUERY ) as query_file:
+            query = query_file.read()
+
+        references = {}
+        for row in get_client( endpoint ).select_iter( query ):
+            # one row per combination of label, type and organization
+            entry = references.setdefault( row["entity"]["value"], [None, [], None] )
+            if entry[0] is None and "label" in row:
+                entry[0] = row["label"]["value"]
+            if "type" in row and row["type"]["value"] not in entry[1]:
+                entry[1].append( row["type"]["value"] )
+            if entry[2] is None and "organization" in row:
+                entry[2] = row["organization"]["value"]
+
+        directory = os.path.dirname( path )
+        if directory:
+            os.makedirs( directory, exist_ok=True )
+        if os.path.exists( path + ".tmp" ):
+            os.remove( path + ".tmp" )
+        db = sqlite3.connect( path + ".tmp" )
+        db.execute( "CREATE TABLE entities (uri TEXT PRIMARY KEY, label TEXT, types TEXT, organization TEXT)" )
+        db.executemany( "INSERT INTO entities VALUES (?, ?, ?, ?)",
+                        ((uri, label, " ".join( types ), organization)
+                         for uri, (label, types, organization) in references.items()) )
+        db.commit()
+        db.close()
+        os.replace( path + ".tmp", path )
+        print( "loaded", len( references ), "reference entities into", path )
+
+    def lookup( self, uris ):
+        """:return: {uri: (label or None, [type, ...], organization or None)} of the `uris` in the store"""
+        uris = list( uris )
+        found = {}
+        for i in range( 0, len( uris ), 500 ):
+            chunk = uris[i:i + 500]
+            rows = self.db.execute( "SELECT uri, label, types, organization FROM entities WHERE uri IN (%s)"
+                                    % ",".join( "?" * len( chunk ) ), chunk )
+            for uri, label, types, organization in rows:
+                found[uri] = (label, types.split(), organization)
+        return found
+
+    def complete( self, view, predicates ):
+        """
+        Give the nodes of a GraphView that its graph links to through one of `predicates` without describing them the
+        label, types and organization of the store, as if the describe query had returned them.  Only the entities
+        the describe query left out are completed, so that a document is the same with and without the store.
+        :param predicates:  the predicates of the reference variables of the describe query, see reference_predicates
+        """
+        linked = set()
+        for node in view.nodes.values():
+            for predicate in predicates:
+                linked.update( node.properties.get( predicate, () ) )
+        pending = [node for node in linked
+                   if not isinstance( node, Literal ) and not node.properties and isinstance( node.identifier, URIRef )]
+        found = self.lookup( str( node.identifier ) for node in pending )
+        for uri, (label, types, organization) in found.items():
+            properties = {}
+            if label is not None:
+                properties[RDFS.label] = (Literal( label ),)
+            if types:
+                properties[RDF.type] = tuple( view.node( URIRef( t ) ) for t in types )
+            if organization is not None:
+                # the link to the organization, which the describe query does not describe either
+                properties[IN_ORGANIZATION] = (view.node( URIRef( organization ) ),)
+            view.node( URIRef( uri ) ).set_properties( properties )
+
+
+def get_store():
+    """:return: the ReferenceStore of this process, or None if the run does not use one"""
+    if settings["path"] is None:
+        return None
+    store = _stores.get( os.getpid() )
+    if store is None:
+        store = _stores[os.getpid()] = ReferenceStore( settings["path"] )
+    return store
+
+
+def trim_describe( query, variables ):
+    """
+    :param query:       a DESCRIBE query
+    :param variables:   the variables of the query that are bound to reference entities, e.g. ["?community", "?team"]
+    :return:            the query without these variables in its DESCRIBE clause if the run uses a reference store;
+                        they are still matched, so the links to the reference entities are still described
+    """
+    if settings["path"] is None or not variables:
+        return query
+    match = re.search( r'DESCRIBE\s+(.*?)\s*WHERE', query, flags=re.IGNORECASE | re.DOTALL )
+    described = [v for v in match.group( 1 ).split() if v not in variables]
+    return query[:match.start( 1 )] + " ".join( described ) + query[match.end( 1 ):]
+
+
+def reference_predicates( query, variables ):
+    """
+    :param query:       a DESCRIBE query, e.g. the content of queries/describeProject.rq
+    :param variables:   the variables of the query that are bound to reference entities, see trim_describe
+    :return:            the predicates through which the query reaches these variables, e.g.
+                        {dco:associatedDCOCommunity, dco:associatedDCOTeam, ...}, as URIRefs
+    """
+    prefixes = dict( re.findall( r'PREFIX\s+([\w-]*):\s*<([^>]*)>', query, flags=re.IGNORECASE ) )
+    predicates = set()
+    for predicate, variable in re.findall( r'\s(<[^>]*>|[\w-]*:\w+)\s+(\?\w+)\b', query ):
+        if variable not in variables:
+            continue
+        if predicate.startswith( "<" ):
+            predicates.add( URIRef( predicate[1:-1] ) )
+        else:
+            prefix, local = predicate.split( ":" )
+            predicates.add( URIRef( prefixes[prefix] + local ) )
+    return frozenset( predicates )
+
+
+def add_reference_arguments( parser ):
+    """Add the reference store command line options to an argparse parser."""
+    parser.add_argument( '--references', help='file of the reference store, e.g. cache/references.sqlite: the labels and types of communities, teams, organizations, areas and reporting years are loaded with one SELECT before the workers start and left out of the describe queries (default = no store)' )
+
+
+def configure_references( args, endpoint ):
+    """Load the reference store, if one is configured, before any worker is forked; after configure_sparql."""
+    if args.references:
+        ReferenceStore.load( endpoint, args.references )
+    settings["path"] = args.references
@@ -0,0 +1,89 @@
+import collections
+
+from rdflib import Literal, URIRef, BNode
+
+from ingestHelpers import bind_values
+from sparqlClient import get_client
+
+# select extraction settings; set them (see configure_select) before worker pools are forked
+settings = {"select": False, "page_size": 500}
+
+
+def term( binding ):
+    """:return: the rdflib term of a binding of the SPARQL JSON results, e.g. a Literal with its datatype"""
+    if binding["type"] == "uri":
+        return URIRef( binding["value"] )
+    if binding["type"] == "bnode":
+        return BNode( binding["value"] )
+    return Literal( binding["value"], lang=binding.get( "xml:lang" ), datatype=binding.get( "datatype" ) )
+
+
+class Bindings:
+    """
+    The result rows of a SELECT query for one entity, e.g. the rows of getPublicationAuthors.rq of one publication.
+    A value is usually repeated over many rows, and the multi-valued parts of a query come in rows of their own (the
+    branches of a UNION, so that their values add up instead of multiplying): first() takes a variable from the first
+    row that binds it, and group() splits the rows by the values of a variable, e.g. by authorship, keeping the order
+    in which the values first appear.
+    """
+
+    __slots__ = ("rows",)
+
+    def __init__( self, rows=None ):
+        self.rows = rows if rows is not None else []
+
+    def first( self, variable ):
+        """:return: the rdflib term of the first binding of the variable (without "?"), or None"""
+        for row in self.rows:
+            binding = row.get( variable )
+            if binding is not None:
+                return term( binding )
+        return None
+
+    def group( self, variable ):
+        """:return: an ordered {term: Bindings} of the rows that bind the variable, by its value"""
+        groups = collections.OrderedDict()
+        for row in self.rows:
+            binding = row.get( variable )
+            if binding is not None:
+                key = term( binding )
+                group = groups.get( key )
+                if group is None:
+                    group = groups[key] = Bindings()
+                group.rows.append( row )
+        return groups
+
+    def __bool__( self ):
+        return bool( self.rows )
+
+
+def select_bindings( endpoint, query, variable, entities ):
+    """
+    Run a set-oriented SELECT query for a page of entities and group its rows by entity, in one pass over the rows.
+    :param endpoint:    SPARQL endpoint
+    :param query:       a SELECT query with the entity variable in its result, e.g. queries/getPublicationInfo.rq
+    :param variable:    the entity variable, e.g. "?publication"
+    :param entities:    the URIs of the entities of the page, bound with a VALUES block
+    :return:            {entity URI: Bindings}; entities without rows are left out
+    """
+    name = variable[1:]
+    grouped = {}
+    for row in get_client( endpoint ).select_iter( bind_values( query, variable, entities ) ):
+        entity = row[name]["value"]
+        bindings = grouped.get( entity )
+        if bindings is None:
+            bindings = grouped[entity] = Bindings()
+        bindings.rows.append( row )
+    return grouped
+
+
+def add_select_arguments( parser ):
+    """Add the select extraction command line options to an argparse parser."""
+    parser.add_argument( '--select', default=False, action="store_true", help='build the documents from paged SELECT result sets instead of a DESCRIBE graph per entity' )
+    parser.add_argument( '--page-size', default=settings["page_size"], type=int, help='number of entities per page of SELECT queries with --select (default = %(default)s)' )
+
+
+def configure_select( args ):
+    """Apply the options added by add_select_arguments; before worker pools are forked."""
+    settings["select"] = args.select
+    settings["page_size"] = args.page_size
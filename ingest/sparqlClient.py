@@ -0,0 +1,348 @@
+import codecs
+import contextlib
+import gzip
+import json
+import os
+import re
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from rdflib import Graph, ConjunctiveGraph, URIRef, BNode, Literal
+
+from describeCache import DescribeCache
+
+# Accept headers: SELECT results as JSON, graphs preferably as N-Triples (the cheapest format for rdflib to parse)
+SELECT_ACCEPT = "application/sparql-results+json"
+GRAPH_ACCEPT = "application/n-triples, text/plain;q=0.9, text/turtle;q=0.8, application/rdf+xml;q=0.5"
+
+# rdflib parser names for the content types a SPARQL endpoint may answer a DESCRIBE/CONSTRUCT query with
+GRAPH_FORMATS = {
+    "application/n-triples": "nt",
+    "text/plain": "nt",
+    "text/turtle": "turtle",
+    "application/x-turtle": "turtle",
+    "application/rdf+xml": "xml",
+    "application/ld+json": "json-ld",
+}
+
+# client settings shared by every process; set them (see configure_sparql) before worker pools are forked
+settings = {"timeout": 60.0, "connections": 4, "retries": 2, "list_page_size": 10000,
+            "cache": None, "cache_ttl": 168.0, "cache_size": 1024, "refresh_cache": False, "source": None,
+            "budget": None, "limiter": None}
+
+# the start of the array of result rows in a SPARQL JSON results document, see iter_bindings
+BINDINGS_START = re.compile( r'"bindings"\s*:\s*\[' )
+BINDINGS_SEPARATOR = re.compile( r'[\s,]*' )
+
+# one client per (worker process, endpoint)
+_clients = {}
+
+# one loaded dump per file, inherited by forked workers
+_dumps = {}
+
+
+class SparqlClient:
+    """Keep-alive HTTP client for a SPARQL endpoint backed by a pooled requests.Session."""
+
+    def __init__( self, endpoint, timeout=None, connections=None, retries=None ):
+        self.endpoint = endpoint
+        self.timeout = timeout if timeout is not None else settings["timeout"]
+        self.connections = connections if connections is not None else settings["connections"]
+
+        adapter = HTTPAdapter( pool_connections=1, pool_maxsize=self.connections,
+                               max_retries=retries if retries is not None else settings["retries"] )
+        self.session = requests.Session()
+        self.session.mount( "http://", adapter )
+        self.session.mount( "https://", adapter )
+
+        # optional on-disk cache of DESCRIBE/CONSTRUCT responses
+        self.cache = None
+        if settings["cache"]:
+            self.cache = DescribeCache( settings["cache"], ttl=settings["cache_ttl"] * 3600,
+                                        max_bytes=settings["cache_size"] * 1024 * 1024 )
+
+    def request( self, query, accept, stream=False ):
+        """
+        Send a query to the endpoint over one of the pooled connections.
+        Queries are POSTed so that long (e.g. batched) queries are not limited by the URL length.
+        :param query:       the SPARQL query
+        :param accept:      the Accept header to send
+        :param stream:      return once the headers are read, the body is read by iterating over the response
+        :return:            the requests.Response
+        Note:   With a budget (a semaphore shared by the processes of ingest-all.py) a slot of it is held until the
+                response is read, or with stream until its headers are.  The same goes for the slots of the limiter
+                of --adaptive, see adaptiveLimiter.AdaptiveLimiter.
+        """
+        def post():
+            return self.session.post( self.endpoint, data={"query": query}, headers={"Accept": accept},
+                                      timeout=self.timeout, stream=stream )
+
+        budget = settings["budget"]
+        limiter = settings["limiter"]
+        with budget if budget is not None else contextlib.nullcontext():
+            r = post() if limiter is None else limiter.call( post, overloaded )
+        if r.status_code != requests.codes.ok:
+            print( r.url, r.status_code )
+            r.raise_for_status()
+        return r
+
+    def select( self, query ):
+        """
+        Run a SELECT query.
+        :param query:       the SPARQL query
+        :return:            the result bindings, e.g. [{'dataset': {'value': 'http://...', 'type': 'uri'}}, ...]
+        """
+        return list( self.select_iter( query ) )
+
+    def select_iter( self, query, columns=None ):
+        """
+        Run a SELECT query and yield its result bindings as they are read off the connection, so that a large result
+        set is never held in memory and its first rows can be used before the response is complete.
+        :param query:       the SPARQL query
+        :param columns:     the variables to keep in each binding, e.g. ["dataset"] (default = all)
+        :return:            a generator over the result bindings, in the form of select()
+        """
+        with contextlib.closing( self.request( query, SELECT_ACCEPT, stream=True ) ) as r:
+            yield from iter_bindings( r.iter_content( 64 * 1024 ), columns )
+
+    def describe_raw( self, query, refresh=False ):
+        """
+        Run a DESCRIBE or CONSTRUCT query without parsing the response.
+        The response is served from and saved to the describe cache, if one is configured.
+        :param query:       the SPARQL query
+        :param refresh:     fetch the response even if it is cached, and cache it again, like --refresh-cache
+        :return:            a (bytes, content type) tuple; see parse_graph
+        """
+        if self.cache is not None and not (refresh or settings["refresh_cache"]):
+            cached = self.cache.get( self.endpoint, query )
+            if cached is not None:
+                return cached
+
+        r = self.request( query, GRAPH_ACCEPT )
+        content_type = r.headers.get( "Content-Type", "" )
+        if self.cache is not None:
+            self.cache.put( self.endpoint, query, r.content, content_type )
+        return r.content, content_type
+
+    def describe( self, query, refresh=False ):
+        """
+        Run a DESCRIBE or CONSTRUCT query.
+        :param query:       the SPARQL query
+        :param refresh:     bypass the describe cache, see describe_raw
+        :return:            an rdflib Graph, or None if the response could not be parsed
+        """
+        return parse_graph( *self.describe_raw( query, refresh ) )
+
+
+class DumpClient:
+    """
+    Answers the queries of the ingest scripts from an N-Triples or N-Quads dump instead of a SPARQL endpoint.
+    The dump is parsed once into an in-memory graph, whose subject index serves the descriptions: a DESCRIBE query is
+    answered by selecting the resources it names and collecting their triples, following blank nodes, which is what
+    the endpoint's DESCRIBE returns.  Queries are evaluated by rdflib, one at a time.
+    """
+
+    def __init__( self, path ):
+        self.endpoint = path
+        self.lock = threading.Lock()
+
+        fmt = "nquads" if ".nq" in os.path.basename( path ) else "nt"
+        self.graph = ConjunctiveGraph() if fmt == "nquads" else Graph()
+        with (gzip.open( path, "rb" ) if path.endswith( ".gz" ) else open( path, "rb" )) as dump:
+            self.graph.parse( source=dump, format=fmt )
+        print( "loaded", len( self.graph ), "triples from", path )
+
+    def select( self, query ):
+        """
+        Run a SELECT query.
+        :param query:       the SPARQL query
+        :return:            the result bindings, in the form of SparqlClient.select
+        """
+        return list( self.select_iter( query ) )
+
+    def select_iter( self, query, columns=None ):
+        """Run a SELECT query, like SparqlClient.select_iter; the rows are evaluated before the first one is yielded."""
+        with self.lock:
+            rows = list( self.graph.query( query ) )
+        for row in rows:
+            yield {str( var ): binding( value ) for var, value in row.asdict().items()
+                   if columns is None or str( var ) in columns}
+
+    def describe_raw( self, query, refresh=False ):
+        """
+        Run a DESCRIBE or CONSTRUCT query.
+        :return:            a (bytes, content type) tuple, like SparqlClient.describe_raw; there is no cache to refresh
+        """
+        data = self.describe( query ).serialize( format="nt" )
+        return data.encode( "utf-8" ) if isinstance( data, str ) else data, "application/n-triples"
+
+    def describe( self, query, refresh=False ):
+        """
+        Run a DESCRIBE query of the form "DESCRIBE ?x <uri> ... WHERE { ... }", or a CONSTRUCT query.
+        :param query:       the SPARQL query
+        :return:            an rdflib Graph with the triples of every described resource
+        """
+        match = re.search( r'DESCRIBE\s+(.*?)\s*WHERE\s*\{', query, flags=re.IGNORECASE | re.DOTALL )
+        if match is None:
+            with self.lock:
+                return self.graph.query( query ).graph
+        terms = re.findall( r'[?$]\w+|<[^>]*>', match.group( 1 ) )
+        variables = [term for term in terms if term[0] in "?$"]
+
+        resources = [URIRef( term[1:-1] ) for term in terms if term[0] == "<"]
+        if variables:
+            select = query[:match.start()] + "SELECT DISTINCT " + " ".join( variables ) + " WHERE {" + query[match.end():]
+            with self.lock:
+                resources.extend( node for row in self.graph.query( select ) for node in row if node is not None )
+
+        graph = Graph()
+        seen = set()
+        with self.lock:
+            for resource in resources:
+                self.add_description( graph, resource, seen )
+        return graph
+
+    def add_description( self, graph, resource, seen ):
+        """Add the triples of a resource to `graph`, and those of the blank nodes it refers to."""
+        if resource in seen or isinstance( resource, Literal ):
+            return
+        seen.add( resource )
+        for s, p, o in self.graph.triples( (resource, None, None) ):
+            graph.add( (s, p, o) )
+            if isinstance( o, BNode ):
+                self.add_description( graph, o, seen )
+
+
+def binding( value ):
+    """:return: the SPARQL JSON results form of an rdflib term, e.g. {'type': 'uri', 'value': 'http://...'}"""
+    if isinstance( value, BNode ):
+        return {"type": "bnode", "value": str( value )}
+    if isinstance( value, Literal ):
+        result = {"type": "literal", "value": str( value )}
+        if value.language:
+            result["xml:lang"] = value.language
+        elif value.datatype:
+            result["datatype"] = str( value.datatype )
+        return result
+    return {"type": "uri", "value": str( value )}
+
+
+def iter_bindings( chunks, columns=None ):
+    """
+    Incrementally parse a SPARQL JSON results document: each row of its bindings array is decoded as soon as it has
+    been read completely, so that only the current part of the document is in memory.
+    :param chunks:      iterable of the bytes of the document, e.g. the chunks of a streamed response
+    :param columns:     the variables to keep in each binding (default = all)
+    :return:            a generator over the result bindings, e.g. {'dataset': {'value': 'http://...', 'type': 'uri'}}
+    """
+    decode = codecs.getincrementaldecoder( "utf-8" )().decode
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    for chunk in chunks:
+        buffer += decode( chunk )
+        if not started:
+            match = BINDINGS_START.search( buffer )
+            if match is None:
+                continue
+            buffer = buffer[match.end():]
+            started = True
+
+        position = 0
+        while True:
+            position = BINDINGS_SEPARATOR.match( buffer, position ).end()
+            if position == len( buffer ):
+                break
+            if buffer[position] == "]":
+                return
+            try:
+                row, position = decoder.raw_decode( buffer, position )
+            except ValueError:
+                # the row is not complete yet
+                break
+            if columns is not None:
+                row = {var: value for var, value in row.items() if var in columns}
+            yield row
+        buffer = buffer[position:]
+    raise ValueError( "incomplete SPARQL results" if started else "no bindings in the SPARQL results" )
+
+
+def overloaded( result ):
+    """
+    :return: whether the response of a request, or the exception it raised, shows an overloaded endpoint: a timeout,
+             a refused or dropped connection, or a 5xx
+    """
+    if isinstance( result, BaseException ):
+        return isinstance( result, (requests.Timeout, requests.ConnectionError) )
+    return result.status_code >= 500
+
+
+def parse_graph( data, content_type ):
+    """
+    Parse the serialized response of a DESCRIBE or CONSTRUCT query.
+    :param data:            the response body
+    :param content_type:    the response Content-Type header
+    :return:                an rdflib Graph, or None if the format is not supported or the data is malformed
+    """
+    fmt = GRAPH_FORMATS.get( content_type.split( ";" )[0].strip().lower() )
+    if fmt is None:
+        print( "unsupported graph format:", content_type )
+        return None
+
+    graph = Graph()
+    try:
+        graph.parse( data=data, format=fmt )
+    except Exception as e:
+        print( "could not parse graph:", e )
+        return None
+    return graph
+
+
+def get_client( endpoint ):
+    """
+    Return the client for an endpoint, creating it on first use.
+    Clients are kept per process so that forked pool workers never share a socket with their parent.
+    :param endpoint:    SPARQL endpoint
+    :return:            a SparqlClient, or the DumpClient of --source
+    """
+    if settings["source"]:
+        dump = _dumps.get( settings["source"] )
+        if dump is None:
+            dump = _dumps[settings["source"]] = DumpClient( settings["source"] )
+        return dump
+
+    key = (os.getpid(), endpoint)
+    client = _clients.get( key )
+    if client is None:
+        client = _clients[key] = SparqlClient( endpoint )
+    return client
+
+
+def add_sparql_arguments( parser ):
+    """Add the SPARQL client command line options to an argparse parser."""
+    parser.add_argument( '--sparql-timeout', default=settings["timeout"], type=float, help='seconds to wait for a SPARQL response (default = %(default)s)' )
+    parser.add_argument( '--sparql-connections', default=settings["connections"], type=int, help='pooled SPARQL connections per worker (default = %(default)s)' )
+    parser.add_argument( '--list-page-size', default=settings["list_page_size"], type=int, help='number of entities per page of the listing query; 0 lists them with one query (default = %(default)s)' )
+    parser.add_argument( '--source', help='answer the queries from an N-Triples/N-Quads dump (.nt, .nq, optionally .gz) instead of the SPARQL endpoint' )
+    parser.add_argument( '--cache', help='file of the on-disk DESCRIBE response cache, e.g. cache/describe.sqlite (default = no cache)' )
+    parser.add_argument( '--cache-ttl', default=settings["cache_ttl"], type=float, help='hours a cached DESCRIBE response stays valid (default = %(default)s)' )
+    parser.add_argument( '--cache-size', default=settings["cache_size"], type=int, help='size cap of the DESCRIBE cache in MB; least recently used responses are evicted (default = %(default)s)' )
+    parser.add_argument( '--no-cache', default=False, action="store_true", help="bypass the DESCRIBE cache" )
+    parser.add_argument( '--refresh-cache', default=False, action="store_true", help="re-fetch every DESCRIBE response and overwrite the cached copy" )
+
+
+def configure_sparql( args ):
+    """Apply the options added by add_sparql_arguments to every client created afterwards."""
+    settings["timeout"] = args.sparql_timeout
+    settings["connections"] = args.sparql_connections
+    settings["list_page_size"] = args.list_page_size
+    settings["cache"] = None if args.no_cache else args.cache
+    settings["cache_ttl"] = args.cache_ttl
+    settings["cache_size"] = args.cache_size
+    settings["refresh_cache"] = args.refresh_cache
+    settings["source"] = args.source
+
+    # load the dump before any worker is forked, so that the workers share it
+    if settings["source"]:
+        get_client( settings["source"] )
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the tests import the ingest modules the way the scripts do, from the ingest directory, and read its specs/ and
+# queries/ relative to it
+INGEST = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, INGEST )
+os.chdir( INGEST )
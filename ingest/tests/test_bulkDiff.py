@@ -0,0 +1,95 @@
+import json
+
+from bulkDiff import BulkDiff
+
+
+def index( doc_id, **fields ):
+    """:return: the bulk index action of a document"""
+    meta = {"index": {"_index": "dco", "_type": "dataset", "_id": doc_id}}
+    return json.dumps( meta ) + '\n' + json.dumps( dict( fields, uri="http://info.deepcarbon.net/" + doc_id ) )
+
+
+def publish( manifest, actions, retry=None, full=False ):
+    """:return: the diff and the actions it lets through, after saving the manifest"""
+    diff = BulkDiff( manifest, "dco", "dataset" )
+    sent = list( diff.diff( actions, full=full, retry=retry ) )
+    diff.save()
+    return diff, sent
+
+
+def source_hash( action ):
+    return BulkDiff.hash( action.partition( '\n' )[2] )
+
+
+def deletes( sent ):
+    """:return: the _ids of the delete actions"""
+    metas = [json.loads( action.partition( '\n' )[0] ) for action in sent]
+    return [meta["delete"]["_id"] for meta in metas if "delete" in meta]
+
+
+def test_new_changed_unchanged_and_deleted( tmp_path ):
+    manifest = str( tmp_path / "dataset.json.gz" )
+    diff, sent = publish( manifest, [index( "a", title="A" ), index( "b", title="B" ), index( "c", title="C" )] )
+    assert (diff.new, diff.changed, diff.unchanged, diff.deleted) == (3, 0, 0, 0)
+    assert len( sent ) == 3
+
+    diff, sent = publish( manifest, [index( "a", title="A" ), index( "b", title="B2" ), index( "d", title="D" )] )
+    assert (diff.new, diff.changed, diff.unchanged, diff.deleted) == (1, 1, 1, 1)
+    assert sent[:2] == [index( "b", title="B2" ), index( "d", title="D" )]
+    assert deletes( sent ) == ["c"]
+
+    diff, sent = publish( manifest, [index( "a", title="A" ), index( "b", title="B2" ), index( "d", title="D" )] )
+    assert (diff.new, diff.changed, diff.unchanged, diff.deleted) == (0, 0, 3, 0)
+    assert sent == []
+
+
+def test_hash_ignores_key_order():
+    assert BulkDiff.hash( '{"a": 1, "b": 2}' ) == BulkDiff.hash( '{"b":2,"a":1}' )
+
+
+def test_failed_entity_keeps_its_document( tmp_path ):
+    manifest = str( tmp_path / "dataset.json.gz" )
+    publish( manifest, [index( "a", title="A" ), index( "b", title="B" )] )
+
+    # "b" could not be built this time, e.g. the endpoint went down after the listing
+    retry = tmp_path / "dataset.bulk.failed"
+    retry.write_text( "http://info.deepcarbon.net/b\n" )
+    diff, sent = publish( manifest, [index( "a", title="A" )], retry=str( retry ) )
+    assert deletes( sent ) == []
+    assert (diff.deleted, diff.kept) == (0, 1)
+
+    # its document stays in the manifest, so a later run does not send it again if it comes back unchanged
+    diff, sent = publish( manifest, [index( "a", title="A" ), index( "b", title="B" )] )
+    assert sent == []
+    assert diff.unchanged == 2
+
+    # and is deleted by a run without failures once it is gone
+    diff, sent = publish( manifest, [index( "a", title="A" )], retry=str( tmp_path / "missing.failed" ) )
+    assert deletes( sent ) == ["b"]
+
+
+def test_full_sends_everything_and_deletes_nothing( tmp_path ):
+    manifest = str( tmp_path / "dataset.json.gz" )
+    publish( manifest, [index( "a", title="A" ), index( "b", title="B" )] )
+
+    retry = tmp_path / "dataset.bulk.failed"
+    retry.write_text( "http://info.deepcarbon.net/b\n" )
+    diff, sent = publish( manifest, [index( "a", title="A" )], retry=str( retry ), full=True )
+    assert sent == [index( "a", title="A" )]
+    # a fresh index does not have the document of the failed entity, so neither does its manifest
+    assert BulkDiff( manifest, "dco", "dataset" ).previous == {"a": source_hash( index( "a", title="A" ) )}
+
+
+class Publisher:
+    def __init__( self, failed ):
+        self.failed = failed
+
+
+def test_manifest_kept_after_failed_publish( tmp_path ):
+    manifest = str( tmp_path / "dataset.json.gz" )
+    publish( manifest, [index( "a", title="A" )] )
+
+    diff = BulkDiff( manifest, "dco", "dataset" )
+    list( diff.diff( [index( "a", title="A2" )] ) )
+    diff.commit( Publisher( failed=1 ) )
+    assert BulkDiff( manifest, "dco", "dataset" ).previous == {"a": source_hash( index( "a", title="A" ) )}
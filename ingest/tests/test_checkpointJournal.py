@@ -0,0 +1,93 @@
+import argparse
+import gzip
+
+import pytest
+
+from checkpointJournal import CheckpointJournal, Isolated, read_retry_list, retry_list
+
+
+def lines( bulk_file, *names ):
+    for name in names:
+        bulk_file.write( ('{"index": {"_id": "%s"}}\n{"uri": "%s"}\n' % (name, name)).encode( "utf-8" ) )
+
+
+@pytest.mark.parametrize( "name", ["dataset.bulk", "dataset.bulk.gz"] )
+def test_resume_skips_the_checkpointed_batches( tmp_path, name ):
+    path = str( tmp_path / name )
+    journal = CheckpointJournal( path + ".journal", [path] )
+    bulk_file, = journal.open()
+    lines( bulk_file, "a", "b" )
+    journal.checkpoint( ["a", "b"] )
+    lines( bulk_file, "c" )
+    journal.checkpoint( ["c"] )
+    # killed while writing the next batch, before its checkpoint
+    lines( bulk_file, "d" )
+    bulk_file.flush()
+
+    resumed = CheckpointJournal( path + ".journal", [str( tmp_path / "other.bulk" )], resume=True )
+    assert resumed.done == {"a", "b", "c"}
+    assert resumed.bulk_paths == [path]
+    assert list( resumed.pending( ["a", "b", "c", "d", "e"] ) ) == ["d", "e"]
+    assert not resumed.complete
+
+    # the lines written after the last checkpoint are dropped, the others are kept and published with the new ones
+    bulk_file, = resumed.open()
+    lines( bulk_file, "d", "e" )
+    assert [line.split( '"' )[-2] for line in resumed.resumed() if "uri" in line] == ["a", "b", "c"]
+    resumed.checkpoint( ["d", "e"] )
+    resumed.close()
+    with (gzip.open( path, "rt" ) if name.endswith( ".gz" ) else open( path )) as bulk:
+        assert [line.split( '"' )[-2] for line in bulk if "uri" in line] == ["a", "b", "c", "d", "e"]
+
+    again = CheckpointJournal( path + ".journal", [path], resume=True )
+    assert again.complete and not again.finished
+    again.finish()
+    assert CheckpointJournal( path + ".journal", [path], resume=True ).finished
+
+
+def test_torn_last_entry_is_dropped( tmp_path ):
+    path = str( tmp_path / "dataset.bulk" )
+    journal = CheckpointJournal( path + ".journal", [path] )
+    bulk_file, = journal.open()
+    lines( bulk_file, "a" )
+    journal.checkpoint( ["a"] )
+    journal.journal.write( '{"entities": ["b"], "len' )
+    journal.journal.flush()
+
+    resumed = CheckpointJournal( path + ".journal", [path], resume=True )
+    assert resumed.done == {"a"}
+    resumed.open()
+    resumed.checkpoint( ["b"] )
+    # the entries appended after the torn one can be read again
+    assert CheckpointJournal( path + ".journal", [path], resume=True ).done == {"a", "b"}
+
+
+def test_without_resume_the_journal_starts_over( tmp_path ):
+    path = str( tmp_path / "dataset.bulk" )
+    journal = CheckpointJournal( path + ".journal", [path] )
+    journal.open()
+    journal.checkpoint( ["a"] )
+    assert CheckpointJournal( path + ".journal", [path] ).done == set()
+
+
+def process( entities, endpoint ):
+    if "bad" in entities:
+        raise ValueError( "cannot build" )
+    return ["%s@%s" % (entity, endpoint) for entity in entities]
+
+
+def test_isolated_records_only_the_entities_that_fail( tmp_path ):
+    retry = str( tmp_path / "dataset.bulk.failed" )
+    isolated = Isolated( process, retry, batched=True )
+    assert isolated( ["a", "bad", "b"], "ep" ) == ["a@ep", "b@ep"]
+    assert isolated( ["c"], "ep" ) == ["c@ep"]
+    assert read_retry_list( retry ) == {"bad"}
+
+
+def test_retry_list_is_emptied_unless_resuming( tmp_path ):
+    out = str( tmp_path / "dataset.bulk" )
+    with open( out + ".failed", "w" ) as retry_file:
+        retry_file.write( "http://ex/a\n" )
+    assert read_retry_list( retry_list( argparse.Namespace( retry_list=None, resume=True ), out ) ) == {"http://ex/a"}
+    assert read_retry_list( retry_list( argparse.Namespace( retry_list=None, resume=False ), out ) ) == set()
+    assert read_retry_list( None ) == set()
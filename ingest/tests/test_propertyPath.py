@@ -0,0 +1,84 @@
+import inspect
+
+import pytest
+from rdflib import Graph, Literal, RDF, RDFS, URIRef
+
+from graphView import GraphView
+from propertyPath import PropertyPath, PREFIXES
+
+OBO, VCARD, VIVO, FOAF = PREFIXES["obo"], PREFIXES["vcard"], PREFIXES["vivo"], PREFIXES["foaf"]
+
+GIVEN_NAME = PropertyPath( "obo:ARG_2000028/vcard:hasName/vcard:givenName[nonempty]" )
+EMAIL = PropertyPath( "obo:ARG_2000028/vcard:hasEmail[a vcard:Work]/vcard:email[nonempty]" )
+ORGANIZATIONS = PropertyPath( "vivo:relatedBy[a vivo:Position]/vivo:relates[a foaf:Organization]" )
+
+
+def ex( name ):
+    return URIRef( "http://ex/" + name )
+
+
+@pytest.fixture
+def person():
+    graph = Graph()
+    triples = [
+        ("person", OBO.ARG_2000028, "vcard"),
+        ("vcard", VCARD.hasName, "name"),
+        ("name", VCARD.givenName, Literal( "" )),
+        ("name", VCARD.givenName, Literal( "Ada" )),
+        ("vcard", VCARD.hasEmail, "home"),
+        ("home", VCARD.email, Literal( "ada@home.example.org" )),
+        ("vcard", VCARD.hasEmail, "work"),
+        ("work", RDF.type, VCARD.Work),
+        ("work", VCARD.email, Literal( "ada@example.org" )),
+        ("position", RDF.type, VIVO.Position),
+        ("person", VIVO.relatedBy, "position"),
+        ("position", VIVO.relates, "person"),
+        ("position", VIVO.relates, "org"),
+        ("position", VIVO.relates, "unlabelled"),
+        ("org", RDF.type, FOAF.Organization),
+        ("org", RDFS.label, Literal( "Carbon Institute" )),
+        ("unlabelled", RDF.type, FOAF.Organization),
+        ("person", VIVO.relatedBy, "membership"),
+        ("membership", VIVO.relates, "club"),
+        ("club", RDF.type, FOAF.Organization),
+        ("club", RDFS.label, Literal( "Not through a position" )),
+    ]
+    for s, p, o in triples:
+        graph.add( (ex( s ), p, o if isinstance( o, (URIRef, Literal) ) else ex( o )) )
+    return GraphView( graph ).resource( ex( "person" ) )
+
+
+def test_first_skips_filtered_values( person ):
+    assert str( GIVEN_NAME.first( person ) ) == "Ada"
+    assert str( EMAIL.first( person ) ) == "ada@example.org"
+
+
+def test_all_and_labelled( person ):
+    assert sorted( str( o ) for o in ORGANIZATIONS.all( person ) ) == ["http://ex/org", "http://ex/unlabelled"]
+    assert ORGANIZATIONS.labelled( person ) == [{"uri": "http://ex/org", "name": "Carbon Institute"}]
+    assert ORGANIZATIONS.labelled( person, first=True ) == {"uri": "http://ex/org", "name": "Carbon Institute"}
+    assert PropertyPath( "vivo:relatedBy/vivo:relates[labelled]" ).labelled( person, first=True ) is not None
+
+
+def test_has_filter( person ):
+    assert [str( v ) for v in PropertyPath( "obo:ARG_2000028[has vcard:hasTelephone vcard:hasName]" ).all( person )] \
+        == ["http://ex/vcard"]
+    assert PropertyPath( "obo:ARG_2000028[has vcard:hasTelephone]" ).all( person ) == []
+
+
+def test_missing_values( person ):
+    assert PropertyPath( "vivo:hasResearchArea" ).first( person ) is None
+    assert PropertyPath( "vivo:hasResearchArea" )( person ) == ()
+    # literals have no properties to follow
+    assert PropertyPath( "obo:ARG_2000028/vcard:hasName/vcard:givenName/rdfs:label" ).all( person ) == []
+    assert GIVEN_NAME.first( Literal( "not a node" ) ) is None
+
+
+@pytest.mark.parametrize( "expression", ["vivo:relatedBy[sorted]", "relatedBy", "nope:relatedBy"] )
+def test_invalid_expressions( expression ):
+    with pytest.raises( (ValueError, KeyError) ):
+        PropertyPath( expression )
+
+
+def test_generated_source_is_viewable():
+    assert inspect.getsource( GIVEN_NAME.traverse ).startswith( "def traverse( node, first ):" )